@@ -26,13 +26,20 @@
 
 
 
+import atexit
+import json
 import os
 import pwem
+import re
 import subprocess
+import threading
+
+from pyworkflow import Config
 
 import pyworkflow.utils as pwutils
 from phenix.constants import *
 from pwem.constants import MAXIT
+from phenix.worker import PhenixPythonWorker, PhenixWorkerError
 
 _logo = "phenix.png"
 _references = ['Adams_2010']
@@ -43,6 +50,14 @@ class Plugin(pwem.Plugin):
     _homeVar = PHENIX_HOME
     _pathVars = [PHENIX_HOME]
     _supportedVersions = PHENIXVERSION
+    # resolved PHENIX versions, see getPhenixVersion
+    _versionCache = {}
+    # counters to check how often phenix.version is really launched
+    versionCalls = 0
+    versionLaunches = 0
+    # phenix.python process shared by every protocol and viewer
+    _worker = None
+    _workerLock = threading.Lock()
 
     @classmethod
     def _defineVariables(cls):
@@ -50,6 +65,7 @@ class Plugin(pwem.Plugin):
             cls._defineEmVar(PHENIX_HOME, 'phenix-1.18.2')
         else:
             cls._defineEmVar(PHENIX_HOME, ('phenix-' + (Plugin.getPhenixVersion())))
+        cls._defineVar(PHENIX_CACHE_SIZE, 20)
 
     @classmethod
     def getEnviron(cls, first=True):
@@ -87,11 +103,35 @@ class Plugin(pwem.Plugin):
         pwutils.runJob(None, program, args, env=env, cwd=cwd)
 
     @classmethod
-    def getProgram(cls, progName):
-        """ Return the program binary that will be used. """
-        return os.path.join(Plugin.getHome(),
-                            mapBinarytoDirectory[progName],
-                            os.path.basename(progName))
+    def createPhenixWorker(cls):
+        """ Return a new phenix.python worker, e.g. for a thread that
+        needs one for itself. The caller must close it. """
+        return PhenixPythonWorker(
+            os.path.join(cls.getHome(), 'build', 'bin',
+                         PHENIX_PYTHON.strip()),
+            environ=cls.getEnviron())
+
+    @classmethod
+    def getPhenixWorker(cls):
+        """ Return the phenix.python worker of this session. """
+        with cls._workerLock:
+            if cls._worker is None:
+                cls._worker = cls.createPhenixWorker()
+                atexit.register(cls._worker.close)
+            return cls._worker
+
+    @classmethod
+    def runPhenixScript(cls, pythonFileName, cwd=None):
+        """ Run a python script with phenix.python. The script is executed
+        by the session worker so the interpreter start up and the cctbx
+        imports are paid only once. A new interpreter is launched if the
+        worker is not available. """
+        try:
+            cls.getPhenixWorker().runScript(pythonFileName, cwd=cwd)
+        except PhenixWorkerError as e:
+            print("phenix.python worker not available (%s), "
+                  "launching a new interpreter" % e)
+            cls.runPhenixProgram("", pythonFileName, cwd=cwd)
 
     @classmethod
     def getProgram(cls, progName):
@@ -102,17 +142,85 @@ class Plugin(pwem.Plugin):
 
     @classmethod
     def getPhenixVersion(cls):
-        """ Return the program binary that will be used. """
-        pid = subprocess.Popen(cls.getProgram("phenix.version"),
-                           shell=True,
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE)
+        """ Return the installed PHENIX version (e.g. '1.19').
+        The version is resolved once per installation: it is cached in memory
+        and on disk, keyed by PHENIX_HOME and the modification time of the
+        phenix.version binary, so upgrading PHENIX invalidates the cache.
+        """
+        cls.versionCalls += 1
+        program = cls.getProgram(GETVERSION)
+        key = cls._getVersionKey(program)
+        if key in cls._versionCache:
+            return cls._versionCache[key]
+
+        diskCache = cls._readVersionCacheFile()
+        if cls._isVersionValid(diskCache.get(key)):
+            version = diskCache[key]
+        else:
+            version = cls._runPhenixVersion(program)
+            # only persist versions of an existing binary
+            if os.path.exists(program) and cls._isVersionValid(version):
+                diskCache[key] = version
+                cls._writeVersionCacheFile(diskCache)
+        if cls._isVersionValid(version):
+            cls._versionCache[key] = version
+        return version
+
+    @classmethod
+    def _runPhenixVersion(cls, program):
+        """ Launch phenix.version and parse its output. """
+        if not os.path.exists(program):
+            return ''
+        cls.versionLaunches += 1
+        pid = subprocess.Popen(program,
+                               shell=True,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
         stdout, stderr = pid.communicate()
         searchKey = "Version: "
         stdout = stdout.decode("utf-8")
         place = stdout.find(searchKey)
+        if place == -1:
+            return ''
         return stdout[place + len(searchKey):place + len(searchKey)+4]
 
+    @staticmethod
+    def _isVersionValid(version):
+        """ True if version looks like a PHENIX version (e.g. '1.19'),
+        so that garbage parsed from phenix.version is never cached. """
+        return bool(version) and re.match(r'\d+\.\d+$', version) is not None
+
+    @classmethod
+    def _getVersionKey(cls, program):
+        try:
+            mtime = os.stat(program).st_mtime
+        except OSError:
+            mtime = None
+        return "%s:%s" % (cls.getHome(), mtime)
+
+    @classmethod
+    def _getVersionCacheFile(cls):
+        return os.path.join(Config.SCIPION_USER_DATA, PHENIX_VERSION_CACHE)
+
+    @classmethod
+    def _readVersionCacheFile(cls):
+        try:
+            with open(cls._getVersionCacheFile()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @classmethod
+    def _writeVersionCacheFile(cls, diskCache):
+        fileName = cls._getVersionCacheFile()
+        tmpFileName = "%s.%d" % (fileName, os.getpid())
+        try:
+            with open(tmpFileName, "w") as f:
+                json.dump(diskCache, f)
+            os.replace(tmpFileName, fileName)
+        except OSError:
+            pwutils.cleanPath(tmpFileName)
+
     @classmethod
     def isVersionActive(cls):
         return cls.getActiveVersion().startswith(PHENIXVERSION)
@@ -0,0 +1,461 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Project level caches of PHENIX inputs and results.
+
+Programs such as molprobity, validation_cryoem or emringer are often run
+on byte identical inputs (cloned protocols, the validation steps of real
+space refine...). The outputs of a run are stored in the project cache
+under a key computed from the content of the input files, the normalized
+argument string and the PHENIX version, and restored on the next run with
+the same key instead of launching the program again.
+
+Maps converted for PHENIX (origin and sampling written in the header) are
+also shared: they are stored once per project, keyed by the content of the
+source file, its origin and its sampling rate, and every protocol gets a
+link to the stored file.
+
+Protocols that leave many small intermediate files behind (e.g. search
+fit) can pack them in a FileArchive and extract them when needed.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+
+import pyworkflow.utils as pwutils
+from pwem.convert.atom_struct import retry
+
+from phenix import Plugin
+from phenix.constants import (PHENIX_CACHE_DIR, PHENIX_CACHE_SIZE,
+                              PHENIX_MAPS_DIR, PHENIX_RESULTS_DIR)
+
+FICLONE = 0x40049409  # linux ioctl to clone (reflink) a file
+MANIFEST = 'manifest.json'
+TMP_MAP_SUFFIX = '.tmp.mrc'  # maps being converted
+
+# sha256 of files already hashed in this process
+_hashes = {}
+_hashesLock = threading.Lock()
+
+
+def hashFile(fileName, blockSize=1 << 20):
+    """ Return the sha256 of a file. Results are memoized using the
+    inode, size and modification time of the file. """
+    st = os.stat(fileName)
+    memoKey = (os.path.abspath(fileName), st.st_ino, st.st_size,
+               st.st_mtime_ns)
+    with _hashesLock:
+        if memoKey in _hashes:
+            return _hashes[memoKey]
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _hashesLock:
+        _hashes[memoKey] = digest
+    return digest
+
+
+def reflinkFile(src, dst):
+    """ Make dst a copy on write clone of src. Returns False (and leaves
+    no dst behind) if the filesystem does not support it. """
+    pwutils.cleanPath(dst)
+    try:
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return True
+    except OSError:
+        pwutils.cleanPath(dst)
+        return False
+
+
+def cloneFile(src, dst):
+    """ Make dst a copy of src as cheaply as possible: a copy on write
+    clone (reflink) where the filesystem supports it, otherwise a hard
+    link and, as last resort, a real copy. """
+    if reflinkFile(src, dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _listFiles(folder):
+    """ Relative paths of every file under folder. """
+    fileList = []
+    for root, dirs, files in os.walk(folder):
+        for fn in files:
+            fileList.append(os.path.relpath(os.path.join(root, fn), folder))
+    return sorted(fileList)
+
+
+class ProgramCache(object):
+    """ Cache of program outputs with LRU eviction and a size cap
+    (in bytes). Each entry is a folder named after the key that contains
+    the output files and a manifest with their size and sha256, which is
+    checked before an entry is restored. """
+    def __init__(self, cacheDir, maxSize):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    def _getEntry(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def _lock(self):
+        pwutils.makePath(self.cacheDir)
+        lockFile = open(os.path.join(self.cacheDir, '.lock'), 'w')
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        return lockFile
+
+    def getKey(self, program, args, cwd, version, modelFiles=()):
+        """ Return the cache key and the arguments to run the program
+        with (paths made absolute so the program can run anywhere).
+        The content of the input files enters the key instead of their
+        path; model basenames are kept because they name the outputs.
+        """
+        modelFiles = [os.path.abspath(fn) for fn in modelFiles]
+        keyTokens = [os.path.basename(program), 'version=%s' % version]
+        runTokens = []
+        for token in args.split():
+            name, sep, value = token.rpartition('=')
+            path = value if os.path.isabs(value) else os.path.join(cwd, value)
+            if value and os.path.isfile(path):
+                path = os.path.abspath(path)
+                runTokens.append(name + sep + path)
+                label = os.path.basename(path) if path in modelFiles else ''
+                keyTokens.append('%s%sfile:%s:%s' % (name, sep, label,
+                                                     hashFile(path)))
+            else:
+                runTokens.append(token)
+                if name != 'nproc':  # does not change the results
+                    keyTokens.append(token)
+        key = hashlib.sha256(' '.join(keyTokens).encode()).hexdigest()
+        return key, ' '.join(runTokens)
+
+    def restore(self, key, outDir):
+        """ Link the outputs stored under key into outDir.
+        Return False if there is no valid entry. """
+        entry = self._getEntry(key)
+        manifestFn = os.path.join(entry, MANIFEST)
+        with self._lock():
+            try:
+                with open(manifestFn) as f:
+                    manifest = json.load(f)
+                for relPath, (size, sha) in manifest['files'].items():
+                    fn = os.path.join(entry, relPath)
+                    if os.path.getsize(fn) != size or hashFile(fn) != sha:
+                        raise ValueError("%s was modified" % fn)
+            except (OSError, ValueError, KeyError):
+                # missing or corrupted entry, never restore it
+                shutil.rmtree(entry, ignore_errors=True)
+                return False
+
+            for relPath in manifest['files']:
+                dst = os.path.join(outDir, relPath)
+                pwutils.makePath(os.path.dirname(dst))
+                cloneFile(os.path.join(entry, relPath), dst)
+            os.utime(manifestFn)  # LRU timestamp
+        return True
+
+    def store(self, key, outDir, description=''):
+        """ Store the files under outDir as the entry for key. """
+        entry = self._getEntry(key)
+        pwutils.makePath(os.path.dirname(entry))
+        tmpEntry = tempfile.mkdtemp(prefix='.tmp', dir=os.path.dirname(entry))
+        manifest = {'description': description, 'files': {}, 'size': 0}
+        for relPath in _listFiles(outDir):
+            src = os.path.join(outDir, relPath)
+            dst = os.path.join(tmpEntry, relPath)
+            pwutils.makePath(os.path.dirname(dst))
+            cloneFile(src, dst)
+            size = os.path.getsize(dst)
+            manifest['files'][relPath] = (size, hashFile(dst))
+            manifest['size'] += size
+        with open(os.path.join(tmpEntry, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        with self._lock():
+            if os.path.exists(entry):
+                shutil.rmtree(tmpEntry, ignore_errors=True)
+            else:
+                os.rename(tmpEntry, entry)
+            self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used entries until the cache
+        fits in maxSize. Must be called holding the lock. """
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.cacheDir):
+            prefixDir = os.path.join(self.cacheDir, prefix)
+            if not os.path.isdir(prefixDir):
+                continue
+            for key in os.listdir(prefixDir):
+                manifestFn = os.path.join(prefixDir, key, MANIFEST)
+                try:
+                    with open(manifestFn) as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(manifestFn), size,
+                                    os.path.join(prefixDir, key)))
+                    total += size
+                except (OSError, ValueError, KeyError):
+                    continue
+        for _, size, entry in sorted(entries):
+            if total <= self.maxSize:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class MapStore(object):
+    """ Converted maps shared by all the protocols of a project.
+    Stored maps are never modified once published. Maps that are not
+    linked from any protocol any more are evicted (least recently used
+    first) when the store grows beyond maxSize bytes. """
+    def __init__(self, storeDir, maxSize):
+        self.storeDir = storeDir
+        self.maxSize = maxSize
+
+    def getKey(self, inFileName, origin, sampling):
+        # remove scipion annotations such as 'volume.mrc:mrc'
+        fileName = re.sub(':mrcs?$', '', inFileName)
+        key = '%s origin=%s sampling=%s' % (
+            hashFile(fileName),
+            ','.join('%0.4f' % x for x in origin), '%0.6f' % sampling)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def getMap(self, inFileName, outFileName, origin, sampling, convert):
+        """ Make outFileName a hard link to (or, across file systems, a
+        copy of) the converted version of inFileName.
+        convert(inFileName, outFileName, origin, sampling) is only
+        called if the map is not in the store yet. """
+        key = self.getKey(inFileName, origin, sampling)
+        storedFn = os.path.join(self.storeDir, key[:2], key + '.mrc')
+        if not os.path.exists(storedFn):
+            pwutils.makePath(os.path.dirname(storedFn))
+            # keep the .mrc extension, the converters rely on it
+            tmpFn = '%s.%d.%d%s' % (storedFn[:-4], os.getpid(),
+                                    threading.get_ident(), TMP_MAP_SUFFIX)
+            try:
+                convert(inFileName, tmpFn, origin, sampling)
+                os.replace(tmpFn, storedFn)
+            finally:
+                pwutils.cleanPath(tmpFn)
+            stored = True
+        else:
+            os.utime(storedFn)  # LRU timestamp
+            stored = False
+
+        pwutils.cleanPath(outFileName)
+        try:
+            os.link(storedFn, outFileName)
+        except OSError:  # e.g. different file systems
+            # a copy, never a symlink: symlinks do not count as users of
+            # the stored map, which could then be evicted under them
+            if not reflinkFile(storedFn, outFileName):
+                shutil.copyfile(storedFn, outFileName)
+        if stored:
+            # once linked, so that the new map is not taken as unused
+            self._evict()
+
+    def _evict(self):
+        maps = []
+        total = 0
+        for root, dirs, files in os.walk(self.storeDir):
+            for fn in files:
+                if not fn.endswith('.mrc') or fn.endswith(TMP_MAP_SUFFIX):
+                    continue
+                path = os.path.join(root, fn)
+                st = os.stat(path)
+                total += st.st_size
+                if st.st_nlink == 1:  # not used by any protocol
+                    maps.append((st.st_mtime, st.st_size, path))
+        for _, size, path in sorted(maps):
+            if total <= self.maxSize:
+                break
+            pwutils.cleanPath(path)
+            total -= size
+
+
+class FileArchive(object):
+    """ Compressed archive of files grouped by a key, e.g. a job id: the
+    files of every key go to their own zip file in the folder dirName.
+    A zip is written under a temporary name and renamed once it is
+    complete on disk, so an interrupted call never damages what was
+    archived before. The archive can be used by several threads and
+    processes at the same time. """
+    def __init__(self, dirName):
+        self.dirName = os.path.abspath(dirName)
+
+    def _lock(self):
+        pwutils.makePath(self.dirName)
+        lockFile = open(os.path.join(self.dirName, '.lock'), 'w')
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        return lockFile
+
+    def _getZipFile(self, key):
+        return os.path.join(self.dirName, '%s.zip' % key)
+
+    def add(self, key, fileNames):
+        """ Move the files into the archive under key. Files already
+        archived under key (e.g. by an interrupted call) are just
+        removed. """
+        zipFn = self._getZipFile(key)
+        with self._lock():
+            # e.g. removed by a concurrent call
+            fileNames = [fn for fn in fileNames if os.path.exists(fn)]
+            existing = []
+            if os.path.exists(zipFn):
+                with zipfile.ZipFile(zipFn) as archive:
+                    existing = archive.namelist()
+            newFiles = [fn for fn in fileNames
+                        if os.path.basename(fn) not in existing]
+            if newFiles:
+                tmpFn = '%s.%d.tmp' % (zipFn, os.getpid())
+                try:
+                    with zipfile.ZipFile(tmpFn, 'w',
+                                         zipfile.ZIP_DEFLATED) as archive:
+                        if existing:  # e.g. files of a later round
+                            with zipfile.ZipFile(zipFn) as old:
+                                for member in existing:
+                                    archive.writestr(old.getinfo(member),
+                                                     old.read(member))
+                        for fileName in newFiles:
+                            archive.write(fileName,
+                                          os.path.basename(fileName))
+                    _fsync(tmpFn)
+                    os.replace(tmpFn, zipFn)
+                    _fsync(self.dirName)
+                finally:
+                    pwutils.cleanPath(tmpFn)
+            # only once the archive is complete on disk
+            for fileName in fileNames:
+                pwutils.cleanPath(fileName)
+
+    def extract(self, key, outDir):
+        """ Copy the files archived under key to outDir and return their
+        paths. The archive keeps them. """
+        zipFn = self._getZipFile(key)
+        if not os.path.exists(zipFn):
+            return []
+        extracted = []
+        with zipfile.ZipFile(zipFn) as archive:
+            for member in archive.namelist():
+                outFileName = os.path.join(outDir, member)
+                with archive.open(member) as fin, \
+                        open(outFileName, 'wb') as fout:
+                    shutil.copyfileobj(fin, fout)
+                extracted.append(outFileName)
+        return extracted
+
+
+def _fsync(path):
+    """ Flush a file (or the entries of a folder) to disk. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _getCacheSize():
+    return float(Plugin.getVar(PHENIX_CACHE_SIZE, 0) or 0) * 1024 ** 3
+
+
+def getMapStore():
+    """ Return the converted map store of the current project,
+    or None if the cache has been disabled. """
+    maxSize = _getCacheSize()
+    if maxSize <= 0:
+        return None
+    return MapStore(os.path.join(os.path.abspath(PHENIX_CACHE_DIR),
+                                 PHENIX_MAPS_DIR), maxSize)
+
+
+def getProjectCache():
+    """ Return the cache of the current project (protocols and viewers
+    run with the project folder as working directory), or None if it
+    has been disabled setting PHENIX_CACHE_SIZE to 0. """
+    maxSize = _getCacheSize()
+    if maxSize <= 0:
+        return None
+    return ProgramCache(os.path.join(os.path.abspath(PHENIX_CACHE_DIR),
+                                     PHENIX_RESULTS_DIR), maxSize)
+
+
+def _moveContent(srcDir, dstDir):
+    for name in os.listdir(srcDir):
+        dst = os.path.join(dstDir, name)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.replace(os.path.join(srcDir, name), dst)
+
+
+def cachedRetry(runEnvirom, program, args, cwd, listAtomStruct=[], log=None,
+                **kwargs):
+    """ Same as pwem retry, but the outputs are taken from the project
+    cache when the program already ran with identical inputs.
+    On a miss the program runs in a private folder inside cwd, so that
+    only its own outputs are stored even if other programs are writing
+    in cwd at the same time, and the outputs are then moved to cwd. """
+    cache = getProjectCache()
+    if cache is None:
+        return retry(runEnvirom, program, args, cwd, listAtomStruct,
+                     log=log, **kwargs)
+    cwd = os.path.abspath(cwd)
+    key, runArgs = cache.getKey(program, args, cwd,
+                                Plugin.getPhenixVersion(), listAtomStruct)
+    if cache.restore(key, cwd):
+        if log is not None:
+            log.info("%s: outputs restored from the PHENIX cache (%s)"
+                     % (os.path.basename(program), key))
+        return
+
+    # remember whether the last launch succeeded: retry does not always
+    # raise when every attempt failed and failures must not be cached
+    status = {'ok': False}
+
+    def run(program, args, cwd=None):
+        status['ok'] = False
+        runEnvirom(program, args, cwd=cwd)
+        status['ok'] = True
+
+    runDir = tempfile.mkdtemp(prefix='.phenix_run_', dir=cwd)
+    try:
+        retry(run, program, runArgs, runDir, listAtomStruct, log=log, **kwargs)
+        if status['ok']:
+            cache.store(key, runDir,
+                        '%s %s' % (os.path.basename(program), args))
+    finally:
+        _moveContent(runDir, cwd)
+        shutil.rmtree(runDir, ignore_errors=True)
@@ -42,6 +42,8 @@ PHENIX_GETVERSION_PATH = 'build/bin'
 # list of phenix scripts and corresponding binary directory
 SUPERPOSE = 'superpose_pdbs.py'
 REALSPACEREFINE = 'real_space_refine.py'
+# module of the real_space_refine program, run inside a phenix.python worker
+REALSPACEREFINE_MODULE = 'phenix.programs.real_space_refine'
 MOLPROBITY = 'molprobity.py'
 MOLPROBITY2 = 'molprobity.py'
 VALIDATION_CRYOEM = 'validation_cryoem.py'
@@ -68,4 +70,16 @@ mapBinarytoDirectory ={
     REBUILDDOCKPREDICTEDMODEL: PHENIX_SCRIPT_PATH2,
     DOCKANDREBUILD: PHENIX_SCRIPT_PATH2
 }
-DISPLAY='display'
\ No newline at end of file
+DISPLAY='display'
+
+# file (in SCIPION_USER_DATA) caching the installed phenix version
+PHENIX_VERSION_CACHE = 'phenix_version.json'
+
+# project level cache of phenix results (see phenix/cache.py)
+PHENIX_CACHE_DIR = 'phenixCache'
+PHENIX_CACHE_SIZE = 'PHENIX_CACHE_SIZE'  # GB, 0 disables the cache
+PHENIX_MAPS_DIR = 'maps'  # converted maps shared by the protocols
+PHENIX_RESULTS_DIR = 'results'  # outputs of phenix programs
+
+# margin (A) around the model when a map is cropped to it
+CROP_PADDING = 10.0
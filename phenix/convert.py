@@ -0,0 +1,441 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Conversion of Scipion objects to the files used by PHENIX,
+and of PHENIX outputs to values Scipion can store.
+"""
+
+import collections
+import mmap
+import os
+import re
+import struct
+
+import numpy as np
+from pwem.convert.atom_struct import AtomicStructHandler
+from pwem.convert.headers import Ccp4Header
+
+from phenix.cache import getMapStore, reflinkFile
+
+MRC_HEADER_SIZE = 1024
+MRC_MODE_FLOAT = 2
+# first 24 words of the header: NC, NR, NS, MODE, NCSTART, NRSTART, NSSTART,
+# NX, NY, NZ, cell lengths, cell angles, MAPC, MAPR, MAPS, AMIN, AMAX, AMEAN,
+# ISPG and NSYMBT
+MRC_HEADER_FORMAT = '<3i i 3i 3i 3f 3f 3i 3f i i'
+SPARSE_BLOCK_SIZE = 1 << 20
+# do not crop if the box keeps more than this fraction of the voxels
+CROP_MAX_FRACTION = 0.8
+LOG_BLOCK_SIZE = 1 << 16
+BACKBONE_ATOMS = ('N', 'CA', 'C', 'O', 'OXT')
+# pdb_interpretation.clash_guard of PHENIX: refinement stops if too many
+# interatomic distances are shorter than CLASH_DISTANCE (Angstrom). The
+# clash guard is disabled beforehand if there are more than
+# CLASH_GUARD_MAX_PER_1000_ATOMS such distances per 1000 atoms
+CLASH_DISTANCE = 0.5
+CLASH_GUARD_MAX_PER_1000_ATOMS = 10.0
+
+_NUMBER = r'(-?\d+\.\d+)'
+# metrics of the final statistics of a real_space_refine log:
+# name -> pattern whose last match in the log gives its value
+RSR_LOG_METRICS = collections.OrderedDict([
+    # also matches the closing 'model-to-map fit, CC_mask: ...'
+    ('cc_mask', re.compile(r'CC_mask\s*:\s*' + _NUMBER)),
+    ('cc_volume', re.compile(r'CC_volume\s*:\s*' + _NUMBER)),
+    ('cc_peaks', re.compile(r'CC_peaks\s*:\s*' + _NUMBER)),
+    ('bond_rmsd', re.compile(r'^\s*Bond\s*:\s*' + _NUMBER)),
+    ('angle_rmsd', re.compile(r'^\s*Angle\s*:\s*' + _NUMBER)),
+    ('clashscore', re.compile(r'Clashscore\s*:\s*' + _NUMBER)),
+    # Ramachandran plot, percentages
+    ('rama_outliers', re.compile(r'^\s*Outliers\s*:\s*' + _NUMBER + r'\s*%')),
+    ('rama_allowed', re.compile(r'^\s*Allowed\s*:\s*' + _NUMBER + r'\s*%')),
+    ('rama_favored', re.compile(r'^\s*Favored\s*:\s*' + _NUMBER + r'\s*%')),
+])
+
+
+def _readMrcHeader(mm):
+    """ Return the first header words of a little endian MRC map,
+    or None if the file does not look like one. """
+    if len(mm) < MRC_HEADER_SIZE or mm[208:212] != b'MAP ' \
+            or mm[212:213] not in (b'\x44', b'\x41'):  # little endian stamp
+        return None
+    return struct.unpack_from(MRC_HEADER_FORMAT, mm)
+
+
+def _readVolumeHeader(fileName):
+    """ Return the first header words of fileName if it is a single
+    float32 volume stored in column/row/section order, otherwise None. """
+    with open(fileName, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MRC_HEADER_SIZE:
+            return None
+        mm = mmap.mmap(f.fileno(), MRC_HEADER_SIZE, access=mmap.ACCESS_READ)
+        try:
+            words = _readMrcHeader(mm)
+        finally:
+            mm.close()
+    if words is None:
+        return None
+    nc, nr, ns, mode = words[:4]
+    mapAxes = words[16:19]
+    nsymbt = words[23]
+    if (mode == MRC_MODE_FLOAT and tuple(mapAxes) == (1, 2, 3)
+            and nsymbt >= 0 and min(nc, nr, ns) > 0
+            and size == MRC_HEADER_SIZE + nsymbt + nc * nr * ns * 4):
+        return words
+    return None
+
+
+def _isHeaderFixable(fileName):
+    """ True if PHENIX only needs a new header for fileName. """
+    if os.path.splitext(fileName)[1].lower() not in ('.mrc', '.map', '.ccp4'):
+        return False
+    return _readVolumeHeader(fileName) is not None
+
+
+def _sparseCopy(inFileName, outFileName, blockSize=SPARSE_BLOCK_SIZE):
+    """ Copy a file through a memory map of the source, leaving holes in
+    place of the blocks that only contain zeros (e.g. masked maps). """
+    zeros = bytes(blockSize)
+    with open(inFileName, 'rb') as fin, open(outFileName, 'wb') as fout:
+        size = os.fstat(fin.fileno()).st_size
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # the header is always written, the data may be sparse
+            fout.write(mm[:MRC_HEADER_SIZE])
+            for start in range(MRC_HEADER_SIZE, size, blockSize):
+                block = mm[start:start + blockSize]
+                if block == zeros[:len(block)]:
+                    fout.seek(len(block), os.SEEK_CUR)
+                else:
+                    fout.write(block)
+            fout.truncate(size)
+        finally:
+            mm.close()
+
+
+def fixMapHeader(inFileName, outFileName, origin, sampling):
+    """ Write outFileName as fixMapFile does but, instead of converting
+    the whole volume, clone the data (reflink where the filesystem allows
+    it, sparse copy otherwise) and rewrite the header only.
+    Returns False, writing nothing, if the map needs a real conversion. """
+    inFileName = re.sub(':mrcs?$', '', inFileName)
+    if not _isHeaderFixable(inFileName):
+        return False
+    if not reflinkFile(inFileName, outFileName):
+        _sparseCopy(inFileName, outFileName)
+
+    ccp4header = Ccp4Header(outFileName, readHeader=True)
+    x, y, z = ccp4header.getDims()
+    ccp4header.setGridSampling(x, y, z)
+    ccp4header.setCellDimensions(x * sampling, y * sampling, z * sampling)
+    # the position only in the start fields, as fixMapFile writes it
+    ccp4header.setOrigin((0., 0., 0.))
+    ccp4header.setStartAngstrom(origin, sampling)
+    if not ccp4header.getISPG():
+        ccp4header.setISPG(1)  # a single volume, not an image stack
+    ccp4header.writeHeader()
+    return True
+
+
+def fixMapFile(inFileName, outFileName, origin, sampling):
+    """ Write a MRC copy of inFileName with the origin and sampling
+    that PHENIX needs in its header. """
+    if fixMapHeader(inFileName, outFileName, origin, sampling):
+        return
+    Ccp4Header.fixFile(inFileName, outFileName, origin, sampling,
+                       Ccp4Header.START)  # ORIGIN
+
+
+def convertVolume(vol, outFileName):
+    """ Convert a Scipion volume to the MRC map used by PHENIX.
+    The converted map is shared with the other protocols of the project:
+    outFileName becomes a link to the stored map, which is only written
+    the first time a given volume, origin and sampling are converted. """
+    convertMapFile(vol.getFileName(), outFileName,
+                   vol.getOrigin(force=True).getShifts(),
+                   vol.getSamplingRate())
+
+
+def convertMapFile(inVolName, outFileName, origin, sampling):
+    """ convertVolume of a map file given its origin (shifts, Angstrom)
+    and sampling rate, e.g. resolved before running parallel steps """
+    store = getMapStore()
+    if store is None:
+        fixMapFile(inVolName, outFileName, origin, sampling)
+    else:
+        store.getMap(inVolName, outFileName, origin, sampling, fixMapFile)
+
+
+def getModelBounds(atomStructFileName):
+    """ Return the minimum and maximum coordinates (Angstrom) of the atoms
+    in the first model of an atomic structure. """
+    structure = AtomicStructHandler(atomStructFileName).getStructure()
+    coords = np.array([atom.get_coord() for atom in structure[0].get_atoms()])
+    return coords.min(axis=0), coords.max(axis=0)
+
+
+def findCloseContacts(coords, cutoff):
+    """ Pairs of points closer than cutoff, using a cell list of cutoff
+    sized cells: every point is only compared with the points of its own
+    cell and of the 13 neighbour cells that come after it.
+    Returns the arrays i, j (i < j) and their distances. """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    empty = np.zeros(0, dtype=int)
+    if len(coords) < 2:
+        return empty, empty, np.zeros(0)
+    cells = np.floor((coords - coords.min(axis=0)) / cutoff).astype(np.int64)
+    dims = cells.max(axis=0) + 3  # room for the neighbours of the border
+    cells += 1
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                if (dx, dy, dz) < (0, 0, 0):
+                    continue  # the other half of the neighbours
+                shift = (dx * dims[1] + dy) * dims[2] + dz
+                lo = np.searchsorted(sortedKeys, keys + shift, 'left')
+                hi = np.searchsorted(sortedKeys, keys + shift, 'right')
+                counts = hi - lo
+                i = np.repeat(np.arange(len(coords)), counts)
+                # position of every candidate in its cell
+                within = np.arange(len(i)) - np.repeat(np.cumsum(counts) -
+                                                       counts, counts)
+                j = order[np.repeat(lo, counts) + within]
+                if shift == 0:
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                pairs.append((i, j))
+    i = np.concatenate([p[0] for p in pairs])
+    j = np.concatenate([p[1] for p in pairs])
+    distances = np.sqrt(((coords[i] - coords[j]) ** 2).sum(axis=1))
+    close = distances < cutoff
+    i, j, distances = i[close], j[close], distances[close]
+    swap = i > j
+    i[swap], j[swap] = j[swap], i[swap]
+    return i, j, distances
+
+
+def _getAtomLabel(atom):
+    residue = atom.get_parent()
+    _, number, insertion = residue.get_id()
+    return '%s/%s %d%s/%s' % (residue.get_parent().get_id(),
+                              residue.get_resname(), number,
+                              insertion.strip(), atom.get_id())
+
+
+def findClashes(atomStructFileName, cutoff=CLASH_DISTANCE):
+    """ Atoms of the first model of an atomic structure closer than cutoff
+    (the non-bonded distances counted by the PHENIX clash guard, as no
+    bond is that short). Only the selected conformation of atoms with
+    alternative locations is used. Returns a list of (label, label,
+    distance) sorted by distance and the number of atoms of the model. """
+    structure = AtomicStructHandler(atomStructFileName).getStructure()
+    atoms = list(structure[0].get_atoms())
+    i, j, distances = findCloseContacts(
+        [atom.get_coord() for atom in atoms], cutoff)
+    return ([(_getAtomLabel(atoms[a]), _getAtomLabel(atoms[b]), float(d))
+             for d, a, b in sorted(zip(distances, i, j))], len(atoms))
+
+
+def _readMapGrid(mapFileName):
+    """ Return the header words of a map (as _readVolumeHeader) and the
+    position of its first voxel in voxels, which is where START and
+    ORIGIN (Angstrom) place it. The voxel of a point is then
+    coords / voxelSize - position. Returns None, None if the map cannot
+    be read. """
+    words = _readVolumeHeader(mapFileName)
+    if words is None:
+        return None, None
+    start = np.array(words[4:7])
+    voxelSize = np.array(words[10:13]) / np.array(words[7:10])
+    with open(mapFileName, 'rb') as f:
+        origin = np.array(struct.unpack_from('<3f', f.read(MRC_HEADER_SIZE),
+                                             196))
+    return words, start + origin / voxelSize
+
+
+def cropMapToModel(mapFileName, atomStructFileName, padding):
+    """ Replace the map written by convertVolume with the sub-box that
+    contains the model plus padding Angstroms on every side. The unit cell
+    and the ORIGIN are kept and the position of the box goes to the start
+    fields of the header, so the model coordinates still match the map.
+    The file is replaced, never modified, since it may be a link to the map
+    store. Returns False, leaving the map as it is, if it cannot be cropped
+    or the box would not be significantly smaller. """
+    words, position = _readMapGrid(mapFileName)
+    if words is None:
+        return False
+    dims = np.array(words[0:3])  # NC, NR, NS
+    start = np.array(words[4:7])
+    voxelSize = np.array(words[10:13]) / np.array(words[7:10])
+    nsymbt = words[23]
+
+    lower, upper = getModelBounds(atomStructFileName)
+    first = np.floor((lower - padding) / voxelSize - position).astype(int)
+    last = np.ceil((upper + padding) / voxelSize - position).astype(int) + 1
+    first = np.clip(first, 0, dims)
+    last = np.clip(last, 0, dims)
+    boxDims = last - first
+    if np.any(boxDims <= 0) or \
+            np.prod(boxDims) > CROP_MAX_FRACTION * np.prod(dims):
+        return False
+
+    with open(mapFileName, 'rb') as f:
+        header = bytearray(f.read(MRC_HEADER_SIZE))
+    data = np.memmap(mapFileName, dtype='<f4', mode='r',
+                     offset=MRC_HEADER_SIZE + nsymbt, shape=tuple(dims[::-1]))
+    box = np.ascontiguousarray(data[first[2]:last[2], first[1]:last[1],
+                                    first[0]:last[0]])
+    del data
+
+    struct.pack_into('<3i', header, 0, *boxDims)
+    struct.pack_into('<3i', header, 16, *(start + first))
+    struct.pack_into('<3f', header, 76, box.min(), box.max(), box.mean())
+    struct.pack_into('<i', header, 92, 0)  # the extended header is dropped
+    struct.pack_into('<f', header, 216, box.std())  # RMS
+
+    tmpFn = '%s.%d.crop' % (mapFileName, os.getpid())
+    try:
+        with open(tmpFn, 'wb') as f:
+            f.write(header)
+            f.write(box.astype('<f4').tobytes())
+        os.replace(tmpFn, mapFileName)
+    finally:
+        if os.path.exists(tmpFn):
+            os.remove(tmpFn)
+    return True
+
+
+def _readSideChainAtoms(fileName):
+    """ Coordinates of the heavy side chain atoms (CB included) of a PDB
+    file. """
+    coords = []
+    with open(fileName) as f:
+        for line in f:
+            if not line.startswith(('ATOM  ', 'HETATM')):
+                continue
+            name = line[12:16].strip()
+            element = line[76:78].strip() or name[:1]
+            if name in BACKBONE_ATOMS or element in ('H', 'D'):
+                continue
+            coords.append((float(line[30:38]), float(line[38:46]),
+                           float(line[46:54])))
+    return coords
+
+
+def _interpolate(data, points):
+    """ Trilinear interpolation of data (sections, rows, columns) at
+    points given as (column, row, section) pixel coordinates. Points
+    outside the map get nan. """
+    shape = np.array(data.shape[::-1])
+    inside = np.all((points >= 0) & (points <= shape - 1), axis=1)
+    p = points[inside]
+    corner = np.minimum(np.floor(p).astype(int), np.maximum(shape - 2, 0))
+    frac = p - corner
+    values = np.zeros(len(p))
+    for dx in (0, 1):
+        for dy in (0, 1):
+            for dz in (0, 1):
+                weight = (np.where(dx, frac[:, 0], 1 - frac[:, 0]) *
+                          np.where(dy, frac[:, 1], 1 - frac[:, 1]) *
+                          np.where(dz, frac[:, 2], 1 - frac[:, 2]))
+                index = np.minimum(corner + (dx, dy, dz), shape - 1)
+                values += weight * data[index[:, 2], index[:, 1], index[:, 0]]
+    result = np.full(len(points), np.nan)
+    result[inside] = values
+    return result
+
+
+def scoreWindows(mapFileName, atomStructFileNames):
+    """ Fast map-model agreement of models that only differ in their
+    side chains (e.g. the windows of search fit): the mean density, in
+    standard deviations of the map, interpolated at the side chain atoms
+    of every model. Atoms of every model are interpolated at once.
+    Returns an array with a score per model (nan if it has no side chain
+    atoms), or None if the map cannot be read. """
+    words, position = _readMapGrid(mapFileName)
+    if words is None:
+        return None
+    dims = np.array(words[0:3])
+    voxelSize = np.array(words[10:13]) / np.array(words[7:10])
+    nsymbt = words[23]
+    data = np.memmap(mapFileName, dtype='<f4', mode='r',
+                     offset=MRC_HEADER_SIZE + nsymbt, shape=tuple(dims[::-1]))
+    mean, std = float(data.mean()), float(data.std()) or 1.
+
+    coords, models = [], []
+    for i, fileName in enumerate(atomStructFileNames):
+        atoms = _readSideChainAtoms(fileName)
+        coords += atoms
+        models += [i] * len(atoms)
+    n = len(atomStructFileNames)
+    if not coords:
+        return np.full(n, np.nan)
+    points = np.array(coords) / voxelSize - position
+    density = _interpolate(data, points)
+    density[np.isnan(density)] = mean  # atoms out of the map
+    density = (density - mean) / std
+    counts = np.bincount(models, minlength=n)
+    sums = np.bincount(models, weights=density, minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _readLinesBackwards(fileName, blockSize=LOG_BLOCK_SIZE):
+    """ Yield the lines of a text file from the last one to the first,
+    reading it by blocks from its end. """
+    with open(fileName, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        rest = b''
+        while position > 0:
+            size = min(blockSize, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + rest).split(b'\n')
+            rest = lines.pop(0)  # may be incomplete
+            for line in reversed(lines):
+                yield line.decode('utf-8', 'replace')
+        yield rest.decode('utf-8', 'replace')
+
+
+def parseRSRefineLog(logFileName, metrics=RSR_LOG_METRICS):
+    """ Return {name: float} with the last value of every metric found
+    in a real_space_refine log. The log is read from its end and only
+    until every metric has been found, which for a finished run means
+    only the final statistics. """
+    values = {}
+    for line in _readLinesBackwards(logFileName):
+        for name, pattern in metrics.items():
+            if name not in values:
+                match = pattern.search(line)
+                if match:
+                    values[name] = float(match.group(1))
+        if len(values) == len(metrics):
+            break
+    return values
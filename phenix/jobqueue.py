@@ -0,0 +1,442 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+"""
+Crash safe job queue stored in a SQLite table.
+
+Several workers (threads or processes) claim jobs from the same table.
+A claimed job gets a lease (owner and expiration time) that the worker
+renews while it is running the job; jobs whose lease expired, or whose
+owner process is gone, go back to the queue, so a killed worker or a
+restarted protocol does not lose any job, and a job is only completed
+once.
+
+The database uses WAL journaling so that readers (e.g. viewers) never
+block the workers, and claims are a single UPDATE ... RETURNING statement
+(or an immediate transaction on SQLite < 3.35).
+
+A JobWatchdog kills the processes of a job that goes over its wall time
+or memory budget, so that the job can be marked as failed (or queued
+again with other settings) instead of keeping its worker busy.
+"""
+
+import contextlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import psutil
+
+# job states (column done)
+PENDING = 0
+RUNNING = 1
+FINISHED = 2
+FAILED = 3  # e.g. killed by its watchdog, see column reason
+
+LEASE_TIME = 600  # seconds a claim is valid unless renewed
+MAX_ATTEMPTS = 3  # claims of a job before it is marked as failed
+DB_TIMEOUT = 60  # seconds to wait for the database lock
+WATCHDOG_INTERVAL = 5  # seconds between checks of the job limits
+CHECK_INTERVAL = 10  # seconds between searches of orphan and exhausted jobs
+
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+HOSTNAME = socket.gethostname()
+
+
+def getOwner():
+    """ Lease owner of the calling thread: host, process and thread. """
+    return '%s:%d:%d' % (HOSTNAME, os.getpid(), threading.get_ident())
+
+
+def _isOwnerAlive(owner):
+    """ False only if owner is a process of this host that is gone. """
+    try:
+        host, pid, _ = owner.rsplit(':', 2)
+        if host != HOSTNAME:
+            return True
+        os.kill(int(pid), 0)
+    except (ValueError, AttributeError):
+        return False  # rows claimed without lease
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # e.g. the process exists but belongs to another user
+    return True
+
+
+class JobQueue(object):
+    """ Queue of jobs stored in table of the SQLite database dbFileName.
+    Every job has an id, a filename and a state (column done), plus the
+    lease columns and any extra column given as {name: sql definition}.
+    Extra columns listed in indexes are indexed. Jobs are claimed in
+    the given order (an SQL ORDER BY expression). Orphan and exhausted
+    jobs are searched for at most every checkInterval seconds. """
+    def __init__(self, dbFileName, table, extraColumns=None, indexes=(),
+                 leaseTime=LEASE_TIME, maxAttempts=MAX_ATTEMPTS, order='id',
+                 checkInterval=CHECK_INTERVAL):
+        self.dbFileName = os.path.abspath(dbFileName)
+        self.table = table
+        self.extraColumns = extraColumns or {}
+        self.indexes = indexes
+        self.leaseTime = leaseTime
+        self.maxAttempts = maxAttempts
+        self.order = order
+        self.checkInterval = checkInterval
+        self._nextCheck = 0
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """ Autocommit connection, transactions are explicit. """
+        conn = sqlite3.connect(self.dbFileName, timeout=DB_TIMEOUT,
+                               isolation_level=None)
+        try:
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, finishedCondition=None):
+        """ Create the table if needed, and add the lease columns to
+        tables created by older versions. In those tables done=1 meant
+        claimed: rows matching the SQL finishedCondition are marked as
+        finished and the others go back to the queue. """
+        columns = [('filename', 'TEXT'),
+                   ('done', 'int DEFAULT %d' % PENDING)]
+        columns += list(self.extraColumns.items())
+        columns += [('lease_owner', "TEXT DEFAULT ''"),
+                    ('lease_expires', 'float DEFAULT 0'),
+                    ('attempts', 'int DEFAULT 0'),
+                    ('reason', "TEXT DEFAULT ''")]
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # persistent
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("CREATE TABLE IF NOT EXISTS %s ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, %s)"
+                         % (self.table, ', '.join('%s %s' % c
+                                                  for c in columns)))
+            existing = [row[1] for row in
+                        conn.execute("PRAGMA table_info(%s)" % self.table)]
+            for name, definition in columns:
+                if name not in existing:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s"
+                                 % (self.table, name, definition))
+            if 'lease_owner' not in existing:
+                if finishedCondition:
+                    conn.execute("UPDATE %s SET done=? WHERE done=? AND %s"
+                                 % (self.table, finishedCondition),
+                                 (FINISHED, RUNNING))
+                conn.execute("UPDATE %s SET done=? WHERE done=?"
+                             % self.table, (PENDING, RUNNING))
+            for name in ('done',) + tuple(self.indexes):
+                conn.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s(%s)"
+                             % (self.table, name, self.table, name))
+            # searches of expired leases and exhausted jobs
+            for name in ('lease_expires', 'attempts'):
+                conn.execute("CREATE INDEX IF NOT EXISTS %s_done_%s "
+                             "ON %s(done, %s)"
+                             % (self.table, name, self.table, name))
+            conn.execute("COMMIT")
+
+    def add(self, fileNames):
+        """ Queue a job per file name. """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO %s(filename) VALUES(?)"
+                             % self.table, [(fn,) for fn in fileNames])
+            conn.execute("COMMIT")
+
+    def claim(self, n=1, columns=()):
+        """ Atomically take up to n jobs (pending or with an expired lease)
+        and return them as a list of (id, filename) tuples, followed by
+        the values of the requested extra columns. """
+        now = time.time()
+        owner = getOwner()
+        if now >= self._nextCheck:
+            self.requeueOrphans()
+            self.failExhausted()
+            self._nextCheck = now + self.checkInterval
+        select = ("SELECT id FROM %s WHERE attempts < ? AND "
+                  "(done=? OR (done=? AND lease_expires < ?)) "
+                  "ORDER BY %s LIMIT ?" % (self.table, self.order))
+        selectParams = (self.maxAttempts, PENDING, RUNNING, now, n)
+        update = ("UPDATE %s SET done=?, lease_owner=?, lease_expires=?, "
+                  "attempts=attempts+1 WHERE id IN (%s)" % (self.table,
+                                                           select))
+        updateParams = (RUNNING, owner, now + self.leaseTime) + selectParams
+        returned = ', '.join(('id', 'filename') + tuple(columns))
+        with self._connect() as conn:
+            if HAS_RETURNING:
+                rows = conn.execute(update + " RETURNING " + returned,
+                                    updateParams).fetchall()
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+                ids = [row[0] for row in conn.execute(select, selectParams)]
+                conn.execute(update, updateParams)
+                rows = conn.execute(
+                    "SELECT %s FROM %s WHERE id IN (%s)"
+                    % (returned, self.table, ','.join('?' * len(ids))),
+                    ids).fetchall() \
+                    if ids else []
+                conn.execute("COMMIT")
+        return sorted(rows)
+
+    def renew(self, jobIds, owner=None):
+        """ Extend the lease of jobs claimed by owner (by default, the
+        calling thread). """
+        if not jobIds:
+            return
+        with self._connect() as conn:
+            conn.execute("UPDATE %s SET lease_expires=? WHERE done=? AND "
+                         "lease_owner=? AND id IN (%s)"
+                         % (self.table, ','.join('?' * len(jobIds))),
+                         (time.time() + self.leaseTime, RUNNING,
+                          owner or getOwner()) + tuple(jobIds))
+
+    def heartbeat(self, jobIds):
+        """ Context manager that renews the lease of jobIds while the
+        jobs are running. """
+        return _Heartbeat(self, getOwner(), jobIds)
+
+    def complete(self, jobId, onComplete=None, **values):
+        """ Mark a job as finished storing values in the extra columns.
+        onComplete(connection), if given, runs in the same transaction to
+        record anything else about the job.
+        Returns False if it had already been completed (e.g. by a worker
+        that took it after our lease expired). """
+        names = sorted(values)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "UPDATE %s SET done=?, lease_owner='', lease_expires=0%s "
+                "WHERE id=? AND done!=?"
+                % (self.table, ''.join(', %s=?' % n for n in names)),
+                (FINISHED,) + tuple(values[n] for n in names) +
+                (jobId, FINISHED))
+            completed = cursor.rowcount == 1
+            if completed and onComplete is not None:
+                onComplete(conn)
+            conn.execute("COMMIT")
+        return completed
+
+    def requeue(self, condition, params=(), **values):
+        """ Put back in the queue the jobs matching the SQL condition
+        (e.g. to process them again with other settings), setting the
+        given values in the extra columns. Returns the number of jobs. """
+        names = sorted(values)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE %s SET done=?, lease_owner='', lease_expires=0, "
+                "attempts=0%s WHERE %s"
+                % (self.table, ''.join(', %s=?' % n for n in names),
+                   condition),
+                (PENDING,) + tuple(values[n] for n in names) + tuple(params))
+            return cursor.rowcount
+
+    def fail(self, jobId, reason, **values):
+        """ Mark a claimed job as failed, e.g. because it went over its
+        limits, so that it is not claimed again. Returns False if the job
+        had been completed in the meantime. """
+        names = sorted(values)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE %s SET done=?, lease_owner='', lease_expires=0, "
+                "reason=?%s WHERE id=? AND done!=?"
+                % (self.table, ''.join(', %s=?' % n for n in names)),
+                (FAILED, reason) + tuple(values[n] for n in names) +
+                (jobId, FINISHED))
+            return cursor.rowcount == 1
+
+    def release(self, jobId):
+        """ Give back a claimed job, e.g. because its run failed. """
+        with self._connect() as conn:
+            conn.execute("UPDATE %s SET done=?, lease_owner='', "
+                         "lease_expires=0 WHERE id=? AND done=?"
+                         % self.table, (PENDING, jobId, RUNNING))
+
+    def requeueOrphans(self):
+        """ Put back in the queue the running jobs whose owner process
+        does not exist any more (e.g. the protocol was killed). """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, lease_owner FROM %s WHERE done=?"
+                                % self.table, (RUNNING,)).fetchall()
+            orphans = [jobId for jobId, owner in rows
+                       if not _isOwnerAlive(owner)]
+            if orphans:
+                conn.execute("UPDATE %s SET done=?, lease_owner='', "
+                             "lease_expires=0 WHERE done=? AND id IN (%s)"
+                             % (self.table, ','.join('?' * len(orphans))),
+                             (PENDING, RUNNING) + tuple(orphans))
+
+    def failExhausted(self):
+        """ Mark as failed the jobs that are waiting to be claimed (pending
+        or with an expired lease) but have used all their attempts, so
+        that they are reported instead of staying in the queue forever.
+        Returns the number of jobs. """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE %s SET done=?, lease_owner='', lease_expires=0, "
+                "reason=? WHERE attempts >= ? AND "
+                "(done=? OR (done=? AND lease_expires < ?))" % self.table,
+                (FAILED, 'not finished after %d attempts' % self.maxAttempts,
+                 self.maxAttempts, PENDING, RUNNING, time.time()))
+            return cursor.rowcount
+
+    def requeueInterrupted(self):
+        """ Put back in the queue every running job that is not owned by
+        this process. Only for queues with a single owner process (e.g. a
+        protocol resumed after being stopped or after a reboot, when the
+        pid of a dead owner may have been reused). The interruption does
+        not count as an attempt. Returns the number of jobs. """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE %s SET done=?, lease_owner='', lease_expires=0, "
+                "attempts=MAX(attempts - 1, 0) "
+                "WHERE done=? AND lease_owner NOT LIKE ?" % self.table,
+                (PENDING, RUNNING, '%s:%d:%%' % (HOSTNAME, os.getpid())))
+            return cursor.rowcount
+
+    def countPending(self):
+        """ Number of jobs that have not been finished (nor failed) yet. """
+        self.failExhausted()
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM %s WHERE done IN (?, ?)"
+                                % self.table,
+                                (PENDING, RUNNING)).fetchone()[0]
+
+
+class _Heartbeat(object):
+    """ Renew the lease of some jobs from a background thread. """
+    def __init__(self, queue, owner, jobIds):
+        self.queue = queue
+        self.owner = owner
+        self.jobIds = list(jobIds)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.leaseTime / 3.):
+            try:
+                self.queue.renew(self.jobIds, self.owner)
+            except sqlite3.Error as e:
+                print("Cannot renew the lease of jobs %s: %s"
+                      % (self.jobIds, e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+class JobLimitExceeded(Exception):
+    """ The job was killed by its watchdog. """
+    pass
+
+
+def findChildren(token):
+    """ Processes started by this one (at any depth) whose command line
+    contains token, e.g. the name of the input file of a job. """
+    found = []
+    for proc in psutil.Process().children(recursive=True):
+        try:
+            if any(token in arg for arg in proc.cmdline()):
+                found.append(proc)
+        except psutil.Error:
+            pass  # already finished
+    return found
+
+
+class JobWatchdog(object):
+    """ Context manager that kills the processes of a job when it runs
+    for more than maxTime seconds or they use more than maxMemory bytes
+    of resident memory (0 means no limit). getProcesses() returns the
+    psutil processes of the job, their children are included.
+    Once a limit is exceeded, reason says which one and every process of
+    the job is killed until the context is left. """
+    def __init__(self, getProcesses, maxTime=0, maxMemory=0,
+                 interval=WATCHDOG_INTERVAL):
+        self.getProcesses = getProcesses
+        self.maxTime = maxTime
+        self.maxMemory = maxMemory
+        self.interval = interval
+        self.reason = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _getTree(self):
+        tree = {}
+        try:
+            roots = self.getProcesses()
+        except psutil.Error:
+            roots = []
+        for proc in roots:
+            try:
+                for p in [proc] + proc.children(recursive=True):
+                    tree[p.pid] = p
+            except psutil.Error:
+                pass
+        return list(tree.values())
+
+    def _check(self, processes, elapsed):
+        if self.maxTime and elapsed > self.maxTime:
+            return 'wall time over %d s' % self.maxTime
+        if self.maxMemory:
+            rss = 0
+            for proc in processes:
+                try:
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    pass
+            if rss > self.maxMemory:
+                return ('resident memory %d MB over %d MB'
+                        % (rss // 2 ** 20, self.maxMemory // 2 ** 20))
+        return None
+
+    def _run(self):
+        start = time.time()
+        while not self._stop.wait(self.interval):
+            processes = self._getTree()
+            if self.reason is None:
+                self.reason = self._check(processes, time.time() - start)
+                if self.reason is not None:
+                    print("Killing job: %s" % self.reason)
+            if self.reason is not None:
+                for proc in processes:
+                    try:
+                        proc.kill()
+                    except psutil.Error:
+                        pass
+
+    def __enter__(self):
+        if self.maxTime or self.maxMemory:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
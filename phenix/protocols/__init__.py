@@ -27,6 +27,9 @@
 from .protocol_emringer import PhenixProtRunEMRinger
 from .protocol_molprobity import PhenixProtRunMolprobity
 from .protocol_real_space_refine import PhenixProtRunRSRefine
+from .protocol_real_space_refine_batch import PhenixProtRunRSRefineBatch
+from .protocol_real_space_refine_maps import PhenixProtRunRSRefineMaps
+from .protocol_real_space_refine_sweep import PhenixProtRunRSRefineSweep
 from .protocol_refinement_base import PhenixProtRunRefinementBase
 from .protocol_superpose_pdbs import PhenixProtRunSuperposePDBs
 from .protocol_validation_cryoem import PhenixProtRunValidationCryoEM
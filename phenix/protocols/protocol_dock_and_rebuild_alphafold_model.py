@@ -27,7 +27,6 @@ import os
 
 from pyworkflow import Config
 from pyworkflow import utils as pwutils
-from pwem.convert import Ccp4Header
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pyworkflow.protocol.params import (PointerParam, BooleanParam, EnumParam,
@@ -41,6 +40,7 @@ try:
 except:
     from pwem.objects import PdbFile as AtomStruct
 from phenix import Plugin
+from phenix.convert import convertVolume
 
 
 class PhenixProtDockAndRebuildAlphaFold2Model(EMProtocol):
@@ -92,12 +92,9 @@ class PhenixProtDockAndRebuildAlphaFold2Model(EMProtocol):
 
     def runDockAndBuildModel(self):
         vol = self._getInputVolume()
-        inVolName = vol.getFileName()
         mapFile = self.DOCKINMAPFILE
         localVolName = os.path.abspath(self._getExtraPath(mapFile))
-        origin = vol.getOrigin(force=True).getShifts()
-        sampling = vol.getSamplingRate()
-        Ccp4Header.fixFile(inVolName, localVolName, origin, sampling, Ccp4Header.START)  # ORIGIN
+        convertVolume(vol, localVolName)
         predictedAtomStruct = os.path.abspath(
             self.inputPredictedModel.get().getFileName())
 
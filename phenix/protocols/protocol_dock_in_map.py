@@ -25,7 +25,6 @@
 
 import os
 
-from pwem.convert import Ccp4Header
 from pwem.convert.atom_struct import retry, fromPDBToCIF, fromCIFTommCIF
 
 from pyworkflow import Config
@@ -39,6 +38,7 @@ try:
 except:
     from pwem.objects import PdbFile as AtomStruct
 from phenix import Plugin
+from phenix.convert import convertVolume
 
 
 class PhenixProtRunDockInMap(EMProtocol):
@@ -85,11 +85,8 @@ class PhenixProtRunDockInMap(EMProtocol):
         """ convert 3D maps to MRC '.mrc' format
         """
         vol = self._getInputVolume()
-        inVolName = vol.getFileName()
         newFn = self._getExtraPath(self.DOCKINMAPFILE)
-        origin = vol.getOrigin(force=True).getShifts()
-        sampling = vol.getSamplingRate()
-        Ccp4Header.fixFile(inVolName, newFn, origin, sampling, Ccp4Header.START)  # ORIGIN
+        convertVolume(vol, newFn)
 
     def runDockInMapStep(self):
         # starting structure
@@ -27,7 +27,6 @@ import os
 
 from pyworkflow import Config
 from pyworkflow import utils as pwutils
-from pwem.convert import Ccp4Header
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pyworkflow.protocol.params import (PointerParam, BooleanParam, EnumParam,
@@ -41,6 +40,7 @@ try:
 except:
     from pwem.objects import PdbFile as AtomStruct
 from phenix import Plugin
+from phenix.convert import convertVolume
 
 
 class PhenixProtDockPredictedAlphaFold2Model(EMProtocol):
@@ -106,11 +106,8 @@ class PhenixProtDockPredictedAlphaFold2Model(EMProtocol):
         """ convert 3D maps to MRC '.mrc' format
         """
         vol = self._getInputVolume()
-        inVolName = vol.getFileName()
         newFn = self._getExtraPath(self.DOCKINMAPFILE)
-        origin = vol.getOrigin(force=True).getShifts()
-        sampling = vol.getSamplingRate()
-        Ccp4Header.fixFile(inVolName, newFn, origin, sampling, Ccp4Header.START)  # ORIGIN
+        convertVolume(vol, newFn)
 
     def runDockPredictedModel(self):
         predictedAtomStruct = os.path.abspath(
@@ -30,14 +30,14 @@ import os
 
 from pyworkflow import Config
 
-from phenix.constants import EMRINGER, DISPLAY
-from pwem.convert.headers import Ccp4Header
+from phenix.constants import CROP_PADDING, EMRINGER, DISPLAY
 from pwem.protocols import EMProtocol
 from pyworkflow.object import String
-from pyworkflow.protocol.params import BooleanParam, PointerParam
+from pyworkflow.protocol.params import BooleanParam, FloatParam, PointerParam
 from phenix import Plugin
+from phenix.convert import convertVolume, cropMapToModel
 from phenix.constants import PHENIX_HOME
-from pwem.convert.atom_struct import retry
+from phenix.cache import cachedRetry
 
 class PhenixProtRunEMRinger(EMProtocol):
     """EMRinger is a Phenix application to validate the agreement between
@@ -68,6 +68,17 @@ the atomic structure backbone has been perfectly fitted to the map.
                       pointerClass="AtomStruct",
                       label='Input atomic structure',
                       help="PDBx/mmCIF to be validated against the volume. ")
+        form.addParam('cropMap', BooleanParam, default=False,
+                      label='Crop the map around the model?',
+                      help="Give EMRinger only the part of the map around "
+                           "the atomic structure (its bounding box plus a "
+                           "padding). PHENIX runtime and memory use grow "
+                           "with the number of voxels.")
+        form.addParam('cropPadding', FloatParam, default=CROP_PADDING,
+                      condition='cropMap',
+                      label='Padding (A)',
+                      help="Margin added around the atomic structure, in "
+                           "Angstrom.")
         form.addParam('doTest', BooleanParam, default=False,
                       label='Test', condition='False',
                       help="""Saves the temporary file 
@@ -87,11 +98,11 @@ the atomic structure backbone has been perfectly fitted to the map.
         """ convert 3D maps to MRC '.mrc' format
         """
         vol = self._getInputVolume()
-        inVolName = vol.getFileName()
         newFn = self._getExtraPath(self.EMRINGERFILE)
-        origin = vol.getOrigin(force=True).getShifts()
-        sampling = vol.getSamplingRate()
-        Ccp4Header.fixFile(inVolName, newFn, origin, sampling, Ccp4Header.START)  # ORIGIN
+        convertVolume(vol, newFn)
+        if self.cropMap:
+            cropMapToModel(newFn, self.inputStructure.get().getFileName(),
+                           self.cropPadding.get())
 
     def runEMRingerStep(self):
         inPDBAtomStructFile = self.inputStructure.get().getFileName()
@@ -108,7 +119,7 @@ the atomic structure backbone has been perfectly fitted to the map.
         sys.stdout.flush()
         # import time
         # time.sleep(30)
-        retry(Plugin.runPhenixProgram, Plugin.getProgram(EMRINGER),
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(EMRINGER),
               args, cwd=self._getExtraPath(),
               listAtomStruct=[atomStruct], log=self._log,
               messages=[("max_max = max(maxima)", 
@@ -226,8 +237,8 @@ dataDict['_residues_dict'] = dictResidue
         with open(pythonFileName, "w") as f:
             f.write(command)
 
-        # execute file with phenix.python
-        Plugin.runPhenixProgram("", pythonFileName)
+        # execute file with the phenix.python worker
+        Plugin.runPhenixScript(pythonFileName)
 
         # read file in scipion python
         with open(EMRINGERTRANSFERFILENAME, "r") as f:
@@ -29,6 +29,7 @@ from phenix.constants import MOLPROBITY, PHENIXVERSION
 from phenix import Plugin
 from .protocol_refinement_base import PhenixProtRunRefinementBase
 from pwem.convert.atom_struct import retry
+from phenix.cache import cachedRetry
 
 class PhenixProtRunMolprobity(PhenixProtRunRefinementBase):
     """MolProbity is a Phenix application to validate the geometry of an
@@ -82,7 +83,7 @@ atomic structure inferred from an electron density map.
         else:
             args = self._writeArgsMolProbityExpand(self.atomStruct, vol=None)
         # script with auxiliary files
-        retry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY),
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY),
               # args, cwd=os.path.abspath(self._getExtraPath()),
               args, cwd=self._getExtraPath(),
               listAtomStruct=[self.atomStruct], log=self._log,
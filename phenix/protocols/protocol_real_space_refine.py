@@ -28,7 +28,7 @@
 import os
 
 from pwem.objects import AtomStruct
-from pyworkflow.protocol.params import BooleanParam,  IntParam
+from pyworkflow.protocol.params import BooleanParam,  IntParam, FloatParam
 from phenix.constants import (REALSPACEREFINE,
                               MOLPROBITY2,
                               VALIDATION_CRYOEM,
@@ -36,16 +36,23 @@ from phenix.constants import (REALSPACEREFINE,
                               PHENIXVERSION19,
                               PHENIXVERSION20)
 
+from pyworkflow.protocol import STEPS_PARALLEL
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 
 from pwem.convert.atom_struct import retry, fromCIFTommCIF
 from .protocol_refinement_base import PhenixProtRunRefinementBase
 from phenix import Plugin
+from phenix.cache import cachedRetry
+from phenix.convert import (CLASH_DISTANCE, CLASH_GUARD_MAX_PER_1000_ATOMS,
+                            findClashes)
 import re
 
 PDB = 0
 mmCIF = 1
 OUTPUT_FORMAT = ['pdb', 'mmcif']
+CLASH_GUARD_ARGS = " pdb_interpretation.clash_guard." \
+                   "nonbonded_distance_threshold=None"
+MAX_REPORTED_CLASHES = 20
 
 
 class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
@@ -62,6 +69,13 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
     if Plugin.getPhenixVersion() != PHENIXVERSION:
         VALIDATIONCRYOEMPKLFILE = 'validation_cryoem.pkl'
 
+    def __init__(self, **kwargs):
+        super(PhenixProtRunRSRefine, self).__init__(**kwargs)
+        # MolProbity and validation_cryoem run at the same time; subclasses
+        # have their own steps and choose their execution mode
+        if type(self) is PhenixProtRunRSRefine:
+            self.stepsExecutionMode = STEPS_PARALLEL
+
     # --------------------------- DEFINE param functions -------------------
     def _defineParams(self, form):
         super(PhenixProtRunRSRefine, self)._defineParams(form)
@@ -82,6 +96,14 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
                            "which model geometry or/and model-to-map fit is "
                            "poor the use of more macro-cycles could be "
                            "helpful.\n")
+        form.addParam("maxClashes", FloatParam,
+                      label="Max. clashes per 1000 atoms",
+                      default=CLASH_GUARD_MAX_PER_1000_ATOMS,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="Interatomic distances shorter than %0.1f A per "
+                           "1000 atoms above which the clash guard of PHENIX "
+                           "is disabled before the refinement, so that it "
+                           "does not stop it.\n" % CLASH_DISTANCE)
         group = form.addGroup('Optimization strategy options')
         group.addParam('minimizationGlobal', BooleanParam,
                        label="Global minimization: ", default=True,
@@ -170,19 +192,44 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
 
     # --------------------------- INSERT steps functions ---------------
     def _insertAllSteps(self):
-        self._insertFunctionStep('convertInputStep', self.REALSPACEFILE)
-        self._insertFunctionStep('runRSrefineStep', self.REALSPACEFILE)
-        self._insertFunctionStep('runMolprobityStep', self.REALSPACEFILE)
+        convertId = self._insertFunctionStep('convertInputStep',
+                                             self.REALSPACEFILE)
+        refineId = self._insertFunctionStep('runRSrefineStep',
+                                            self.REALSPACEFILE,
+                                            prerequisites=[convertId])
+        # both validations only read the refined model and the map
+        validationIds = [self._insertFunctionStep('runMolprobityStep',
+                                                  self.REALSPACEFILE,
+                                                  prerequisites=[refineId])]
         if Plugin.getPhenixVersion() != PHENIXVERSION:
-            self._insertFunctionStep('runValidationCryoEMStep', self.REALSPACEFILE)
-        self._insertFunctionStep('createOutputStep')
+            validationIds.append(self._insertFunctionStep(
+                'runValidationCryoEMStep', self.REALSPACEFILE,
+                prerequisites=[refineId]))
+        self._insertFunctionStep('createOutputStep',
+                                 prerequisites=validationIds)
 
     # --------------------------- STEPS functions --------------------------
     def runRSrefineStep(self, tmpMapFile):
         atomStruct = os.path.abspath(self.inputStructure.get().getFileName())
         vol = os.path.abspath(self._getExtraPath(tmpMapFile))
-        args = self._writeArgsRSR(atomStruct, vol)
-        cwd = os.getcwd() + "/" + self._getExtraPath()
+        self._runRSRefine(atomStruct, vol, self._getExtraPath())
+        # before the validations start reading it
+        self._getRSRefineOutput()
+
+    def _runRSRefine(self, atomStruct, vol, outDir, numberOfThreads=None,
+                     clashGuardDisabled=None, settings=None):
+        """ Refine atomStruct against vol writing the results in outDir.
+        The clashes of atomStruct are checked unless clashGuardDisabled
+        is given. settings replace parameters of the form (see
+        _writeArgsRSR) """
+        args = self._writeArgsRSR(atomStruct, vol, numberOfThreads, settings)
+        cwd = os.path.abspath(outDir)
+        # decide on the clash guard before launching, so that a model with
+        # too many clashes is not refined twice
+        if clashGuardDisabled is None:
+            clashGuardDisabled = self._hasTooManyClashes(atomStruct)
+        if clashGuardDisabled:
+            args += CLASH_GUARD_ARGS
 
         retry(Plugin.runPhenixProgram,
               Plugin.getProgram(REALSPACEREFINE), args, cwd=cwd,
@@ -191,22 +238,17 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
                          "Sorry: Map and model are not aligned! Use skip_map_model_overlap_check=True to continue.")], 
               sdterrLog = self.getLogsLastLines)
 
-        self.refinedFile = False
-        for item in os.listdir(self._getExtraPath()):
-            p = re.compile('\d+')
-            if p.search(item) is not None and item.endswith(".cif"):
-                self.refinedFile = True
-                break
+        # local: parallel steps of the subclasses refine at the same time
+        refined = self._getRefinedFileName(outDir) is not None
 
-        if self.refinedFile == False:
+        if not refined and not clashGuardDisabled:
             print("WARNING!!!\nPHENIX error:\n pdb_interpretation.clash_guard" \
                   " failure: High number of nonbonded interaction distances " \
                   "< 0.5. This error has been disable by running the same " \
                   "command with the same following additional " \
                   "argument:\npdb_interpretation.clash_guard." \
                   "nonbonded_distance_threshold=None ")
-            args += " pdb_interpretation.clash_guard." \
-                    "nonbonded_distance_threshold=None"
+            args += CLASH_GUARD_ARGS
             retry(Plugin.runPhenixProgram,
                   Plugin.getProgram(REALSPACEREFINE), args, cwd=cwd,
                   listAtomStruct=[atomStruct], log=self._log,
@@ -216,20 +258,20 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
 
     def runMolprobityStep(self, tmpMapFile):
         # PDBx/mmCIF
-        self._getRSRefineOutput()
-        atomStruct = os.path.abspath(self.outAtomStructName)
+        atomStruct = os.path.abspath(self._getRefinedFileName())
         # starting volume (.mrc)
         vol = os.path.abspath(self._getExtraPath(tmpMapFile))
-        args = self._writeArgsMolProbity(atomStruct, vol)
+        args = self._writeArgsMolProbity(
+            atomStruct, vol, numberOfThreads=self._getMolprobityThreads())
         cwd = os.getcwd() + "/" + self._getExtraPath()
-        retry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY2),
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY2),
               args, cwd=cwd,
               listAtomStruct=[atomStruct], log=self._log,
               sdterrLog = self.getLogsLastLines)
 
     def runValidationCryoEMStep(self, tmpMapFile):
         # PDBx/mmCIF
-        atomStruct = os.path.abspath(self.outAtomStructName)
+        atomStruct = os.path.abspath(self._getRefinedFileName())
         # starting volume (.mrc)
         volume = os.path.abspath(self._getExtraPath(tmpMapFile))
         if self.inputVolume.get() is not None:
@@ -239,15 +281,14 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
 
         args = self._writeArgsValCryoEM(atomStruct, volume, vol)
         cwd = os.getcwd() + "/" + self._getExtraPath()
-        retry(Plugin.runPhenixProgram, Plugin.getProgram(VALIDATION_CRYOEM),
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(VALIDATION_CRYOEM),
               args, cwd=cwd,
               listAtomStruct=[atomStruct], log=self._log,
               sdterrLog = self.getLogsLastLines)
 
     def createOutputStep(self):
-        # self._getRSRefineOutput()
         pdb = AtomStruct()
-        pdb.setFileName(self.outAtomStructName)
+        pdb.setFileName(self._getRefinedFileName())
 
         if self.inputVolume.get() is not None:
             pdb.setVolume(self.inputVolume.get())
@@ -289,22 +330,76 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
 
     # --------------------------- UTILS functions --------------------------
 
-    def _getRSRefineOutput(self):
-        inPdbName = os.path.basename(self.inputStructure.get().getFileName())
+    def _hasTooManyClashes(self, atomStruct):
+        """ Count the interatomic distances below the clash guard threshold
+        of PHENIX and report them. True if there are more than maxClashes
+        per 1000 atoms, so that the clash guard would stop the
+        refinement """
+        try:
+            clashes, numberOfAtoms = findClashes(atomStruct)
+        except Exception as e:
+            print("WARNING: clashes could not be checked (%s)" % e)
+            return False
+        if not clashes:
+            return False
+        print("%d interatomic distances < %0.1f A in %s:"
+              % (len(clashes), CLASH_DISTANCE, os.path.basename(atomStruct)))
+        for atom1, atom2, distance in clashes[:MAX_REPORTED_CLASHES]:
+            print("    %s - %s: %0.3f A" % (atom1, atom2, distance))
+        if len(clashes) > MAX_REPORTED_CLASHES:
+            print("    ...")
+        clashesPer1000Atoms = 1000. * len(clashes) / max(numberOfAtoms, 1)
+        maxClashes = self.maxClashes.get()
+        if clashesPer1000Atoms <= maxClashes:
+            return False
+        print("WARNING!!!\n%0.1f clashes per 1000 atoms (more than %0.1f), "
+              "the PHENIX clash guard would stop the refinement. It is "
+              "disabled with the argument:\npdb_interpretation.clash_guard."
+              "nonbonded_distance_threshold=None"
+              % (clashesPer1000Atoms, maxClashes))
+        return True
+
+    def _getRefinedFileName(self, outDir=None):
+        """ Last model written by real_space_refine in outDir (extra by
+        default), None if there is none """
+        outDir = outDir or self._getExtraPath()
         list_cif = []
-        for item in os.listdir(self._getExtraPath()):
+        for item in os.listdir(outDir):
             p = re.compile('\d+')
             if p.search(item) is not None and item.endswith(".cif"):
                 list_cif.append(item)
-        name = sorted(list_cif)[-1]
-        outAtomStructName = self._getExtraPath(name)
+        if not list_cif:
+            return None
+        return os.path.join(outDir, sorted(list_cif)[-1])
+
+    def _getRSRefineOutput(self):
+        outAtomStructName = self._getRefinedFileName()
         # convert cif to mmcif by using maxit program
         # to get the right number and name of chains
         log = self._log
         self.outAtomStructName = outAtomStructName
         fromCIFTommCIF(outAtomStructName, self.outAtomStructName, log)
 
-    def _writeArgsRSR(self, atomStruct, vol):
+    def _getMolprobityThreads(self):
+        """ MolProbity gets the threads not used by validation_cryoem
+        (single threaded) when both run at the same time, i.e. when
+        there are at least two step threads besides the main one """
+        numberOfThreads = self.numberOfThreads.get()
+        if Plugin.getPhenixVersion() != PHENIXVERSION and numberOfThreads > 2:
+            numberOfThreads -= 1
+        return numberOfThreads
+
+    def _writeArgsRSR(self, atomStruct, vol, numberOfThreads=None,
+                      settings=None):
+        """ settings: {parameter name: value} that replace the values of
+        the form (e.g. resolution, macroCycles or the run modes) """
+        settings = settings or {}
+
+        def value(name):
+            if name in settings:
+                return settings[name]
+            return getattr(self, name).get()
+
         if Plugin.getPhenixVersion() == PHENIXVERSION19 or PHENIXVERSION20:
             args = " "
         else:
@@ -315,35 +410,36 @@ class PhenixProtRunRSRefine(PhenixProtRunRefinementBase):
         else:
             args += " map_file="
         args += "%s " % vol
-        args += " resolution=%f" % self.resolution
+        args += " resolution=%f" % value('resolution')
         if self.doSecondary == True:
             args += " secondary_structure.enabled=%s" % self.doSecondary
         args += " run="
-        if self.minimizationGlobal == True:
+        if value('minimizationGlobal'):
             args += "minimization_global+"
-        if self.rigidBody == True:
+        if value('rigidBody'):
             args += "rigid_body+"
-        if self.localGridSearch == True:
+        if value('localGridSearch'):
             args += "local_grid_search+"
-        if self.morphing == True:
+        if value('morphing'):
             args += "morphing+"
-        if self.simulatedAnnealing == True:
+        if value('simulatedAnnealing'):
             args += "simulated_annealing+"
-        if self.adp == True:
+        if value('adp'):
             args += "adp+"
-        if self.occupancy == True:
+        if value('occupancy'):
             args += "occupancy+"
-        if self.nqh_flips == True:
+        if value('nqh_flips'):
             args += "nqh_flips+"
         args = args[:-1]
         # args += " run=minimization_global+local_grid_search+morphing+simulated_annealing"
-        if self.macroCycles != 5:
-            args += " macro_cycles=%d" % self.macroCycles
+        if value('macroCycles') != 5:
+            args += " macro_cycles=%d" % value('macroCycles')
         #args += " model_format=pdb+mmcif"
         #args += " wrapping=Auto adp_individual_isotropic=Auto ncs_search.enabled=True"
         # args += " write_pkl_stats=True"
         args += " %s " % self.extraParams.get()
-        numberOfThreads = self.numberOfThreads.get()
+        if numberOfThreads is None:
+            numberOfThreads = self.numberOfThreads.get()
         if numberOfThreads > 1:
             args += " nproc=%d" % numberOfThreads
         return args
@@ -0,0 +1,166 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import pyworkflow.utils as pwutils
+from pwem.objects import AtomStruct
+from pwem.convert.atom_struct import fromCIFTommCIF
+from pyworkflow.object import Integer
+from pyworkflow.protocol import STEPS_PARALLEL
+from pyworkflow.protocol.params import PointerParam
+from phenix import Plugin
+from phenix.cache import cachedRetry
+from phenix.constants import MOLPROBITY2, REALSPACEREFINE
+from .protocol_real_space_refine import PhenixProtRunRSRefine
+
+MODELFOLDER = 'model_%06d'  # input structure id
+
+
+class PhenixProtRunRSRefineBatch(PhenixProtRunRSRefine):
+    """Real-space refinement of every atomic structure of a set (e.g. the
+    members of an ensemble, alternative builds or the ranked models of
+    AlphaFold) against the same map. The map is converted once and the
+    structures are refined in parallel; every refined structure, with its
+    MolProbity statistics, is added to the output set as soon as it is
+    finished.
+    """
+    _label = 'real space refine (batch)'
+
+    def __init__(self, **kwargs):
+        super(PhenixProtRunRSRefineBatch, self).__init__(**kwargs)
+        # the structures are refined and validated at the same time, each
+        # one only depends on the converted map
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    # --------------------------- DEFINE param functions -------------------
+    def _defineParams(self, form):
+        super(PhenixProtRunRSRefineBatch, self)._defineParams(form)
+        param = form.getParam('inputVolume')
+        param.allowsNull.set(False)
+        param.help.set("\nMap the atomic structures are refined against.\n"
+                       "It is converted only once for all of them.\n")
+        # the set of structures replaces the single one
+        param = form.getParam('inputStructure')
+        param.allowsNull.set(True)
+        param.condition.set('False')
+        # the map is shared by structures that may cover different parts
+        for name in ('cropMap', 'cropPadding'):
+            form.getParam(name).condition.set('False')
+        form.addParam('inputStructures', PointerParam,
+                      pointerClass="SetOfAtomStructs", allowsNull=False,
+                      important=True,
+                      label='Input atomic structures',
+                      help="Atomic structures to refine, each one on its "
+                           "own.\nThe refinements run as parallel steps: "
+                           "with MPI every refinement uses the given "
+                           "threads, otherwise every thread runs a "
+                           "refinement.")
+
+    # --------------------------- INSERT steps functions ---------------
+    def _insertAllSteps(self):
+        convertId = self._insertFunctionStep('convertInputStep',
+                                             self.REALSPACEFILE)
+        deps = []
+        for atomStruct in self.inputStructures.get():
+            refineId = self._insertFunctionStep('refineStructureStep',
+                                                atomStruct.getObjId(),
+                                                atomStruct.getFileName(),
+                                                prerequisites=[convertId])
+            deps.append(self._insertFunctionStep('molprobityStructureStep',
+                                                 atomStruct.getObjId(),
+                                                 prerequisites=[refineId]))
+        self._insertFunctionStep('createOutputStep', prerequisites=deps)
+
+    # --------------------------- STEPS functions --------------------------
+    def refineStructureStep(self, structId, fileName):
+        outDir = self._getModelPath(structId)
+        pwutils.makePath(outDir)
+        vol = os.path.abspath(self._getExtraPath(self.REALSPACEFILE))
+        self._runRSRefine(os.path.abspath(fileName), vol, outDir,
+                          self._getRefineThreads())
+        refinedFile = self._getRefinedFileName(outDir)
+        if refinedFile is None:
+            raise Exception("%s did not refine %s"
+                            % (REALSPACEREFINE, fileName))
+        # convert cif to mmcif by using maxit program
+        # to get the right number and name of chains
+        fromCIFTommCIF(refinedFile, refinedFile, self._log)
+
+    def molprobityStructureStep(self, structId):
+        outDir = self._getModelPath(structId)
+        atomStruct = os.path.abspath(self._getRefinedFileName(outDir))
+        vol = os.path.abspath(self._getExtraPath(self.REALSPACEFILE))
+        args = self._writeArgsMolProbity(
+            atomStruct, vol, numberOfThreads=self._getRefineThreads())
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY2),
+                    args, cwd=os.path.abspath(outDir),
+                    listAtomStruct=[atomStruct], log=self._log,
+                    sdterrLog=self.getLogsLastLines)
+        self._publishStructure(structId, atomStruct,
+                               os.path.join(outDir,
+                                            self.MOLPROBITYOUTFILENAME))
+
+    def createOutputStep(self):
+        if not self._closeOutput():
+            return
+        self._defineSourceRelation(self.inputStructures,
+                                   self.outputAtomStructs)
+        self._defineSourceRelation(self.inputVolume, self.outputAtomStructs)
+
+    # --------------------------- INFO functions ---------------------------
+    def _validate(self):
+        return self.validateBase(REALSPACEREFINE, 'REALSPACEREFINE')
+
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('outputAtomStructs'):
+            summary.append("%d of %d atomic structures refined."
+                           % (self.outputAtomStructs.getSize(),
+                              self.inputStructures.get().getSize()))
+        else:
+            summary.append("No atomic structure refined yet.")
+        summary.append(
+            "https://www.phenix-online.org/documentation/reference/"
+            "real_space_refine.html")
+        return summary
+
+    # --------------------------- UTILS functions --------------------------
+    def _getInputVolume(self):
+        return self.inputVolume.get()
+
+    def _getModelPath(self, structId):
+        return self._getExtraPath(MODELFOLDER % structId)
+
+    def _publishStructure(self, structId, atomStructFn, molprobityFn):
+        """ Add a refined structure, with its MolProbity statistics, to the
+        streaming output as soon as it is finished """
+        atomStruct = AtomStruct()
+        atomStruct.setFileName(atomStructFn)
+        atomStruct.setVolume(self.inputVolume.get())
+        atomStruct.inputId = Integer(structId)
+        if os.path.exists(molprobityFn):
+            for name, value in self._readMolprobityFile(molprobityFn).items():
+                setattr(atomStruct, name, value)
+        self._appendToOutput(atomStruct)
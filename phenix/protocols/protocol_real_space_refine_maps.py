@@ -0,0 +1,218 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import csv
+import os
+
+import pyworkflow.utils as pwutils
+from pwem.objects import AtomStruct
+from pwem.convert.atom_struct import fromCIFTommCIF, fromPDBToCIF
+from pyworkflow.object import Boolean, Float, Integer, String
+from pyworkflow.protocol import STEPS_PARALLEL
+from pyworkflow.protocol.params import PointerParam
+from phenix.constants import REALSPACEREFINE
+from phenix.convert import (RSR_LOG_METRICS, convertMapFile, cropMapToModel,
+                            parseRSRefineLog)
+from .protocol_real_space_refine import PhenixProtRunRSRefine
+
+MODELFILENAME = 'model.cif'  # input model, normalised once
+MAPFOLDER = 'map_%06d'  # input volume id
+COMPARISONFILENAME = 'comparison.csv'
+# attributes of the output models with the metrics of the refinement logs
+METRIC_ATTRIBUTES = dict(
+    (name, name.split('_')[0] + ''.join(word.capitalize()
+                                        for word in name.split('_')[1:]))
+    for name in RSR_LOG_METRICS)
+
+
+class PhenixProtRunRSRefineMaps(PhenixProtRunRSRefine):
+    """Real-space refinement of one atomic structure against every map of
+    a set (e.g. the classes of a 3D classification). The model is
+    prepared once and refined against the maps in parallel; the refined
+    models are added to the output set as soon as they are finished and
+    their model-to-map correlation and geometry are compared in a table.
+    """
+    _label = 'real space refine (multiple maps)'
+
+    def __init__(self, **kwargs):
+        super(PhenixProtRunRSRefineMaps, self).__init__(**kwargs)
+        # the maps are converted and refined against at the same time, each
+        # one only depends on the prepared model
+        self.stepsExecutionMode = STEPS_PARALLEL
+        # set by prepareModelStep, used by every refinement
+        self.clashGuardDisabled = Boolean()
+
+    # --------------------------- DEFINE param functions -------------------
+    def _defineParams(self, form):
+        super(PhenixProtRunRSRefineMaps, self)._defineParams(form)
+        # the set of maps replaces the single one
+        param = form.getParam('inputVolume')
+        param.allowsNull.set(True)
+        param.condition.set('False')
+        param = form.getParam('inputStructure')
+        param.help.set("Atomic structure refined against every map.\n"
+                       "Supported formats are PDB or mmCIF; it is "
+                       "converted to mmCIF only once.")
+        form.addParam('inputVolumes', PointerParam,
+                      pointerClass="SetOfVolumes", allowsNull=False,
+                      important=True,
+                      label='Input volumes',
+                      help="Maps the atomic structure is refined against "
+                           "(e.g. the classes of a 3D classification), each "
+                           "one on its own.\nThe refinements run as "
+                           "parallel steps: with MPI every refinement uses "
+                           "the given threads, otherwise every thread runs "
+                           "a refinement.")
+
+    # --------------------------- INSERT steps functions ---------------
+    def _insertAllSteps(self):
+        prepareId = self._insertFunctionStep('prepareModelStep')
+        deps = []
+        # the steps get what they need of every volume, so that they do
+        # not read the input set from parallel threads
+        for vol in self.inputVolumes.get():
+            volId = vol.getObjId()
+            convertId = self._insertFunctionStep(
+                'convertMapStep', volId, vol.getFileName(),
+                [float(x) for x in vol.getOrigin(force=True).getShifts()],
+                vol.getSamplingRate(), prerequisites=[prepareId])
+            deps.append(self._insertFunctionStep(
+                'refineMapStep', volId, self._getMapLabel(vol),
+                prerequisites=[convertId]))
+        self._insertFunctionStep('createOutputStep', prerequisites=deps)
+
+    # --------------------------- STEPS functions --------------------------
+    def prepareModelStep(self):
+        """ Convert the model to mmCIF and check its clashes, once for
+        every map """
+        inFileName = os.path.abspath(self.inputStructure.get().getFileName())
+        modelFileName = self._getExtraPath(MODELFILENAME)
+        if inFileName.endswith(('.pdb', '.ent')):
+            fromPDBToCIF(inFileName, modelFileName, self._log)
+            inFileName = modelFileName
+        # convert cif to mmcif by using maxit program
+        # to get the right number and name of chains
+        fromCIFTommCIF(inFileName, modelFileName, self._log)
+        self.clashGuardDisabled.set(self._hasTooManyClashes(modelFileName))
+        self._store(self.clashGuardDisabled)
+
+    def convertMapStep(self, volId, volFileName, origin, sampling):
+        mapDir = self._getMapPath(volId)
+        pwutils.makePath(mapDir)
+        mapFileName = os.path.join(mapDir, self.REALSPACEFILE)
+        convertMapFile(volFileName, mapFileName, origin, sampling)
+        if self.cropMap:
+            cropMapToModel(mapFileName, self._getExtraPath(MODELFILENAME),
+                           self.cropPadding.get())
+
+    def refineMapStep(self, volId, mapLabel):
+        mapDir = self._getMapPath(volId)
+        self._runRSRefine(
+            os.path.abspath(self._getExtraPath(MODELFILENAME)),
+            os.path.abspath(os.path.join(mapDir, self.REALSPACEFILE)),
+            mapDir, self._getRefineThreads(),
+            clashGuardDisabled=self.clashGuardDisabled.get())
+        refinedFile = self._getRefinedFileName(mapDir)
+        if refinedFile is None:
+            raise Exception("%s did not refine the model against map %d"
+                            % (REALSPACEREFINE, volId))
+        metrics = parseRSRefineLog(refinedFile[:-4] + ".log")
+        # convert cif to mmcif by using maxit program
+        # to get the right number and name of chains
+        fromCIFTommCIF(refinedFile, refinedFile, self._log)
+        self._publishModel(volId, mapLabel, refinedFile, metrics)
+
+    def createOutputStep(self):
+        if not self._closeOutput():
+            return
+        self._defineSourceRelation(self.inputStructure,
+                                   self.outputAtomStructs)
+        self._defineSourceRelation(self.inputVolumes, self.outputAtomStructs)
+        self._writeComparison()
+
+    # --------------------------- INFO functions ---------------------------
+    def _validate(self):
+        return self.validateBase(REALSPACEREFINE, 'REALSPACEREFINE')
+
+    def _summary(self):
+        rows = self._readComparison()
+        if not rows:
+            return ["No model refined yet."]
+        summary = ["Model refined against %d maps (best model-to-map fit "
+                   "first):" % len(rows),
+                   "%-20s %8s %8s %8s %10s %10s" % ('map', 'CC_mask',
+                                                    'CC_vol', 'clash',
+                                                    'bonds', 'angles')]
+        for row in rows:
+            summary.append("%-20s %8s %8s %8s %10s %10s"
+                           % (row['map'], row['cc_mask'], row['cc_volume'],
+                              row['clashscore'], row['bond_rmsd'],
+                              row['angle_rmsd']))
+        return summary
+
+    # --------------------------- UTILS functions --------------------------
+    def _getMapPath(self, volId):
+        return self._getExtraPath(MAPFOLDER % volId)
+
+    def _publishModel(self, volId, mapLabel, atomStructFn, metrics):
+        """ Add the model refined against a map, with the metrics of its
+        refinement log, to the streaming output as soon as it is
+        finished """
+        atomStruct = AtomStruct()
+        atomStruct.setFileName(atomStructFn)
+        atomStruct.mapId = Integer(volId)
+        atomStruct.mapLabel = String(mapLabel)
+        for name, attribute in METRIC_ATTRIBUTES.items():
+            setattr(atomStruct, attribute, Float(metrics.get(name)))
+        self._appendToOutput(atomStruct)
+
+    @staticmethod
+    def _getMapLabel(vol):
+        return vol.getObjLabel() or os.path.basename(vol.getFileName())
+
+    def _writeComparison(self):
+        """ Table with the metrics of the model refined against every map,
+        best model-to-map fit (CC_mask) first """
+        rows = []
+        for atomStruct in self.outputAtomStructs:
+            row = {'map_id': atomStruct.mapId.get(),
+                   'map': atomStruct.mapLabel.get()}
+            for name, attribute in METRIC_ATTRIBUTES.items():
+                row[name] = getattr(atomStruct, attribute).get()
+            row['filename'] = atomStruct.getFileName()
+            rows.append(row)
+        rows.sort(key=lambda row: -1 if row['cc_mask'] is None
+                  else row['cc_mask'], reverse=True)
+        with open(self._getExtraPath(COMPARISONFILENAME), 'w') as f:
+            writer = csv.DictWriter(f, ['map_id', 'map'] +
+                                    list(RSR_LOG_METRICS) + ['filename'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def _readComparison(self):
+        fileName = self._getExtraPath(COMPARISONFILENAME)
+        if not os.path.exists(fileName):
+            return []
+        with open(fileName) as f:
+            return list(csv.DictReader(f))
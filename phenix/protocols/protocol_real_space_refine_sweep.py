@@ -0,0 +1,375 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import collections
+import csv
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+
+import pyworkflow.utils as pwutils
+from pwem.objects import AtomStruct
+from pwem.convert.atom_struct import fromCIFTommCIF
+from pyworkflow.object import Float, String
+from pyworkflow.protocol import STEPS_PARALLEL
+from pyworkflow.protocol.params import (EnumParam, IntParam, PointerParam,
+                                        StringParam)
+from phenix import Plugin
+from phenix.cache import cachedRetry, hashFile
+from phenix.constants import MOLPROBITY2, REALSPACEREFINE
+from phenix.convert import parseRSRefineLog
+from .protocol_real_space_refine import PhenixProtRunRSRefine
+
+SWEEP_GRID = 0
+SWEEP_RANDOM = 1
+# run modes of real_space_refine (parameters of PhenixProtRunRSRefine)
+RUN_MODES = ['minimizationGlobal', 'rigidBody', 'localGridSearch',
+             'morphing', 'simulatedAnnealing', 'adp', 'occupancy',
+             'nqh_flips']
+POINTFOLDER = 'point_%s'  # key of the settings
+RESULTFILENAME = 'result.json'  # scores of a point, written when finished
+SWEEPFILENAME = 'sweep.csv'
+
+
+def getParetoFront(scores):
+    """ Indexes of the (ccMask, molprobityScore) pairs that no other pair
+    improves in both scores: higher CC_mask and lower MolProbity score """
+    front = []
+    for i, (cc, molprobity) in enumerate(scores):
+        if not any(otherCc >= cc and otherMolprobity <= molprobity and
+                   (otherCc, otherMolprobity) != (cc, molprobity)
+                   for otherCc, otherMolprobity in scores):
+            front.append(i)
+    return front
+
+
+def getPointScores(metrics, molprobity):
+    """ (CC_mask, MolProbity score) of a point, from the metrics of its
+    refinement log and the statistics of its molprobity.out. A missing
+    score is None and leaves the point unscored """
+    molprobityScore = molprobity.get('overallScore')
+    return (metrics.get('cc_mask'),
+            None if molprobityScore is None else molprobityScore.get())
+
+
+def isScored(result):
+    """ True if both scores of the result of a point are known """
+    return (result['cc_mask'] is not None and
+            result['molprobity_score'] is not None)
+
+
+def getParetoKeys(results):
+    """ Keys of the settings of the results on the Pareto front; the
+    unscored ones are left out """
+    scored = [result for result in results if isScored(result)]
+    return set(getSettingsKey(scored[i]['settings']) for i in
+               getParetoFront([(result['cc_mask'],
+                                result['molprobity_score'])
+                               for result in scored]))
+
+
+def getSettingsKey(settings):
+    """ Name of a point of the sweep, the same for equal settings """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()
+                        ).hexdigest()[:12]
+
+
+class PhenixProtRunRSRefineSweep(PhenixProtRunRSRefine):
+    """Sweep of real_space_refine settings: the atomic structure is refined
+    with every combination (or a random sample of the combinations) of
+    the given resolutions, macro cycles and run modes. Every result is
+    scored by its model-to-map fit (CC_mask) and its MolProbity score, and
+    the Pareto-optimal settings (those no other combination improves in
+    both scores) are the output. Points already refined by a previous
+    sweep on the same inputs are reused, so a sweep can be extended.
+    """
+    _label = 'real space refine (sweep)'
+
+    def __init__(self, **kwargs):
+        super(PhenixProtRunRSRefineSweep, self).__init__(**kwargs)
+        # the combinations are refined at the same time, each one only
+        # depends on the converted map
+        self.stepsExecutionMode = STEPS_PARALLEL
+
+    # --------------------------- DEFINE param functions -------------------
+    def _defineParams(self, form):
+        super(PhenixProtRunRSRefineSweep, self)._defineParams(form)
+        form.addSection(label='Sweep')
+        form.addParam('sweepResolutions', StringParam, default='',
+                      label='Resolutions (A)',
+                      help="Resolutions to try, separated by spaces "
+                           "(e.g. 3.0 3.5 4.0). If empty, only the "
+                           "resolution of the input section.")
+        form.addParam('sweepMacroCycles', StringParam, default='',
+                      label='Macro cycles',
+                      help="Numbers of macro cycles to try, separated by "
+                           "spaces (e.g. 5 10). If empty, only the macro "
+                           "cycles of the input section.")
+        form.addParam('sweepRunModes', StringParam,
+                      default='morphing simulatedAnnealing',
+                      label='Run modes to switch',
+                      help="Run modes tried both on and off, separated by "
+                           "spaces. The other ones keep the value of the "
+                           "optimization strategy options.\nRun modes: %s"
+                           % ' '.join(RUN_MODES))
+        form.addParam('sweepMode', EnumParam, default=SWEEP_GRID,
+                      choices=['grid', 'random sample'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Combinations',
+                      help="Refine every combination of the settings above "
+                           "or a random sample of them.")
+        form.addParam('numberOfSamples', IntParam, default=8,
+                      condition='sweepMode == %d' % SWEEP_RANDOM,
+                      label='Number of samples',
+                      help="Combinations refined. With the same seed, a "
+                           "larger sample contains the smaller ones, so a "
+                           "sweep can be extended.")
+        form.addParam('randomSeed', IntParam, default=0,
+                      condition='sweepMode == %d' % SWEEP_RANDOM,
+                      label='Random seed')
+        form.addParam('previousSweep', PointerParam,
+                      pointerClass='PhenixProtRunRSRefineSweep',
+                      allowsNull=True,
+                      label='Previous sweep',
+                      help="Sweep of the same atomic structure and map whose "
+                           "finished combinations are reused instead of "
+                           "refined again.")
+
+    # --------------------------- INSERT steps functions ---------------
+    def _insertAllSteps(self):
+        # the combinations run as parallel steps: the number of threads
+        # (or MPI processes) is the limit of concurrent refinements
+        convertId = self._insertFunctionStep('convertInputStep',
+                                             self.REALSPACEFILE)
+        deps = [self._insertFunctionStep('refinePointStep',
+                                         json.dumps(settings, sort_keys=True),
+                                         prerequisites=[convertId])
+                for settings in self._getSweepPoints()]
+        self._insertFunctionStep('createOutputStep', prerequisites=deps)
+
+    # --------------------------- STEPS functions --------------------------
+    def refinePointStep(self, settingsJson):
+        """ Refine and validate with MolProbity a combination of settings,
+        or copy its results from the previous sweep """
+        settings = json.loads(settingsJson)
+        key = getSettingsKey(settings)
+        pointDir = self._getPointPath(key)
+        if self._reusePoint(key):
+            print("Settings %s: results reused from the previous sweep"
+                  % settingsJson)
+            return
+        pwutils.cleanPath(pointDir)
+        pwutils.makePath(pointDir)
+        atomStruct = os.path.abspath(self.inputStructure.get().getFileName())
+        vol = os.path.abspath(self._getExtraPath(self.REALSPACEFILE))
+        self._runRSRefine(atomStruct, vol, pointDir,
+                          self._getRefineThreads(), settings=settings)
+        refinedFile = self._getRefinedFileName(pointDir)
+        if refinedFile is None:
+            raise Exception("%s did not refine with the settings %s"
+                            % (REALSPACEREFINE, settingsJson))
+        metrics = parseRSRefineLog(refinedFile[:-4] + ".log")
+        # convert cif to mmcif by using maxit program
+        # to get the right number and name of chains
+        fromCIFTommCIF(refinedFile, refinedFile, self._log)
+        refinedFile = os.path.abspath(refinedFile)
+        args = self._writeArgsMolProbity(
+            refinedFile, vol, numberOfThreads=self._getRefineThreads())
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY2),
+                    args, cwd=os.path.abspath(pointDir),
+                    listAtomStruct=[refinedFile], log=self._log,
+                    sdterrLog=self.getLogsLastLines)
+        molprobity = self._readMolprobityFile(
+            os.path.join(pointDir, self.MOLPROBITYOUTFILENAME))
+        ccMask, molprobityScore = getPointScores(metrics, molprobity)
+        result = {'settings': settings,
+                  'inputs': self._getInputsKey(),
+                  'filename': os.path.basename(refinedFile),
+                  'cc_mask': ccMask,
+                  'molprobity_score': molprobityScore}
+        if not isScored(result):
+            print("WARNING: settings %s not scored (CC_mask: %s, MolProbity "
+                  "score: %s), left out of the Pareto front"
+                  % (settingsJson, ccMask, molprobityScore))
+        # written last: a point is finished when its result exists
+        with open(os.path.join(pointDir, RESULTFILENAME), 'w') as f:
+            json.dump(result, f, indent=1)
+
+    def createOutputStep(self):
+        results = self._readResults()
+        front = getParetoKeys(results)
+        # the front first, then the scored points, best CC_mask first
+        results.sort(key=lambda result: (
+            getSettingsKey(result['settings']) not in front,
+            not isScored(result), -(result['cc_mask'] or 0)))
+        with open(self._getExtraPath(SWEEPFILENAME), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['key', 'pareto', 'scored'] +
+                            self._getSweptNames() +
+                            ['cc_mask', 'molprobity_score', 'filename'])
+            for result in results:
+                key = getSettingsKey(result['settings'])
+                writer.writerow([key, int(key in front),
+                                 int(isScored(result))] +
+                                [result['settings'][name]
+                                 for name in self._getSweptNames()] +
+                                [result['cc_mask'],
+                                 result['molprobity_score'],
+                                 self._getPointPath(key, result['filename'])])
+
+        outputSet = self._createSetOfPDBs()
+        for result in results:
+            key = getSettingsKey(result['settings'])
+            if key not in front:
+                continue
+            atomStruct = AtomStruct()
+            atomStruct.setFileName(self._getPointPath(key,
+                                                      result['filename']))
+            atomStruct.setVolume(self._getInputVolume())
+            atomStruct.settings = String(json.dumps(result['settings'],
+                                                    sort_keys=True))
+            atomStruct.ccMask = Float(result['cc_mask'])
+            atomStruct.molprobityScore = Float(result['molprobity_score'])
+            outputSet.append(atomStruct)
+        self._defineOutputs(outputAtomStructs=outputSet)
+        self._defineSourceRelation(self.inputStructure, outputSet)
+        self._defineSourceRelation(self._getInputVolume(), outputSet)
+
+    # --------------------------- INFO functions ---------------------------
+    def _validate(self):
+        errors = self.validateBase(REALSPACEREFINE, 'REALSPACEREFINE')
+        if self._getInputVolume() is None:
+            errors.append("Error: You should provide a volume.\n")
+        try:
+            self._parseSweep()
+        except ValueError as e:
+            errors.append(str(e))
+            return errors
+        if not self._getSweepPoints():
+            errors.append("Every combination has all the run modes off.")
+        return errors
+
+    def _summary(self):
+        fileName = self._getExtraPath(SWEEPFILENAME)
+        if not os.path.exists(fileName):
+            return ["Sweep not finished yet."]
+        with open(fileName) as f:
+            rows = list(csv.DictReader(f))
+        summary = ["%d combinations refined, Pareto-optimal settings "
+                   "(CC_mask, MolProbity score):" % len(rows)]
+        for row in rows:
+            if row['pareto'] == '1':
+                summary.append("%s: %s, %s" % (
+                    ', '.join('%s=%s' % (name, row[name])
+                              for name in self._getSweptNames()),
+                    row['cc_mask'], row['molprobity_score']))
+        return summary
+
+    # --------------------------- UTILS functions --------------------------
+    def _parseSweep(self):
+        """ Values of the swept settings, as {name: list of values} """
+        try:
+            resolutions = [float(word) for word in
+                           self.sweepResolutions.get('').split()]
+            macroCycles = [int(word) for word in
+                           self.sweepMacroCycles.get('').split()]
+        except ValueError:
+            raise ValueError("Resolutions and macro cycles must be numbers "
+                             "separated by spaces.")
+        values = collections.OrderedDict()
+        values['resolution'] = resolutions or [self.resolution.get()]
+        values['macroCycles'] = macroCycles or [self.macroCycles.get()]
+        for name in self.sweepRunModes.get('').split():
+            if name not in RUN_MODES:
+                raise ValueError("Unknown run mode %s, it must be one of: "
+                                 "%s" % (name, ' '.join(RUN_MODES)))
+            values[name] = [False, True]
+        return values
+
+    def _getSweptNames(self):
+        return list(self._parseSweep())
+
+    def _getSweepPoints(self):
+        """ Settings of every combination to refine: the swept values plus
+        the run modes that are not swept """
+        values = self._parseSweep()
+        fixed = dict((name, getattr(self, name).get()) for name in RUN_MODES
+                     if name not in values)
+        points = []
+        for combination in itertools.product(*values.values()):
+            settings = dict(fixed)
+            settings.update(zip(values, combination))
+            if any(settings[name] for name in RUN_MODES):
+                points.append(settings)
+        if self.sweepMode == SWEEP_RANDOM:
+            # a fixed order, so that larger samples extend smaller ones
+            random.Random(self.randomSeed.get()).shuffle(points)
+            points = points[:self.numberOfSamples.get()]
+        return points
+
+    def _getPointPath(self, key, *paths):
+        return self._getExtraPath(POINTFOLDER % key, *paths)
+
+    def _getInputsKey(self):
+        """ Checksums of the model and map a point was refined from, the
+        parameters of the form that are not swept, the crop of the map
+        (padding in Angstrom) and the PHENIX version """
+        cropPadding = self.cropPadding.get() if self.cropMap else None
+        return [hashFile(self.inputStructure.get().getFileName()),
+                hashFile(self._getInputVolume().getFileName()),
+                self.doSecondary.get(), self.extraParams.get(),
+                cropPadding, Plugin.getPhenixVersion()]
+
+    def _reusePoint(self, key):
+        """ Copy the finished point of the previous sweep with these
+        settings and the same inputs. Returns False if there is none """
+        previous = self.previousSweep.get()
+        if previous is None:
+            return False
+        previousDir = previous._getPointPath(key)
+        resultFile = os.path.join(previousDir, RESULTFILENAME)
+        if not os.path.exists(resultFile):
+            return False
+        with open(resultFile) as f:
+            result = json.load(f)
+        if result.get('inputs') != self._getInputsKey():
+            return False
+        pointDir = self._getPointPath(key)
+        pwutils.cleanPath(pointDir)
+        shutil.copytree(previousDir, pointDir)
+        return True
+
+    def _readResults(self):
+        """ Results of the finished points of this sweep """
+        results = []
+        for settings in self._getSweepPoints():
+            resultFile = self._getPointPath(getSettingsKey(settings),
+                                            RESULTFILENAME)
+            if os.path.exists(resultFile):
+                with open(resultFile) as f:
+                    results.append(json.load(f))
+        return results
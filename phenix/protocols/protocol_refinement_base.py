@@ -1,18 +1,22 @@
 
 import os
+import threading
 
 from pyworkflow import Config
-from pyworkflow.object import Float, Integer
+from pyworkflow.object import Float, Integer, Set
+from pwem.objects import SetOfAtomStructs
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol.params import (PointerParam, FloatParam, \
-    StringParam)
-from phenix.constants import (PHENIXVERSION)
-from pwem.convert.headers import Ccp4Header
+    StringParam, BooleanParam)
+from phenix.constants import (CROP_PADDING, PHENIXVERSION)
 from phenix import Plugin
+from phenix.convert import convertVolume, cropMapToModel
+from phenix.worker import PhenixWorkerError
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 import collections
 import json
 
+OUTPUTSETFILENAME = 'atomStructs.sqlite'  # refined models (streaming)
 
 
 class PhenixProtRunRefinementBase(EMProtocol):
@@ -27,6 +31,10 @@ atomic structure derived from a cryo-EM density map.
     MOLPROBITYPKLFILENAME = 'molprobity.pkl'
     SUMMARYFILENAME = 'validationSummary.txt'
 
+    def __init__(self, **kwargs):
+        super(PhenixProtRunRefinementBase, self).__init__(**kwargs)
+        # parallel steps update the streaming output
+        self._outputLock = threading.Lock()
 
     # --------------------------- DEFINE param functions -------------------
     def _defineParams(self, form):
@@ -53,6 +61,21 @@ atomic structure derived from a cryo-EM density map.
                       help="Set the atomic structure to be processed.\n"
                            "Supported formats are PDB or mmCIF; this last one"
                            " is especially useful for very large structures.")
+        form.addParam('cropMap', BooleanParam, default=False,
+                      label='Crop the map around the model?',
+                      help="Give PHENIX only the part of the map around the "
+                           "atomic structure (its bounding box plus a "
+                           "padding). PHENIX runtime and memory use grow "
+                           "with the number of voxels, so this speeds up "
+                           "the processing of models that only cover a small "
+                           "part of the map (e.g. a domain of a large "
+                           "complex).\nThe map is not cropped if it comes "
+                           "with half maps.")
+        form.addParam('cropPadding', FloatParam, default=CROP_PADDING,
+                      condition='cropMap',
+                      label='Padding (A)',
+                      help="Margin added around the atomic structure, in "
+                           "Angstrom.")
         form.addParam('extraParams', StringParam,
                        label="Extra Params ",
                        default="",
@@ -66,11 +89,13 @@ atomic structure derived from a cryo-EM density map.
         """ convert 3D maps to MRC '.mrc' format
         """
         vol = self._getInputVolume()
-        inVolName = vol.getFileName()
         newFn = self._getExtraPath(tmpMapFileName)
-        origin = vol.getOrigin(force=True).getShifts()
-        sampling = vol.getSamplingRate()
-        Ccp4Header.fixFile(inVolName, newFn, origin, sampling, Ccp4Header.START)  # ORIGIN
+        convertVolume(vol, newFn)
+        # half maps are given to PHENIX as they are, so the map can only be
+        # cropped when there are none
+        if self.cropMap and not vol.getHalfMaps():
+            cropMapToModel(newFn, self.inputStructure.get().getFileName(),
+                           self.cropPadding.get())
 
 
     def _summary(self):
@@ -126,6 +151,47 @@ atomic structure derived from a cryo-EM density map.
 
     # --------------------------- UTILS functions --------------------------
 
+    def _getRefineThreads(self):
+        """ PHENIX threads of every refinement run as a parallel step """
+        if self.numberOfMpi.get() > 1:
+            return self.numberOfThreads.get()
+        return 1
+
+    def _loadOutputSet(self, create=False):
+        """ Return the streaming set of refined models,
+        or None if there is none and create is False. """
+        setFile = self._getPath(OUTPUTSETFILENAME)
+        if os.path.exists(setFile) and os.path.getsize(setFile) > 0:
+            outputSet = SetOfAtomStructs(filename=setFile)
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+        elif create:
+            outputSet = SetOfAtomStructs(filename=setFile)
+            outputSet.setStreamState(outputSet.STREAM_OPEN)
+        else:
+            outputSet = None
+        return outputSet
+
+    def _appendToOutput(self, atomStruct):
+        """ Add a refined model to the streaming output as soon as it is
+        finished """
+        with self._outputLock:
+            outputSet = self._loadOutputSet(create=True)
+            outputSet.append(atomStruct)
+            self._updateOutputSet('outputAtomStructs', outputSet,
+                                  Set.STREAM_OPEN)
+
+    def _closeOutput(self):
+        """ Close the streaming output. False if nothing was added to
+        it """
+        with self._outputLock:
+            outputSet = self._loadOutputSet()
+            if outputSet is None:
+                return False
+            self._updateOutputSet('outputAtomStructs', outputSet,
+                                  Set.STREAM_CLOSED)
+        return True
+
     def _getInputVolume(self):
         if self.inputVolume.get() is None:
             fnVol = self.inputStructure.get().getVolume()
@@ -134,27 +200,61 @@ atomic structure derived from a cryo-EM density map.
         return fnVol
 
     def _parseFile(self, fileName):
+        for name, value in self._readMolprobityFile(fileName).items():
+            setattr(self, name, value)
+
+    def _readMolprobityFile(self, fileName):
+        """ Statistics of a molprobity.out file, as {attribute name:
+        Float or Integer} """
+        values = collections.OrderedDict()
         with open(fileName, encoding = "ISO-8859-1") as f:
             line = f.readline()
             while line:
                 words = line.strip().split()
                 if len(words) > 1:
                     if (words[0] == 'Ramachandran' and words[1] == 'outliers'):
-                        self.ramachandranOutliers = Float(words[3])
+                        values['ramachandranOutliers'] = Float(words[3])
                     elif (words[0] == 'favored' and words[1] == '='):
-                        self.ramachandranFavored = Float(words[2])
+                        values['ramachandranFavored'] = Float(words[2])
                     elif (words[0] == 'Rotamer' and words[1] == 'outliers'):
-                        self.rotamerOutliers = Float(words[3])
+                        values['rotamerOutliers'] = Float(words[3])
                     elif (words[0] == 'C-beta' and words[1] == 'deviations'):
-                        self.cbetaOutliers = Integer(words[3])
+                        values['cbetaOutliers'] = Integer(words[3])
                     elif (words[0] == 'Clashscore' and words[1] == '='):
-                        self.clashscore = Float(words[2])
+                        values['clashscore'] = Float(words[2])
                     elif (words[0] == 'MolProbity' and words[1] == 'score'):
-                        self.overallScore = Float(words[3])
+                        values['overallScore'] = Float(words[3])
                 line = f.readline()
+        return values
 
 
     def _readValidationPklFile(self, fileName):
+        attributes = [
+            ('Rhama_Outliers', 'model.geometry.ramachandran.outliers'),
+            ('Rhama_Favored', 'model.geometry.ramachandran.favored'),
+            ('Rota_Outliers', 'model.geometry.rotamer.outliers'),
+            ('Cbeta_Outliers_n', 'model.geometry.c_beta.cbetadev.n_outliers'),
+            ('Clash_score', 'model.geometry.clash.score'),
+            ('MolProbity_score', 'model.geometry.molprobity_score')]
+        try:
+            # ask the phenix.python worker of this session
+            dictSummary = collections.OrderedDict(
+                Plugin.getPhenixWorker().getPickleAttributes(fileName,
+                                                             attributes))
+        except PhenixWorkerError:
+            dictSummary = self._readValidationPklFileScript(fileName,
+                                                            attributes)
+
+        self.ramachandranOutliers = Float(dictSummary['Rhama_Outliers'])
+        self.ramachandranFavored = Float(dictSummary['Rhama_Favored'])
+        self.rotamerOutliers = Float(dictSummary['Rota_Outliers'])
+        self.cbetaOutliers = Integer(dictSummary['Cbeta_Outliers_n'])
+        self.clashscore = Float(dictSummary['Clash_score'])
+        self.overallScore = Float(dictSummary['MolProbity_score'])
+
+    def _readValidationPklFileScript(self, fileName, attributes):
+        """ Fallback of _readValidationPklFile that launches a new
+        phenix.python interpreter. """
         self.SUMMARYFILENAME = self._getTmpPath(self.SUMMARYFILENAME)
         command = """import pickle
 import collections
@@ -168,13 +268,9 @@ def pickleData(file):
 data = pickleData('{VALIDATIONCRYOEMPKLFILENAME}')
 dictSummary = collections.OrderedDict()
 
-dictSummary['Rhama_Outliers'] = data.model.geometry.ramachandran.outliers
-dictSummary['Rhama_Favored'] = data.model.geometry.ramachandran.favored
-dictSummary['Rota_Outliers'] = data.model.geometry.rotamer.outliers
-dictSummary['Cbeta_Outliers_n'] = data.model.geometry.c_beta.cbetadev.n_outliers
-dictSummary['Clash_score'] = data.model.geometry.clash.score
-dictSummary['MolProbity_score'] = data.model.geometry.molprobity_score
 """.format(VALIDATIONCRYOEMPKLFILENAME=fileName)
+        for key, path in attributes:
+            command += "dictSummary['%s'] = data.%s\n" % (key, path)
 
         command += """with open('%s',"w") as f:
     f.write(json.dumps(dictSummary))
@@ -192,17 +288,10 @@ dictSummary['MolProbity_score'] = data.model.geometry.molprobity_score
         with open(self.SUMMARYFILENAME, "r") as f:
             dictSummary = f.read()
 
-        dictSummary = json.loads(
+        return json.loads(
             dictSummary, object_pairs_hook=collections.OrderedDict)
 
-        self.ramachandranOutliers = Float(dictSummary['Rhama_Outliers'])
-        self.ramachandranFavored = Float(dictSummary['Rhama_Favored'])
-        self.rotamerOutliers = Float(dictSummary['Rota_Outliers'])
-        self.cbetaOutliers = Integer(dictSummary['Cbeta_Outliers_n'])
-        self.clashscore = Float(dictSummary['Clash_score'])
-        self.overallScore = Float(dictSummary['MolProbity_score'])
-
-    def _writeArgsMolProbity(self, atomStruct, vol=None):
+    def _writeArgsMolProbity(self, atomStruct, vol=None, numberOfThreads=None):
         args = ""
         args += atomStruct
         if Plugin.getPhenixVersion() == PHENIXVERSION:
@@ -212,7 +301,8 @@ dictSummary['MolProbity_score'] = data.model.geometry.molprobity_score
             args += " "
             args += " d_min=%f" % self.resolution.get()
         args += " "
-        numberOfThreads = self.numberOfThreads.get()
+        if numberOfThreads is None:
+            numberOfThreads = self.numberOfThreads.get()
         if numberOfThreads > 1:
             args += " nproc=%d" % numberOfThreads
         return args
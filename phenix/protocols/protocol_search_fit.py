@@ -22,15 +22,23 @@
 # *
 # **************************************************************************
 
+import collections
+import math
 import os
-import re
 import sqlite3
 import glob
 import json
+import shlex
+import threading
+import time
 
+import numpy as np
+import psutil
 from pwem.objects import AtomStruct
+from pyworkflow.object import Float, Integer, String
 from pyworkflow.protocol.params import (StringParam,  IntParam,
-                                        PointerParam, BooleanParam)
+                                        PointerParam, BooleanParam,
+                                        EnumParam, FloatParam)
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from .protocol_refinement_base import PhenixProtRunRefinementBase
 from pwem.convert.atom_struct import AtomicStructHandler
@@ -40,23 +48,52 @@ from phenix import Plugin
 from ccp4 import Plugin as PluginCCP4
 from ccp4.convert import (runCCP4Program)
 from ccp4.constants import CCP4_BINARIES
-from phenix.constants import (REALSPACEREFINE,
+from phenix.constants import (REALSPACEREFINE, REALSPACEREFINE_MODULE,
                               PHENIXVERSION19,
                               PHENIXVERSION20)
 from pwem.convert.atom_struct import retry
+from phenix.jobqueue import (FAILED, FINISHED, PENDING, JobQueue,
+                             JobWatchdog, JobLimitExceeded, findChildren)
+from phenix.worker import PhenixScriptError, PhenixWorkerError
+from phenix.cache import FileArchive, hashFile
+from phenix.convert import RSR_LOG_METRICS, parseRSRefineLog, scoreWindows
 
 COOT = CCP4_BINARIES['COOT']
-COOTSCRIPTFILENAME = "cootScript.py"
+COOTSCRIPTFILENAME = "cootScript_%03d.py" # chunk
 COOTPDBTEMPLATEFILENAME = "coot_%06d_Imol_%04d_version_%04d.pdb" # protId, modelID, counter
 COOTPDBTEMPLATEFILENAMEINV = "coot_%06d_Imol_%04d_version_%04d_inv.pdb" # protId, modelID, counter
 DATAFILE = 'db.sqlite3'
 TABLE = 'myTable'
+ROUNDTABLE = 'roundTable'  # model_to_map_fit of every round of every job
+CHUNKTABLE = 'chunkTable'  # state of the parallel mutation chunks
+SUMMARYTABLE = 'summaryTable'  # count, sum and sum of squares per round
+TOPTABLE = 'topTable'  # best TOPSIZE results of every round
+TOPSIZE = 1000
+FRAGMENTTABLE = 'fragmentTable'  # chains searched by the protocol
+WINDOWSARCHIVE = 'windows'  # zip files of the windows that are not kept
+PRUNE_INTERVAL = 20  # refinements of a worker between archive updates
+CC_MASK_PATTERN = RSR_LOG_METRICS['cc_mask']
+# job table columns with the other metrics of the refinement logs
+LOG_COLUMNS = [name for name in RSR_LOG_METRICS if name != 'cc_mask']
+POLLING_TIME = 10  # seconds between checks for new mutated windows
+WORKER_MAX_RUNS = 100  # refinements before a phenix.python worker is renewed
+SEARCH_EXHAUSTIVE = 0
+SEARCH_HALVING = 1
+# threading directions (column direction) and the option with both
+FORWARD = 0
+REVERSE = 1
+BOTH_DIRECTIONS = 2
+DIRECTIONNAMES = ['forward', 'reverse']
+PRESCREEN_NONE = 0
+PRESCREEN_SKIP = 1
+PRESCREEN_DEFER = 2
 
 class PhenixProtSearchFit(PhenixProtRunRefinementBase):
     """given a chain of n alanines, a 3D map and
     a sequence search for the subsequence of n aminoacids
-    that better fits in the density. Only works if the
-    atomic structure has a single chain
+    that better fits in the density. Several chains (of the
+    atomic structure or of a set of fragments) can be searched
+    at the same time, sharing the refinement workers
     """
     _label = 'search fit'
     _program = ""
@@ -66,6 +103,9 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
     def __init__(self, **kwargs):
         super(PhenixProtSearchFit, self).__init__(**kwargs)
         self.stepsExecutionMode = STEPS_PARALLEL
+        # the first refinement worker checks what a previous run left
+        self._resumeLock = threading.Lock()
+        self._resumed = False
 
     # --------------------------- DEFINE param functions -------------------
     def _defineParams(self, form):
@@ -74,16 +114,111 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
         param.default.set(1)
         param = form.getParam('inputStructure')
         param.help.set('Alanine chain used as template')
+        form.addParam('searchAllChains', BooleanParam, default=False,
+                      label='Search every chain',
+                      help="Search the windows of every chain of the "
+                           "template, each one on its own. Otherwise only "
+                           "its first chain is used.")
+        form.addParam('inputFragments', PointerParam,
+                      pointerClass="SetOfAtomStructs", allowsNull=True,
+                      label='Additional fragments',
+                      help="Every chain of these atomic structures is "
+                           "searched too. All the windows of every chain "
+                           "go to the same queue, so a single run keeps "
+                           "every worker busy. Results are kept per "
+                           "chain.")
         form.addParam('inputSequence', PointerParam, pointerClass="Sequence",
                          label='Test sequence', important=True,
                          help="Input the aminoacid sequence to fit with the "
                               "ALA chain.")
+        form.addParam('threadingDirection', EnumParam,
+                      choices=DIRECTIONNAMES + ['both'],
+                      default=FORWARD,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Threading direction',
+                      help="forward: the sequence is threaded from the "
+                           "first to the last residue of the chain.\n"
+                           "reverse: from the last to the first one, for "
+                           "fragments traced in the opposite direction.\n"
+                           "both: the windows of both directions go to the "
+                           "same queue and compete in the search; results "
+                           "are tagged with their direction.")
         form.addParam('residues', StringParam, important=True,
                       label='Residues',
                       help='Select the first and last residues of the sequence fragment '
                            'that you would like to consider (Use Ctrl for multiple selection).\n The sequence '
                            'should overlap total or partially the ALA chain.')
 
+        group = form.addGroup('Windows')
+        group.addParam('windowStride', IntParam, default=1,
+                       label="Stride",
+                       help="Distance (in residues) between the first "
+                            "residues of consecutive sequence windows. "
+                            "With a stride k only one window out of k is "
+                            "refined.")
+        group.addParam('windowOffsets', StringParam, default='',
+                       label="Offsets",
+                       expertLevel=LEVEL_ADVANCED,
+                       help="Refine only the windows starting at these "
+                            "offsets from the first selected residue "
+                            "(0 is the first one), e.g. '0 4 10-15'. "
+                            "Empty: use the stride.")
+        group.addParam('refineAroundHits', BooleanParam, default=False,
+                       condition='windowStride > 1',
+                       label="Refine around the best hits",
+                       help="After the windows given by the stride (or the "
+                            "offsets) are refined, every window within "
+                            "stride - 1 residues of the best ones is "
+                            "refined too, so the search costs about 1/k of "
+                            "the exhaustive one and still finds its "
+                            "optimum when the fit changes smoothly with "
+                            "the offset.")
+        group.addParam('numberOfHits', IntParam, default=3,
+                       condition='windowStride > 1 and refineAroundHits',
+                       label="Number of hits",
+                       help="Number of best windows of the first pass "
+                            "whose neighbourhood is refined.")
+        group.addParam('keepTopWindows', IntParam, default=0,
+                       label="Windows kept unpacked",
+                       expertLevel=LEVEL_ADVANCED,
+                       help="While the search runs, the files of every "
+                            "window (Coot model, logs, geometry "
+                            "restraints...) except those of the best ones "
+                            "of each chain are moved to compressed archives "
+                            "(extra/%s), so large searches do not fill the "
+                            "disk with thousands of files. The refined "
+                            "models of the streaming output are always "
+                            "kept. The viewer and the protocol extract the "
+                            "archived files when needed. "
+                            "0 keeps every file." % WINDOWSARCHIVE)
+        group = form.addGroup('Pre-screen')
+        group.addParam('prescreenMode', EnumParam,
+                       choices=['none', 'skip', 'refine last'],
+                       default=PRESCREEN_NONE,
+                       display=EnumParam.DISPLAY_HLIST,
+                       label="Pre-screen windows",
+                       help="Before any refinement, every window is scored "
+                            "with the map density interpolated at its side "
+                            "chain atoms (in standard deviations of the "
+                            "map), which takes a fraction of a second for "
+                            "all of them. Windows scoring below the "
+                            "percentile below (among those of the same "
+                            "chain) are not refined (skip) or refined "
+                            "after all the others (refine last).\n"
+                            "Refinement starts when all the windows "
+                            "have been created.")
+        group.addParam('prescreenPercentile', FloatParam, default=50,
+                       condition='prescreenMode!=%d' % PRESCREEN_NONE,
+                       label="Percentile",
+                       help="Windows whose pre-screen score is below this "
+                            "percentile are skipped or refined last.")
+        form.addParam('mutateChunks', IntParam, default=4,
+                      label="Parallel Coot processes",
+                      expertLevel=LEVEL_ADVANCED,
+                      help="The sequence windows are created by this number "
+                           "of Coot processes running at the same time. "
+                           "Refinement starts as soon as the first windows "
+                           "are created.")
         form.addParam('extraCommands', StringParam,
                        label="Extra Params ",
                        default="",
@@ -185,96 +320,316 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
                             "phenix.refine uses Reduce to identify Asn, Gln, and "
                             "His residues that should be flipped, and then flips "
                             "them automatically.")
+        form.addParam('batchRefine', BooleanParam, default=False,
+                      label="Refine in persistent PHENIX processes",
+                      expertLevel=LEVEL_ADVANCED,
+                      help="Each refinement worker runs real_space_refine "
+                           "inside a phenix.python process that is kept "
+                           "alive between windows, so PHENIX start up and "
+                           "map reading are paid once instead of once per "
+                           "window. Outputs are the same as with the "
+                           "command line, which is used when this mode is "
+                           "not available (PHENIX older than 1.19).")
+        group = form.addGroup('Limits per window')
+        group.addParam('maxJobTime', FloatParam, default=0,
+                       label="Maximum time (min)",
+                       expertLevel=LEVEL_ADVANCED,
+                       help="Refinements of a single window that run for "
+                            "longer are killed, so that a pathological "
+                            "window (e.g. a clash explosion after the "
+                            "mutation) does not keep a worker busy while "
+                            "the others are idle. 0 means no limit.")
+        group.addParam('maxJobMemory', FloatParam, default=0,
+                       label="Maximum memory (GB)",
+                       expertLevel=LEVEL_ADVANCED,
+                       help="Refinements of a single window whose "
+                            "processes use more resident memory are "
+                            "killed. With persistent PHENIX processes the "
+                            "memory of the process (including the map it "
+                            "keeps) is counted. 0 means no limit.")
+        group.addParam('retryKilledJobs', BooleanParam, default=True,
+                       label="Retry killed windows with a cheap refinement",
+                       expertLevel=LEVEL_ADVANCED,
+                       help="A window killed because of the limits above is "
+                            "queued again once with a single macro cycle of "
+                            "global minimization. Otherwise (or if it is "
+                            "killed again) it is marked as failed in the job "
+                            "table together with the reason.")
+        group = form.addGroup('Search strategy')
+        group.addParam('searchMode', EnumParam,
+                       choices=['exhaustive', 'successive halving'],
+                       default=SEARCH_EXHAUSTIVE,
+                       display=EnumParam.DISPLAY_HLIST,
+                       label="Search mode",
+                       help="exhaustive: every sequence window is refined "
+                            "with the options above.\n"
+                            "successive halving: every window is first "
+                            "scored with a cheap refinement (a single macro "
+                            "cycle of global minimization), then only the "
+                            "best ones are promoted to more expensive "
+                            "rounds, and the finalists get the refinement "
+                            "defined above.")
+        group.addParam('numberOfRounds', IntParam, default=3,
+                       condition='searchMode==%d' % SEARCH_HALVING,
+                       label="Number of rounds",
+                       help="Rounds of the search, including the cheap first "
+                            "one and the final one. Intermediate rounds use "
+                            "the run options above with a proportional "
+                            "number of macro cycles.")
+        group.addParam('promotedFraction', FloatParam, default=0.25,
+                       condition='searchMode==%d' % SEARCH_HALVING,
+                       label="Fraction promoted",
+                       help="Fraction of the windows of a round (ranked by "
+                            "model-to-map fit) that go to the next round.")
         form.addParallelSection(threads=0, mpi=1)
 
 
     # --------------------------- INSERT steps functions ---------------
     def _insertAllSteps(self):
-        # compute alanine atom struct len
-        inputPdb = self.inputStructure.get().getFileName()
-        atomStruct = AtomicStructHandler(inputPdb)
-        # we assume that there is a single model and a single chain
-        atomStructSize = sum(1 for _ in atomStruct.getStructure().get_residues())
-        chainName = next(atomStruct.getStructure().get_chains()).get_id()
-        firstAAinChain = next(atomStruct.getStructure().get_residues()).id[1]
+        # the chains to search (fragments) are read by createTableStep,
+        # not here, and share every step: the windows of all of them go
+        # to the same job queue
 
         # starting and ending residue
         firstaa, lastaa = self.getIdxRemoveResidues()
 
         # compute number of steps according to the sequence size
         numberOfSteps = lastaa - firstaa + 1
+        offsets = self._getWindowOffsets(numberOfSteps)
 
         # steps
         prepareId = self._insertFunctionStep('convertInputStep', self.FITTEDFILE)
-        # mutateChain
-        mutateId = self._insertFunctionStep('mutateStep',
-                                            firstaa,  # in seq
-                                            firstAAinChain,  # in struct
-                                            atomStructSize,
-                                            chainName,
-                                            numberOfSteps,
-                                            prerequisites=[prepareId])
-        refineIdList = []
-        numberOfThreads = self.numberOfMpi.get()
-        for start in range(numberOfThreads):
-            refineId = self._insertFunctionStep('refineStep2',
-                                                prerequisites=[mutateId])
-            refineIdList.append(refineId)
+        # no more chunks than parallel steps, so that waiting refinement
+        # workers never take the place of a chunk
+        numberOfChunks = max(1, min(self.mutateChunks.get(),
+                                    self.numberOfMpi.get(), len(offsets)))
+        tableId = self._insertFunctionStep('createTableStep', numberOfChunks,
+                                           prerequisites=[prepareId])
+        # mutateChain: the windows are split in chunks mutated by
+        # parallel coot processes
+        chunkSize = int(math.ceil(float(len(offsets)) / numberOfChunks))
+        mutateIdList = []
+        for chunk in range(numberOfChunks):
+            mutateId = self._insertFunctionStep('mutateStep',
+                                     chunk,
+                                     firstaa,  # in seq
+                                     offsets[chunk * chunkSize:
+                                             (chunk + 1) * chunkSize],
+                                     prerequisites=[tableId])
+            mutateIdList.append(mutateId)
+        if self.prescreenMode != PRESCREEN_NONE:
+            prescreenId = self._insertFunctionStep('prescreenStep',
+                                                   prerequisites=mutateIdList)
+            refineIdList = self._insertRefineSteps([prescreenId])
+        else:
+            # refinement starts as soon as the first windows are mutated
+            refineIdList = self._insertRefineSteps([tableId])
+        if self._isRefiningAroundHits():
+            densifyId = self._insertFunctionStep('densifyStep',
+                                                 numberOfChunks,
+                                                 firstaa,
+                                                 numberOfSteps,
+                                                 prerequisites=refineIdList)
+            refineIdList = self._insertRefineSteps([densifyId])
+        for searchRound in range(1, self._getNumberOfRounds()):
+            promoteId = self._insertFunctionStep('promoteStep',
+                                                 searchRound,
+                                                 prerequisites=refineIdList)
+            refineIdList = self._insertRefineSteps([promoteId])
 
         self._insertFunctionStep('createOutputStep', prerequisites=refineIdList)
 
+    def _insertRefineSteps(self, prerequisites):
+        """ A refinement worker per parallel step """
+        return [self._insertFunctionStep('refineStep2',
+                                         prerequisites=prerequisites)
+                for _ in range(self.numberOfMpi.get())]
+
     # --------------------------- STEPS functions --------------------------
 
 
     def createTable(self):
-        """ Create table and clean it if needed"""
+        """ Create table (or update the one of a previous run) """
+        self._getJobQueue().create(finishedCondition='model_to_map_fit != -1')
         conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)))
-        c = conn.cursor()
-        create_table_sql = """CREATE TABLE IF NOT EXISTS %s (   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                                                  filename TEXT,
-                                                                  done int DEFAULT 0,
-                                                                  model_to_map_fit float DEFAULT -1,
-                                                                  phenix_id TEXT default ''
-                                                                  )""" % TABLE
-        print("create_table_sql", create_table_sql)
-        c.execute(create_table_sql)
-        c.close()
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            job_id int,
+                            search_round int,
+                            model_to_map_fit float,
+                            phenix_id TEXT default ''
+                            )""" % ROUNDTABLE)
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+                            id INTEGER PRIMARY KEY,
+                            filename TEXT,
+                            chain TEXT,
+                            first_residue int,
+                            size int,
+                            label TEXT
+                            )""" % FRAGMENTTABLE)
+        # running aggregates, so that viewers do not scan the results
+        summaryColumns = [row[1] for row in conn.execute(
+            "PRAGMA table_info(%s)" % SUMMARYTABLE)]
+        newSummary = 'direction' not in summaryColumns
+        if newSummary:  # missing or made by an older version
+            conn.execute("DROP TABLE IF EXISTS %s" % SUMMARYTABLE)
+            conn.execute("DROP TABLE IF EXISTS %s" % TOPTABLE)
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+                            search_round int,
+                            fragment int,
+                            direction int,
+                            count int DEFAULT 0,
+                            sum float DEFAULT 0,
+                            sum2 float DEFAULT 0,
+                            PRIMARY KEY (search_round, fragment, direction)
+                            )""" % SUMMARYTABLE)
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            job_id int,
+                            search_round int,
+                            fragment int,
+                            direction int,
+                            model_to_map_fit float
+                            )""" % TOPTABLE)
+        conn.execute("CREATE INDEX IF NOT EXISTS %s_fit ON %s("
+                     "search_round, fragment, direction, model_to_map_fit)"
+                     % (TOPTABLE, TOPTABLE))
+        if newSummary:
+            # results of a run made before these tables existed
+            for jobId, searchRound, fragment, direction, fit in conn.execute(
+                    """SELECT id, search_round, fragment, direction,
+                              model_to_map_fit
+                       FROM %s WHERE model_to_map_fit != -1"""
+                    % TABLE).fetchall():
+                self._updateSummary(conn, jobId, searchRound, fragment,
+                                    direction, fit)
+        conn.commit()
         conn.close()
 
-    def mutateStep(self, firstaa, firstAAinChain,
-                   atomStructSize,
-                   chainName,
-                   numberOfSteps):
-        """ mutate atom struct inputStructure using
-           aa in sequence  inputSequence starting at firstaa"""
-        scriptFile = self._getExtraPath(COOTSCRIPTFILENAME)
+    def _updateSummary(self, conn, jobId, searchRound, fragment, direction,
+                       modelToMapFit):
+        """ Add a result to the aggregates of its round, fragment and
+        direction, within the transaction that records it """
+        group = (searchRound, fragment, direction)
+        conn.execute("""INSERT OR IGNORE INTO %s(search_round, fragment,
+                                                 direction)
+                        VALUES(?, ?, ?)""" % SUMMARYTABLE, group)
+        conn.execute("""UPDATE %s SET count=count+1, sum=sum+?, sum2=sum2+?
+                        WHERE search_round=? AND fragment=? AND direction=?"""
+                     % SUMMARYTABLE,
+                     (modelToMapFit, modelToMapFit ** 2) + group)
+        # bounded top list: insert and drop whatever falls out of it
+        conn.execute("""INSERT INTO %s(job_id, search_round, fragment,
+                                       direction, model_to_map_fit)
+                        VALUES(?, ?, ?, ?, ?)""" % TOPTABLE,
+                     (jobId,) + group + (modelToMapFit,))
+        conn.execute("""DELETE FROM %s WHERE id IN (
+                            SELECT id FROM %s
+                            WHERE search_round=? AND fragment=? AND direction=?
+                            ORDER BY model_to_map_fit DESC
+                            LIMIT -1 OFFSET ?)""" % (TOPTABLE, TOPTABLE),
+                     group + (TOPSIZE,))
+
+    def createTableStep(self, numberOfChunks):
+        """ Create the job table, store the fragments to search and
+        create the table where mutation chunks report they have finished """
+        self.createTable()
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)))
+        conn.execute("DELETE FROM %s" % FRAGMENTTABLE)
+        conn.executemany("""INSERT INTO %s(id, filename, chain, first_residue,
+                                           size, label)
+                            VALUES(?, ?, ?, ?, ?, ?)""" % FRAGMENTTABLE,
+                         [(fragment,) + values for fragment, values
+                          in enumerate(self._readFragments())])
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+                            id INTEGER PRIMARY KEY,
+                            done int DEFAULT 0
+                            )""" % CHUNKTABLE)
+        conn.execute("DELETE FROM %s" % CHUNKTABLE)
+        conn.executemany("INSERT INTO %s(id) VALUES(?)" % CHUNKTABLE,
+                         [(chunk,) for chunk in range(numberOfChunks)])
+        conn.commit()
+        conn.close()
+
+    def mutateStep(self, chunk, firstaa, offsets):
+        """ mutate every fragment (see createTableStep) using
+           aa in sequence  inputSequence starting at firstaa.
+           This chunk creates the windows starting at the given offsets
+           from firstaa and queues each one as soon as it is saved"""
+        fragments = self._getFragments()
+        self._mutateWindows(chunk, firstaa,
+                            [(fragment, direction, start)
+                             for start in offsets
+                             for fragment in sorted(fragments)
+                             for direction in self._getDirections()])
+
+    def _mutateWindows(self, chunk, firstaa, windows):
+        """ Create with coot the windows given as (fragment, direction,
+        offset) and queue them. Windows saved and queued by a previous
+        (interrupted) run are not created again """
+        fragments = self._getFragments()
+        database = os.path.abspath(self._getExtraPath(DATAFILE))
+        existing = self._getVerifiedMutants()
+        windows = [window for window in windows
+                   if os.path.abspath(self._getMutantFileName(*window))
+                   not in existing]
+        if not windows:
+            print("mutateStep: every window of chunk %d already exists"
+                  % chunk)
+            self._setChunkFinished(chunk)
+            return
+        scriptFile = self._getExtraPath(COOTSCRIPTFILENAME % chunk)
         f = open(scriptFile, "w")
-        fnAtomStruct = self.inputStructure.get().getFileName()
-        f.write("# read atom structure (pdb) file\n")
-        f.write("read_pdb('%s')\n" % os.path.abspath(fnAtomStruct))
+        f.write("# read atom structure (pdb) files, a molecule per fragment\n")
+        molecules = {}
+        for fragment in sorted(set(window[0] for window in windows)):
+            fnAtomStruct, chainName, _, _, _ = fragments[fragment]
+            if fnAtomStruct not in molecules:
+                molecules[fnAtomStruct] = "imol_%d" % len(molecules)
+                f.write("%s = read_pdb('%s')\n" % (molecules[fnAtomStruct],
+                                                   fnAtomStruct))
+            f.write("fragment_%d = new_molecule_by_atom_selection(%s, "
+                    "'//%s')\n" % (fragment, molecules[fnAtomStruct],
+                                   chainName))
         f.write("# mutation loop\n")
-        database = os.path.abspath(self._getExtraPath(DATAFILE))
+        f.write("import hashlib\n")
         f.write("import sqlite3\n")
-        f.write("conn = sqlite3.connect('%s')\n" % database)
+        f.write("def fileInfo(fileName):\n")
+        f.write("    data = open(fileName, 'rb').read()\n")
+        f.write("    return len(data), hashlib.sha256(data).hexdigest()\n")
+        f.write("conn = sqlite3.connect('%s', timeout=60)\n" % database)
         f.write("cur = conn.cursor()\n")
-        iMol = 0 # pdb id is  0 or 1 for inverse
-        startMut = firstAAinChain  # 1
-        endMut = firstAAinChain + atomStructSize -1
-        self.createTable()
+        # windows queued by a previous run whose file was lost are not
+        # queued twice, only their size and checksum are updated
+        command = "INSERT INTO %s(filename, window_offset, fragment, " \
+                  "direction) SELECT ?, ?, ?, ? " \
+                  "WHERE NOT EXISTS (SELECT 1 FROM %s WHERE filename=?)" \
+                  % (TABLE, TABLE)
+        checksum = "UPDATE %s SET mutant_size=?, mutant_sha256=? " \
+                   "WHERE filename=?" % TABLE
+        sequence = self.inputSequence.get().getSequence()
 
-        for start in range(numberOfSteps):
-            seq = self.inputSequence.get().getSequence()[firstaa + start : firstaa + start + atomStructSize]
-            f.write("mutate_residue_range(%d, '%s', %d, %d, '%s')\n" % (iMol,
-                                                                      chainName,
-                                                                      startMut,
-                                                                      endMut,
-                                                                      seq))
-            outFileName = self._getExtraPath(COOTPDBTEMPLATEFILENAME% (0,0,start))
-            f.write("save_coordinates(0, '%s')\n" % outFileName)
-            command = "INSERT INTO %s(filename) VALUES('%s')" % (TABLE,
-                                                                 os.path.abspath(outFileName)
-                                                                 )
-            f.write('cur.execute("%s")\n' % command)
+        for fragment, direction, start in windows:
+            _, chainName, firstAAinChain, atomStructSize, _ = \
+                fragments[fragment]
+            startMut = firstAAinChain  # 1
+            endMut = firstAAinChain + atomStructSize -1
+            seq = sequence[firstaa + start : firstaa + start + atomStructSize]
+            if direction == REVERSE:
+                # first residue of the window on the last one of the chain
+                seq = seq[::-1]
+            f.write("mutate_residue_range(fragment_%d, '%s', %d, %d, '%s')\n"
+                    % (fragment, chainName, startMut, endMut, seq))
+            outFileName = os.path.abspath(
+                self._getMutantFileName(fragment, direction, start))
+            f.write("save_coordinates(fragment_%d, '%s')\n"
+                    % (fragment, outFileName))
+            f.write('cur.execute("%s", (%r, %d, %d, %d, %r))\n'
+                    % (command, outFileName, start, fragment, direction,
+                       outFileName))
+            f.write('cur.execute("%s", fileInfo(%r) + (%r,))\n'
+                    % (checksum, outFileName, outFileName))
+            f.write("conn.commit()\n")
 
         if len(self.extraCommands.get()) > 0:
             f.write("\n#Extra Commands\n")
@@ -290,84 +645,409 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
         args += " -s %s" % scriptFile
         # run
         self._log.info('Launching: ' + PluginCCP4.getProgram(COOT) + ' ' + args)
-        runCCP4Program(PluginCCP4.getProgram(COOT), args)
+        try:
+            runCCP4Program(PluginCCP4.getProgram(COOT), args)
+        finally:
+            # even if coot failed, so that the refinement workers stop
+            # waiting for this chunk
+            self._setChunkFinished(chunk)
+
+    def _setChunkFinished(self, chunk):
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        conn.execute("UPDATE %s SET done=1 WHERE id=?" % CHUNKTABLE, (chunk,))
+        conn.commit()
+        conn.close()
+
+    def _getMutantFileName(self, fragment, direction, start):
+        template = COOTPDBTEMPLATEFILENAMEINV if direction == REVERSE \
+            else COOTPDBTEMPLATEFILENAME
+        return self._getExtraPath(template % (0, fragment, start))
+
+    def _getVerifiedMutants(self):
+        """ Names of the queued windows whose file made by coot is in the
+        archive or on disk with the size and checksum saved with it """
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        rows = conn.execute("SELECT filename, archived, mutant_size, "
+                            "mutant_sha256 FROM %s" % TABLE).fetchall()
+        conn.close()
+        return set(fileName for fileName, archived, size, sha in rows
+                   if archived or self._isFileValid(fileName, size, sha))
+
+    @staticmethod
+    def _isFileValid(fileName, size, sha):
+        """ True if the file exists with the given size and checksum (only
+        its existence is checked if they were not saved) """
+        if not os.path.exists(fileName) or os.path.getsize(fileName) == 0:
+            return False
+        if size is None or sha is None:
+            return True  # queued by an older version
+        return os.path.getsize(fileName) == size and hashFile(fileName) == sha
+
+    def densifyStep(self, numberOfChunks, firstaa, numberOfSteps):
+        """ Mutate and queue the windows around the best ones of the
+        first pass (of every fragment) that have not been refined yet """
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)))
+        radius = self.windowStride.get() - 1
+        windows = []
+        for fragment in sorted(self._getFragments()):
+            for direction in self._getDirections():
+                hits = [row[0] for row in conn.execute(
+                    """SELECT window_offset FROM %s
+                       WHERE search_round=0 AND done=? AND window_offset != -1
+                             AND fragment=? AND direction=?
+                       ORDER BY model_to_map_fit DESC LIMIT ?""" % TABLE,
+                    (FINISHED, fragment, direction,
+                     self.numberOfHits.get()))]
+                existing = set(row[0] for row in conn.execute(
+                    """SELECT window_offset FROM %s
+                       WHERE fragment=? AND direction=?""" % TABLE,
+                    (fragment, direction)))
+                offsets = sorted(set(offset for hit in hits
+                                     for offset in range(max(0, hit - radius),
+                                                         min(numberOfSteps,
+                                                             hit + radius + 1)))
+                                 - existing)
+                print("densifyStep: fragment %d %s, %d windows around "
+                      "offsets %s" % (fragment, DIRECTIONNAMES[direction],
+                                      len(offsets), hits))
+                windows += [(fragment, direction, offset)
+                            for offset in offsets]
+        if not windows:
+            # nothing left for a chunk of an interrupted run of this step
+            conn.execute("UPDATE %s SET done=1 WHERE id >= ?" % CHUNKTABLE,
+                         (numberOfChunks,))
+            conn.commit()
+            conn.close()
+            return
+        # a new chunk, so refinement workers wait for it (or the one left
+        # unfinished by an interrupted run of this step)
+        chunk, = conn.execute("SELECT MIN(id) FROM %s WHERE id >= ? AND "
+                              "done=0" % CHUNKTABLE,
+                              (numberOfChunks,)).fetchone()
+        if chunk is None:
+            chunk, = conn.execute("SELECT MAX(id) + 1 FROM %s"
+                                  % CHUNKTABLE).fetchone()
+            chunk = max(chunk or 0, numberOfChunks)
+            conn.execute("INSERT INTO %s(id) VALUES(?)" % CHUNKTABLE, (chunk,))
+        conn.commit()
+        conn.close()
+        self._mutateWindows(chunk, firstaa, windows)
 
-    def extractNumber(self,filename):
-        myfile = open(filename, "rt")
-        contents = myfile.read()
-        myfile.close()
-        m = re.findall(
-                r"verall(.+)\n(\*+)\nmodel-to-map fit, CC_mask: (\d+.\d+)", contents)[-1]
-        # [-1] --> find last ocurrence
-        return m[2]
+    def prescreenStep(self):
+        """ Score the windows not refined yet with the map density at
+        their side chains and skip (or send to the end of the queue)
+        those below the percentile of their fragment """
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        rows = conn.execute("""SELECT id, filename FROM %s
+                               WHERE done=? AND prescreen_score IS NULL"""
+                            % TABLE, (PENDING,)).fetchall()
+        if rows:
+            scores = scoreWindows(
+                os.path.abspath(self._getExtraPath(self.FITTEDFILE)),
+                [row[1] for row in rows])
+            if scores is None:
+                print("prescreenStep: the map cannot be read, every window "
+                      "will be refined")
+                conn.close()
+                return
+            conn.executemany("UPDATE %s SET prescreen_score=? WHERE id=?"
+                             % TABLE, [(None if np.isnan(score) else score,
+                                        row[0])
+                                       for score, row in zip(scores, rows)])
+            conn.commit()
+        queue = self._getJobQueue()
+        percentile = self.prescreenPercentile.get()
+        for fragment in sorted(self._getFragments()):
+            scores = [row[0] for row in conn.execute(
+                """SELECT prescreen_score FROM %s
+                   WHERE fragment=? AND prescreen_score IS NOT NULL"""
+                % TABLE, (fragment,))]
+            if not scores:
+                continue
+            threshold = float(np.percentile(scores, percentile))
+            below = [row[0] for row in conn.execute(
+                """SELECT id FROM %s WHERE fragment=? AND done=?
+                   AND prescreen_score < ?""" % TABLE,
+                (fragment, PENDING, threshold))]
+            if self.prescreenMode == PRESCREEN_SKIP:
+                for jobId in below:
+                    queue.fail(jobId, 'pre-screen score below %0.3f'
+                               % threshold)
+            else:
+                conn.executemany("UPDATE %s SET priority=-1 WHERE id=?"
+                                 % TABLE, [(jobId,) for jobId in below])
+                conn.commit()
+            print("prescreenStep: fragment %d, %d of %d windows below "
+                  "%0.3f" % (fragment, len(below), len(scores), threshold))
+        conn.close()
+
+    def _isMutationFinished(self):
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        pending, = conn.execute("SELECT COUNT(*) FROM %s WHERE done=0"
+                                % CHUNKTABLE).fetchone()
+        conn.close()
+        return pending == 0
+
+    def extractNumber(self, filename):
+        """ model-to-map fit (CC_mask) of a real_space_refine log """
+        metrics = parseRSRefineLog(filename, {'cc_mask': CC_MASK_PATTERN})
+        return metrics['cc_mask']
 
     def refineStep2(self):
         # atomStruct = os.path.abspath(self.inputStructure.get().getFileName())
         ## vol = os.path.abspath(self._getInputVolume().getFileName())
         vol = os.path.abspath(self._getExtraPath(self.FITTEDFILE))
         cwd = os.getcwd() + "/" + self._getExtraPath()
-        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)))
-        c = conn.cursor()
+        queue = self._getJobQueue()
+        worker = None
+        if self.batchRefine and Plugin.getPhenixVersion() >= PHENIXVERSION19:
+            worker = Plugin.createPhenixWorker()
+        with self._resumeLock:
+            if not self._resumed:
+                self._resumeJobs(queue)
+                self._resumed = True
+        nRuns = 0
         while 1:
-            command = """SELECT filename from %s
-                         WHERE done=0
-                         LIMIT 1""" % TABLE
-            c.execute(command)
-            myrow = c.fetchone()
-            if not myrow:
-                print("refineStep: no more available works")
-                break  # break while if no job is available
-
-            atomStructFn, = myrow
-            c.execute("""UPDATE %s
-                            SET done=1
-                          WHERE filename='%s' AND done=0""" % (TABLE, atomStructFn))
-            # ^^^^^^ This will return the number of rows updated (c.rowcount).
-            # Note that we only update if done is still '0', so if we get 1 updated
-            # row, we're sure no one else took our job. This works because UPDATE is atomic.
-
-            if not c.rowcount:
-                # Whoops this job was taken! Try again and get another one
+            # a refinement takes minutes, so jobs are taken one by one
+            # to keep the workers balanced
+            mutationFinished = self._isMutationFinished()
+            jobs = queue.claim(columns=('search_round', 'cheap_retry',
+                                        'fragment', 'direction'))
+            if not jobs:
+                if mutationFinished:
+                    print("refineStep: no more available works")
+                    break  # break while if no job is available
+                time.sleep(POLLING_TIME)  # wait for the mutation chunks
                 continue
-            conn.commit()
 
-            args = self._writeArgsRSR(atomStructFn, vol)
+            (jobId, atomStructFn, searchRound, cheapRetry, fragment,
+             direction) = jobs[0]
+            runModes, macroCycles = self._getRoundSettings(searchRound,
+                                                           cheapRetry)
+            args = self._writeArgsRSR(atomStructFn, vol, runModes=runModes,
+                                      macroCycles=macroCycles)
 
             # TODO:Review with Rob (break doesn't seem to work)
             # if self.getLogsLastLines(logFile=1) != []:
             #    if self.getLogsLastLines(logFile=1)[0].startswith("Sorry: Map and model are not aligned!"):
             #        break
 
-            retry(Plugin.runPhenixProgram,
-                 Plugin.getProgram(REALSPACEREFINE), args,
-                 cwd=cwd, listAtomStruct=[atomStructFn], log=self._log, 
-                 messages=[("Sorry: Map and model are not aligned! Use skip_map_model_overlap_check=True to continue.",
-                             "Sorry: Map and model are not aligned! Use skip_map_model_overlap_check=True to continue.")],
-                 sdterrLog = self.getLogsLastLines)
-            
+            # the model file converted by _writeArgsRSR identifies the
+            # processes of this job
+            token = atomStructFn[:-4] + ".cif"
+            watchdog = JobWatchdog(
+                lambda: self._getJobProcesses(worker, token),
+                maxTime=self.maxJobTime.get() * 60,
+                maxMemory=int(self.maxJobMemory.get() * 2 ** 30))
+
+            def runPhenixProgram(program, args, cwd=None):
+                # retry must not launch the job again once it was killed
+                if watchdog.reason is not None:
+                    raise JobLimitExceeded(watchdog.reason)
+                Plugin.runPhenixProgram(program, args, cwd=cwd)
+
+            try:
+                with queue.heartbeat([jobId]), watchdog:
+                    refined = worker is not None and \
+                        self._runRSRefineInWorker(worker, atomStructFn,
+                                                  args, cwd)
+                    if not refined and watchdog.reason is None:
+                        retry(runPhenixProgram,
+                             Plugin.getProgram(REALSPACEREFINE), args,
+                             cwd=cwd, listAtomStruct=[atomStructFn], log=self._log,
+                             messages=[("Sorry: Map and model are not aligned! Use skip_map_model_overlap_check=True to continue.",
+                                         "Sorry: Map and model are not aligned! Use skip_map_model_overlap_check=True to continue.")],
+                             sdterrLog = self.getLogsLastLines)
+            except Exception:
+                if watchdog.reason is None:
+                    queue.release(jobId)  # let another worker try again
+                    if worker is not None:
+                        worker.close()
+                    raise
+            if watchdog.reason is not None:
+                self._jobKilled(queue, jobId, searchRound, cheapRetry,
+                                watchdog.reason)
+                continue
+            nRuns += 1
+            if worker is not None and nRuns % WORKER_MAX_RUNS == 0:
+                worker.close()  # restarted on next use, releases memory
+
             if Plugin.getPhenixVersion() >= PHENIXVERSION19:
                 # update data base with phenix version
-                logFileFn = atomStructFn[:-4] + "_real_space_refined_000.log"
+                # (every round of a job gets a new serial number)
+                logFileFn = atomStructFn[:-4] + "_real_space_refined_[0-9][0-9][0-9].log"
                 # last file
                 lastLogFile = sorted(glob.glob(logFileFn))[-1]
                 phenix_id = lastLogFile[-8:-4]  # _000
-                c.execute("""UPDATE %s
-                                SET phenix_id='%s'
-                              WHERE filename='%s'""" % (TABLE, phenix_id,
-                                                                             atomStructFn))
             else:
                 phenix_id = ''
-            conn.commit()
 
             logFileFn = atomStructFn[:-4] + "_real_space_refined%s.log" % phenix_id
-            model_to_map_fit = self.extractNumber(logFileFn)
-            accepted = c.execute("""UPDATE %s
-                                    SET model_to_map_fit=%f
-                                    WHERE filename='%s'""" % (TABLE,
-                                                              float(model_to_map_fit),
-                                                              atomStructFn)
-                                 )
-            conn.commit()
+            # every metric of the final statistics, read from the end of
+            # the log; model_to_map_fit (used to rank) is CC_mask
+            metrics = parseRSRefineLog(logFileFn)
+            model_to_map_fit = metrics['cc_mask']
+            metrics = {name: metrics.get(name) for name in LOG_COLUMNS}
+            # checked when the protocol is resumed
+            refinedFn = atomStructFn[:-4] + "_real_space_refined%s.cif" \
+                % phenix_id
+            if os.path.exists(refinedFn):
+                metrics.update(output_size=os.path.getsize(refinedFn),
+                               output_sha256=hashFile(refinedFn))
+
+            def recordRound(conn):
+                conn.execute("""INSERT INTO %s(job_id, search_round,
+                                               model_to_map_fit, phenix_id)
+                                VALUES(?, ?, ?, ?)""" % ROUNDTABLE,
+                             (jobId, searchRound, model_to_map_fit, phenix_id))
+                self._updateSummary(conn, jobId, searchRound, fragment,
+                                    direction, model_to_map_fit)
+
+            if queue.complete(jobId, onComplete=recordRound,
+                              model_to_map_fit=model_to_map_fit,
+                              phenix_id=phenix_id, **metrics):
+                self._publishRefinedWindow(refinedFn, model_to_map_fit,
+                                           searchRound, fragment, direction)
+            if nRuns % PRUNE_INTERVAL == 0:
+                self._pruneWindows()
+        if worker is not None:
+            worker.close()
+
+    def _resumeJobs(self, queue):
+        """ Queue again the jobs of a previous run of the protocol that were
+        interrupted and the finished ones whose refined model was lost or
+        does not match the size and checksum saved when it finished """
+        interrupted = queue.requeueInterrupted()
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        rows = conn.execute("""SELECT id, filename, phenix_id, search_round,
+                                      output_size, output_sha256
+                               FROM %s WHERE done=? AND archived=0"""
+                            % TABLE, (FINISHED,)).fetchall()
+        lost = [(jobId, searchRound)
+                for jobId, atomStructFn, phenixId, searchRound, size, sha
+                in rows
+                if not self._isFileValid(
+                    atomStructFn[:-4] + "_real_space_refined%s.cif"
+                    % phenixId, size, sha)]
+        # the results of these jobs are not counted until they finish again
+        for jobId, searchRound in lost:
+            self._removeResult(conn, jobId, searchRound)
+        conn.commit()
+        conn.close()
+        for jobId, _ in lost:
+            queue.requeue("id=? AND done=?", (jobId, FINISHED),
+                          model_to_map_fit=-1, output_size=None,
+                          output_sha256=None,
+                          reason='refined model lost, queued again')
+        if interrupted or lost:
+            print("refineStep: resuming, %d interrupted and %d lost jobs "
+                  "queued again" % (interrupted, len(lost)))
+
+    def _removeResult(self, conn, jobId, searchRound):
+        """ Undo what _updateSummary and the round table recorded for the
+        result of a job in a round """
+        row = conn.execute("""SELECT j.fragment, j.direction,
+                                     r.model_to_map_fit
+                              FROM %s r JOIN %s j ON j.id = r.job_id
+                              WHERE r.job_id=? AND r.search_round=?
+                              ORDER BY r.id DESC LIMIT 1"""
+                           % (ROUNDTABLE, TABLE),
+                           (jobId, searchRound)).fetchone()
+        if row is None:
+            return
+        fragment, direction, modelToMapFit = row
+        conn.execute("""UPDATE %s SET count=count-1, sum=sum-?, sum2=sum2-?
+                        WHERE search_round=? AND fragment=? AND direction=?"""
+                     % SUMMARYTABLE,
+                     (modelToMapFit, modelToMapFit ** 2, searchRound,
+                      fragment, direction))
+        conn.execute("DELETE FROM %s WHERE job_id=? AND search_round=?"
+                     % TOPTABLE, (jobId, searchRound))
+        conn.execute("DELETE FROM %s WHERE job_id=? AND search_round=?"
+                     % ROUNDTABLE, (jobId, searchRound))
+
+    def _runRSRefineInWorker(self, worker, atomStructFn, args, cwd):
+        """ Refine atomStructFn in a phenix.python process that is kept
+        alive between jobs, so cctbx is imported and the map is read only
+        once. Returns False if the refinement has to be run by the usual
+        command line instead. """
+        logFn = os.path.abspath(self._getTmpPath(
+            'rsr_%d_%d.log' % (os.getpid(), threading.get_ident())))
+        try:
+            newFiles = worker.runProgram(REALSPACEREFINE_MODULE,
+                                         shlex.split(args), cwd, logFn)
+        except (PhenixWorkerError, PhenixScriptError) as e:
+            print("Refinement in phenix.python worker failed (%s), "
+                  "running %s" % (e, REALSPACEREFINE))
+            return False
+        # write the log where the command line writes it
+        prefix = os.path.basename(atomStructFn)[:-4] + "_real_space_refined_"
+        refined = sorted(fn for fn in newFiles
+                         if fn.startswith(prefix) and fn.endswith(".cif"))
+        if not refined:
+            return False
+        logFileFn = os.path.join(cwd, refined[-1][:-4] + ".log")
+        if not os.path.exists(logFileFn):
+            os.replace(logFn, logFileFn)
+        return True
+
+    def _getJobProcesses(self, worker, token):
+        """ Processes running the refinement of a job: the phenix.python
+        worker of this thread and the command line programs given the
+        model file token """
+        processes = findChildren(token)
+        pid = worker.getPid() if worker is not None else None
+        if pid is not None:
+            processes.append(psutil.Process(pid))
+        return processes
+
+    def _jobKilled(self, queue, jobId, searchRound, cheapRetry, reason):
+        """ Queue a killed job again with the cheapest refinement, or mark
+        it as failed if it already had it """
+        cheapSettings = self._getRoundSettings(searchRound, cheapRetry=True)
+        if self.retryKilledJobs and not cheapRetry and \
+                self._getRoundSettings(searchRound) != cheapSettings:
+            queue.requeue("id=?", (jobId,), cheap_retry=1,
+                          reason='retried: %s' % reason)
+            print("refineStep: job %d killed (%s), queued again with a "
+                  "cheap refinement" % (jobId, reason))
+        else:
+            queue.fail(jobId, reason)
+            print("refineStep: job %d killed (%s), marked as failed"
+                  % (jobId, reason))
+
+    def promoteStep(self, searchRound):
+        """ Send the best windows of the previous round to searchRound """
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)))
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM %s WHERE search_round>=?" % TABLE,
+                  (searchRound,))
+        if c.fetchone()[0]:
+            print("promoteStep: round %d already started" % searchRound)
+        else:
+            # every fragment promotes its own best windows
+            ids = []
+            for fragment in sorted(self._getFragments()):
+                c.execute("""SELECT id FROM %s
+                              WHERE search_round=? AND done=? AND fragment=?
+                              ORDER BY model_to_map_fit DESC""" % TABLE,
+                          (searchRound - 1, FINISHED, fragment))
+                fragmentIds = [row[0] for row in c.fetchall()]
+                size = int(math.ceil(len(fragmentIds) *
+                                     self.promotedFraction.get()))
+                ids += fragmentIds[:max(size, 1)]
+            if ids:  # empty if every window failed
+                self._restoreWindows(ids)
+                self._getJobQueue().requeue(
+                    "id IN (%s)" % ','.join('?' * len(ids)), ids,
+                    search_round=searchRound, cheap_retry=0)
+            print("promoteStep: %d windows promoted to round %d"
+                  % (len(ids), searchRound))
         c.close()
         conn.close()
 
@@ -376,23 +1056,108 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
         # make 5 pdbs with higher score available to scipion
         conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)))
         c = conn.cursor()
-        sqlCommand = """SELECT filename, model_to_map_fit, phenix_id
+        # pack the windows that are not kept, then extract the outputs
+        # (there may be more than the windows kept)
+        self._pruneWindows()
+        sqlCommand = """SELECT id, filename, phenix_id
                                     FROM   %s
-                                    ORDER BY model_to_map_fit DESC
-                                    LIMIT 5""" % TABLE
-        c.execute(sqlCommand)
-        rows = c.fetchall()
-
+                                    WHERE  done=%d AND fragment=?
+                                    ORDER BY search_round DESC,
+                                             model_to_map_fit DESC
+                                    LIMIT 5""" % (TABLE, FINISHED)
+        fragments = self._getFragments()
         argsOutput = {}
-        for counter, row in enumerate(rows):
-            atomStructFn = row[0][:-4] + "_real_space_refined%s.log" % row[2]
-            atomStruct = AtomStruct()
-            atomStruct.setFileName(atomStructFn)
-            argsOutput["outputAtomStruct_%d" % counter] = atomStruct
+        for fragment in sorted(fragments):
+            c.execute(sqlCommand, (fragment,))
+            rows = c.fetchall()
+            self._restoreWindows([row[0] for row in rows])
+            # with several fragments the names tell their chain
+            if len(fragments) == 1:
+                outputName = "outputAtomStruct_%d"
+            else:
+                outputName = "outputAtomStruct_%s_%%d" % fragments[fragment][4]
+            for counter, row in enumerate(rows):
+                atomStructFn = row[1][:-4] + "_real_space_refined%s.cif" % row[2]
+                atomStruct = AtomStruct()
+                atomStruct.setFileName(atomStructFn)
+                argsOutput[outputName % counter] = atomStruct
         c.close()
         conn.close()
         self._defineOutputs(**argsOutput)
 
+        self._closeOutput()
+
+    def _getWindowFiles(self, atomStructFn):
+        """ Files of a window: the model made by coot, its conversions
+        and everything written by its refinements """
+        stem = atomStructFn[:-4]
+        return glob.glob(stem + ".*") + \
+            glob.glob(stem + "_real_space_refined*")
+
+    def _pruneWindows(self):
+        """ Move to the archive the files of the finished (or failed)
+        windows that are not among the keepTopWindows best ones of their
+        fragment. The refined models of every round are kept, since the
+        streaming output points to them. """
+        keep = self.keepTopWindows.get()
+        if keep <= 0:
+            return
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        best = set()
+        for fragment in self._getFragments():
+            best.update(row[0] for row in conn.execute(
+                """SELECT id FROM %s WHERE fragment=? AND done=?
+                   ORDER BY search_round DESC, model_to_map_fit DESC
+                   LIMIT ?""" % TABLE, (fragment, FINISHED, keep)))
+        rows = conn.execute("""SELECT id, filename FROM %s
+                               WHERE done IN (?, ?) AND archived=0"""
+                            % TABLE, (FINISHED, FAILED)).fetchall()
+        archive = FileArchive(self._getExtraPath(WINDOWSARCHIVE))
+        for jobId, atomStructFn in rows:
+            if jobId in best:
+                continue
+            published = set(atomStructFn[:-4] +
+                            "_real_space_refined%s.cif" % row[0]
+                            for row in conn.execute(
+                                "SELECT phenix_id FROM %s WHERE job_id=?"
+                                % ROUNDTABLE, (jobId,)))
+            # the archive is on disk before it is marked as archived
+            archive.add(jobId, [fn for fn in
+                                self._getWindowFiles(atomStructFn)
+                                if fn not in published])
+            conn.execute("UPDATE %s SET archived=1 WHERE id=?" % TABLE,
+                         (jobId,))
+            conn.commit()
+        conn.close()
+
+    def _restoreWindows(self, jobIds):
+        """ Extract from the archive the files of these windows """
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        archive = FileArchive(self._getExtraPath(WINDOWSARCHIVE))
+        for jobId in jobIds:
+            if conn.execute("SELECT archived FROM %s WHERE id=?" % TABLE,
+                            (jobId,)).fetchone() != (1,):
+                continue
+            archive.extract(jobId, os.path.abspath(self._getExtraPath()))
+            conn.execute("UPDATE %s SET archived=0 WHERE id=?" % TABLE,
+                         (jobId,))
+            conn.commit()
+        conn.close()
+
+    def _publishRefinedWindow(self, atomStructFn, modelToMapFit, searchRound,
+                              fragment=0, direction=FORWARD):
+        """ Add a refined window to the streaming output as soon as it
+        is finished, so results can be inspected while the search runs """
+        atomStruct = AtomStruct()
+        atomStruct.setFileName(atomStructFn)
+        atomStruct.fragment = String(self._getFragments()[fragment][4])
+        atomStruct.direction = String(DIRECTIONNAMES[direction])
+        atomStruct.modelToMapFit = Float(modelToMapFit)
+        atomStruct.searchRound = Integer(searchRound)
+        self._appendToOutput(atomStruct)
+
     # --------------------------- INFO functions ---------------------------
 
     def _validate(self):
@@ -400,6 +1165,16 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
         # Check that the input volume exist
         if self._getInputVolume() is None:
             errors.append("Error: You should provide a volume.\n")
+        try:
+            self._parseWindowOffsets()
+        except ValueError:
+            errors.append("Error: Offsets must be integers or ranges "
+                          "(e.g. '0 4 10-15').\n")
+        if self.cropMap and self.inputFragments.get() is not None:
+            errors.append("Error: The map can only be cropped around the "
+                          "template, not around additional fragments.\n")
+        if self.windowStride.get() < 1:
+            errors.append("Error: The stride must be at least 1.\n")
         return errors
 
 #   def _citations(self):
@@ -413,7 +1188,9 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
 #            "real_space_refine.html")
         return summary
 
-    def _writeArgsRSR(self, atomStruct, vol):
+    def _writeArgsRSR(self, atomStruct, vol, runModes=None,
+                      macroCycles=None):
+        """ runModes and macroCycles replace the options of the form """
         if Plugin.getPhenixVersion() >= PHENIXVERSION19 or PHENIXVERSION20:
             # Necessary step to avoid the failing of phenix-real_space_refine
             # due to the mmcif format
@@ -439,26 +1216,16 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
         if self.doSecondary == True:
             args += " secondary_structure.enabled=%s" % self.doSecondary
         args += " run="
-        if self.minimizationGlobal == True:
-            args += "minimization_global+"
-        if self.rigidBody == True:
-            args += "rigid_body+"
-        if self.localGridSearch == True:
-            args += "local_grid_search+"
-        if self.morphing == True:
-            args += "morphing+"
-        if self.simulatedAnnealing == True:
-            args += "simulated_annealing+"
-        if self.adp == True:
-            args += "adp+"
-        if self.occupancy == True:
-            args += "occupancy+"
-        if self.nqh_flips == True:
-            args += "nqh_flips+"
+        if runModes is not None:
+            args += runModes + "+"
+        else:
+            args += self._getRunModes()
         args = args[:-1]
         # args += " run=minimization_global+local_grid_search+morphing+simulated_annealing"
-        if self.macroCycles != 5:
-            args += " macro_cycles=%d" % self.macroCycles
+        if macroCycles is None:
+            macroCycles = self.macroCycles.get()
+        if macroCycles != 5:
+            args += " macro_cycles=%d" % macroCycles
         # args += " model_format=pdb+mmcif"
         # args += " wrapping=Auto adp_individual_isotropic=Auto ncs_search.enabled=True"
         # args += " write_pkl_stats=True"
@@ -468,6 +1235,133 @@ class PhenixProtSearchFit(PhenixProtRunRefinementBase):
             args += " nproc=%d" % numberOfThreads
         return args
 
+    def _getRunModes(self):
+        runModes = ""
+        if self.minimizationGlobal == True:
+            runModes += "minimization_global+"
+        if self.rigidBody == True:
+            runModes += "rigid_body+"
+        if self.localGridSearch == True:
+            runModes += "local_grid_search+"
+        if self.morphing == True:
+            runModes += "morphing+"
+        if self.simulatedAnnealing == True:
+            runModes += "simulated_annealing+"
+        if self.adp == True:
+            runModes += "adp+"
+        if self.occupancy == True:
+            runModes += "occupancy+"
+        if self.nqh_flips == True:
+            runModes += "nqh_flips+"
+        return runModes
+
+    def _readFragments(self):
+        """ (file name, chain, first residue, number of residues, label)
+        of every chain to search: the first one (or all, see
+        searchAllChains) of the template and all the chains of the
+        additional fragments """
+        fileNames = [self.inputStructure.get().getFileName()]
+        if self.inputFragments.get() is not None:
+            fileNames += [atomStruct.getFileName()
+                          for atomStruct in self.inputFragments.get()]
+        fragments = []
+        for i, fileName in enumerate(fileNames):
+            # only the first model
+            model = next(AtomicStructHandler(fileName).getStructure()
+                         .get_models())
+            chains = list(model.get_chains())
+            if i == 0 and not self.searchAllChains:
+                chains = chains[:1]
+            for chain in chains:
+                residues = list(chain.get_residues())
+                chainName = chain.get_id()
+                label = chainName if i == 0 else '%d%s' % (i, chainName)
+                fragments.append((os.path.abspath(fileName), chainName,
+                                  residues[0].id[1], len(residues), label))
+        return fragments
+
+    def _getFragments(self):
+        """ Fragments stored by createTableStep as
+        {fragment: (file name, chain, first residue, size, label)} """
+        conn = sqlite3.connect(os.path.abspath(self._getExtraPath(DATAFILE)),
+                               timeout=60)
+        rows = conn.execute("""SELECT id, filename, chain, first_residue,
+                                      size, label
+                               FROM %s""" % FRAGMENTTABLE).fetchall()
+        conn.close()
+        if not rows:  # run made before there were fragments
+            return dict(enumerate(self._readFragments()[:1]))
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def _parseWindowOffsets(self):
+        """ Offsets listed by the user, e.g. '0 4 10-15' """
+        offsets = set()
+        for item in self.windowOffsets.get().replace(',', ' ').split():
+            first, _, last = item.partition('-')
+            offsets.update(range(int(first), int(last or first) + 1))
+        return offsets
+
+    def _getWindowOffsets(self, numberOfSteps):
+        """ Offsets (from the first selected residue) of the windows
+        refined by the first pass of the search """
+        if self.windowOffsets.get().strip():
+            offsets = [offset for offset in sorted(self._parseWindowOffsets())
+                       if 0 <= offset < numberOfSteps]
+        else:
+            offsets = list(range(0, numberOfSteps,
+                                 max(1, self.windowStride.get())))
+        return offsets or [0]
+
+    def _getDirections(self):
+        """ Threading directions to search """
+        if self.threadingDirection == BOTH_DIRECTIONS:
+            return [FORWARD, REVERSE]
+        return [self.threadingDirection.get()]
+
+    def _isRefiningAroundHits(self):
+        return self.windowStride.get() > 1 and self.refineAroundHits.get()
+
+    def _getNumberOfRounds(self):
+        if self.searchMode == SEARCH_HALVING:
+            return max(self.numberOfRounds.get(), 1)
+        return 1
+
+    def _getRoundSettings(self, searchRound, cheapRetry=False):
+        """ Run modes and macro cycles of a round of the search.
+        None means the options of the form (used by the last round).
+        cheapRetry asks for the cheapest refinement (jobs killed because
+        of the limits). """
+        lastRound = self._getNumberOfRounds() - 1
+        if cheapRetry:
+            return "minimization_global", 1
+        if searchRound >= lastRound:
+            return None, None
+        if searchRound == 0:
+            return "minimization_global", 1
+        return None, max(1, int(round(self.macroCycles.get() *
+                                      float(searchRound) / lastRound)))
+
+    def _getJobQueue(self):
+        return JobQueue(self._getExtraPath(DATAFILE), TABLE,
+                        extraColumns=collections.OrderedDict([
+                            ('model_to_map_fit', 'float DEFAULT -1'),
+                            ('phenix_id', "TEXT default ''"),
+                            ('search_round', 'int DEFAULT 0'),
+                            ('cheap_retry', 'int DEFAULT 0'),
+                            ('window_offset', 'int DEFAULT -1'),
+                            ('fragment', 'int DEFAULT 0'),
+                            ('direction', 'int DEFAULT %d' % FORWARD),
+                            ('archived', 'int DEFAULT 0'),
+                            ('prescreen_score', 'float'),
+                            ('priority', 'int DEFAULT 0'),
+                            ('mutant_size', 'int'),
+                            ('mutant_sha256', 'TEXT'),
+                            ('output_size', 'int'),
+                            ('output_sha256', 'TEXT')] +
+                            [(name, 'float') for name in LOG_COLUMNS]),
+                        indexes=['model_to_map_fit', 'filename'],
+                        order='priority DESC, id')
+
     def getIdxRemoveResidues(self):
         idxs = json.loads(getattr(self, 'residues').get())['index'].split('-')
         return list(map(int, idxs))
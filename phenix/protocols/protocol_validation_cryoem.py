@@ -27,7 +27,7 @@
 import os
 from phenix.constants import MOLPROBITY, VALIDATION_CRYOEM, PHENIXVERSION
 from phenix import Plugin
-from pwem.convert.atom_struct import retry
+from phenix.cache import cachedRetry
 from .protocol_refinement_base import PhenixProtRunRefinementBase
 
 class PhenixProtRunValidationCryoEM(PhenixProtRunRefinementBase):
@@ -89,13 +89,13 @@ atomic structure inferred from an electron density map.
         cwd = os.getcwd() + "/" + self._getExtraPath()
         # script with auxiliary files
 
-        retry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY),
+        cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(MOLPROBITY),
             args, cwd=cwd, listAtomStruct=[atomStruct], log=self._log, sdterrLog = self.getLogsLastLines)
 
         args = self._writeArgsValCryoEM(atomStruct, volume, self.vol)
 
         if Plugin.getPhenixVersion() != PHENIXVERSION and self.vol is not None:
-            retry(Plugin.runPhenixProgram, Plugin.getProgram(VALIDATION_CRYOEM),
+            cachedRetry(Plugin.runPhenixProgram, Plugin.getProgram(VALIDATION_CRYOEM),
                   args, cwd=cwd, listAtomStruct=[atomStruct], log=self._log, sdterrLog = self.getLogsLastLines)
 
     def createOutputStep(self):
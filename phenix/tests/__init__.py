@@ -30,6 +30,10 @@ from .test_protocol_molprobity import (TestImportBase, TestImportData,
                                       TestMolprobityValidation2)
 from .test_protocol_real_space_refine import (TestImportBase, TestImportData,
                                              TestPhenixRSRefine)
+from .test_protocol_real_space_refine_batch import TestPhenixRSRefineBatch
+from .test_protocol_real_space_refine_maps import TestPhenixRSRefineMaps
+from .test_protocol_real_space_refine_sweep import (TestParetoFront,
+                                                   TestPhenixRSRefineSweep)
 from .test_protocol_validation_cryoem import (TestImportBase, TestImportData,
                                              TestValCryoEM)
 from .test_protocol_superpose_pdbs import (TestImportBase, TestProtSuperposePdbs,
@@ -41,3 +45,7 @@ from .test_protocol_dock_in_map import TestProtDockInMap
 from .test_protocol_search_fit import TestPhenixProtSearchFit
 from .test_phenix_alphafold import TestAProtProcessDockBuildPredictedAlphaFold, \
     TestBProtProcessDockBuildPredictedAlphaFold, TestCProtProcessDockBuildPredictedAlphaFold
+from .test_worker import TestPhenixWorker
+from .test_convert import TestMapConversion
+from .test_jobqueue import TestJobQueue
+from .test_cache import TestFileArchive, TestMapStore
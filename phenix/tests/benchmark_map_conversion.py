@@ -0,0 +1,103 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+"""
+Compare the time needed to prepare a map for PHENIX with a full conversion
+(Ccp4Header.fixFile) and with the header only path (fixMapHeader) on
+synthetic 1 GB maps, a dense one and a masked (mostly zero) one.
+
+Run it inside the scipion environment:
+
+    scipion3 python -m phenix.tests.benchmark_map_conversion [workDir]
+
+workDir should be on the filesystem used by the projects, since the
+header only path depends on its support for reflinks and sparse files.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pwem.convert.headers import Ccp4Header
+from phenix.convert import fixMapHeader
+from phenix.tests.test_convert import writeMrc
+
+SIZE = 640  # 640^3 float32 voxels ~ 1 GB
+ORIGIN = (-160., -160., -160.)
+SAMPLING = 1.0
+
+
+def createMap(fileName, dense):
+    writeMrc(fileName, (1, 1, 1))  # header
+    with open(fileName, 'r+b') as f:
+        f.truncate(1024 + 4 * SIZE ** 3)
+    data = np.memmap(fileName, dtype='<f4', mode='r+', offset=1024,
+                     shape=(SIZE, SIZE, SIZE))
+    if dense:
+        for z in range(SIZE):
+            data[z] = np.random.random((SIZE, SIZE))
+    else:
+        box = slice(SIZE // 3, 2 * SIZE // 3)
+        data[box, box, box] = 1.
+    data.flush()
+    del data
+    # write the real dimensions
+    header = Ccp4Header(fileName, readHeader=True)
+    header.setDims(SIZE, SIZE, SIZE)
+    header.setGridSampling(SIZE, SIZE, SIZE)
+    header.writeHeader()
+
+
+def timeIt(func, *args):
+    t0 = time.time()
+    func(*args)
+    return time.time() - t0
+
+
+def main(workDir):
+    tmpDir = tempfile.mkdtemp(dir=workDir)
+    outFn = os.path.join(tmpDir, 'out.mrc')
+    try:
+        print("%-8s %12s %12s %14s" % ('map', 'fixFile (s)', 'header (s)',
+                                       'disk used (MB)'))
+        for name, dense in [('dense', True), ('masked', False)]:
+            inFn = os.path.join(tmpDir, '%s.mrc' % name)
+            createMap(inFn, dense)
+            tFull = timeIt(Ccp4Header.fixFile, inFn, outFn, ORIGIN,
+                           SAMPLING, Ccp4Header.START)
+            os.remove(outFn)
+            tHeader = timeIt(fixMapHeader, inFn, outFn, ORIGIN, SAMPLING)
+            used = os.stat(outFn).st_blocks * 512 / 1024. ** 2
+            print("%-8s %12.2f %12.2f %14.1f" % (name, tFull, tHeader, used))
+            os.remove(outFn)
+            os.remove(inFn)
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.getcwd())
@@ -0,0 +1,130 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# test the archive where search fit packs the files of its windows
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from pyworkflow.tests import *
+from phenix.cache import FileArchive, MapStore
+
+
+class TestFileArchive(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.archive = FileArchive(os.path.join(self.tmpDir, 'windows'))
+
+    def _writeFiles(self, key):
+        fileNames = []
+        for ext in ('pdb', 'cif', 'log'):
+            fileName = os.path.join(self.tmpDir, 'window_%d.%s' % (key, ext))
+            with open(fileName, 'w') as f:
+                f.write('%d %s\n' % (key, ext) * 1000)
+            fileNames.append(fileName)
+        return fileNames
+
+    def testAddExtract(self):
+        fileNames = self._writeFiles(1)
+        self.archive.add(1, fileNames)
+        self.assertFalse(any(os.path.exists(fn) for fn in fileNames))
+        self.archive.add(2, self._writeFiles(2))
+        self.assertEqual(sorted(self.archive.extract(1, self.tmpDir)),
+                         sorted(fileNames))
+        with open(fileNames[2]) as f:
+            self.assertEqual(f.readline(), '1 log\n')
+        self.assertEqual(self.archive.extract(3, self.tmpDir), [])
+        # adding again what is already archived only removes the files
+        self.archive.add(1, fileNames)
+        self.assertFalse(any(os.path.exists(fn) for fn in fileNames))
+        self.assertEqual(len(self.archive.extract(1, self.tmpDir)), 3)
+
+    def testInterruptedAdd(self):
+        fileNames = self._writeFiles(1)
+        self.archive.add(1, fileNames[:2])
+        # a call killed while writing leaves a partial temporary zip
+        with open(os.path.join(self.archive.dirName, '1.zip.999.tmp'),
+                  'w') as f:
+            f.write('PK partial')
+        self.assertEqual(sorted(self.archive.extract(1, self.tmpDir)),
+                         sorted(fileNames[:2]))
+        # files added later to the same key are merged
+        self.archive.add(1, fileNames)
+        self.assertEqual(sorted(self.archive.extract(1, self.tmpDir)),
+                         sorted(fileNames))
+
+    def testConcurrentAdd(self):
+        keys = list(range(1, 41))
+        files = {key: self._writeFiles(key) for key in keys}
+
+        def worker(keys):
+            for key in keys:
+                FileArchive(self.archive.dirName).add(key, files[key])
+
+        threads = [threading.Thread(target=worker, args=(keys[i::4],))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for key in keys:
+            self.assertEqual(sorted(self.archive.extract(key, self.tmpDir)),
+                             sorted(files[key]))
+
+
+class TestMapStore(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.store = MapStore(os.path.join(self.tmpDir, 'maps'), maxSize=0)
+
+    @staticmethod
+    def _convert(inFileName, outFileName, origin, sampling):
+        with open(inFileName, 'rb') as fin, open(outFileName, 'wb') as fout:
+            fout.write(fin.read())
+
+    def _getMap(self, name):
+        inFileName = os.path.join(self.tmpDir, name + '.mrc')
+        with open(inFileName, 'w') as f:
+            f.write(name * 1000)
+        outFileName = os.path.join(self.tmpDir, name + '_phenix.mrc')
+        self.store.getMap(inFileName, outFileName, (0, 0, 0), 1.,
+                          self._convert)
+        return outFileName
+
+    def testLinkedMapsAreKept(self):
+        first = self._getMap('first')
+        self._getMap('second')  # evicts every map without users
+        with open(first) as f:
+            self.assertEqual(f.read(), 'first' * 1000)
+
+    def testCopyAcrossFileSystems(self):
+        with mock.patch('os.link', side_effect=OSError('cross-device')):
+            first = self._getMap('first')
+            self._getMap('second')
+        # a copy survives the eviction of the stored map
+        self.assertFalse(os.path.islink(first))
+        with open(first) as f:
+            self.assertEqual(f.read(), 'first' * 1000)
@@ -0,0 +1,260 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# test the header only conversion of maps for PHENIX
+import os
+import struct
+import tempfile
+
+import numpy as np
+from pwem.convert.headers import Ccp4Header
+from pyworkflow.tests import *
+from phenix.convert import (MRC_HEADER_FORMAT, _readLinesBackwards,
+                            cropMapToModel, findCloseContacts, fixMapHeader,
+                            parseRSRefineLog, scoreWindows)
+
+
+def writeMrc(fileName, dims, mode=2, mapAxes=(1, 2, 3), value=1.0,
+             origin=(0., 0., 0.)):
+    """ Write a synthetic little endian MRC volume. """
+    nx, ny, nz = dims
+    header = bytearray(1024)
+    struct.pack_into(MRC_HEADER_FORMAT, header, 0, nx, ny, nz, mode,
+                     0, 0, 0, nx, ny, nz, nx, ny, nz, 90., 90., 90.,
+                     mapAxes[0], mapAxes[1], mapAxes[2], 0., value, 0., 1, 0)
+    struct.pack_into('<3f', header, 196, *origin)
+    header[208:214] = b'MAP \x44\x44'
+    with open(fileName, 'wb') as f:
+        f.write(header)
+        f.write(struct.pack('<f', value) * (nx * ny * nz))
+
+
+# the statistics of real_space_refine, printed after every macro cycle
+# and at the end
+RSR_STATISTICS = """
+  Deviations from Ideal Values.
+    Bond      :  %(bond).3f   0.039   1234
+    Angle     :  0.772   7.567   1678
+    Chirality :  0.045   0.146    190
+
+  Molprobity Statistics.
+    All-atom Clashscore : 4.96
+    Ramachandran Plot:
+      Outliers :  0.00 %%
+      Allowed  :  3.57 %%
+      Favored  : 96.43 %%
+    Rotamer Outliers :  1.20 %%
+
+  Model vs data:
+    CC_mask  : %(cc).4f
+    CC_volume: 0.7776
+    CC_peaks : 0.6892
+"""
+
+
+PDB_ATOMS = (
+    "ATOM      1  N   ALA A   1      20.000  30.000  40.000  1.00  0.00"
+    "           N\n"
+    "ATOM      2  CA  ALA A   1      30.000  40.000  50.000  1.00  0.00"
+    "           C\n"
+    "END\n")
+
+
+def pdbAtom(serial, name, x, y, z):
+    return ("ATOM  %5d  %-3s ALA A   1    %8.3f%8.3f%8.3f  1.00  0.00"
+            "          %2s\n" % (serial, name, x, y, z, name[0]))
+
+
+class TestMapConversion(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def testFixMapHeader(self):
+        inFn = os.path.join(self.tmpDir, 'in.mrc')
+        outFn = os.path.join(self.tmpDir, 'out.mrc')
+        writeMrc(inFn, (10, 12, 14))
+        self.assertTrue(fixMapHeader(inFn + ':mrc', outFn,
+                                     (-4., -6., 8.), 2.))
+        with open(inFn, 'rb') as f:
+            inData = f.read()
+        with open(outFn, 'rb') as f:
+            outData = f.read()
+        # same data, new origin (in pixels) and sampling
+        self.assertEqual(inData[1024:], outData[1024:])
+        words = struct.unpack_from(MRC_HEADER_FORMAT, outData)
+        self.assertEqual(words[4:10], (-2, -3, 4, 10, 12, 14))
+        self.assertEqual(words[10:13], (20., 24., 28.))
+        # the source is left untouched
+        self.assertEqual(struct.unpack_from(MRC_HEADER_FORMAT, inData)[4:7],
+                         (0, 0, 0))
+
+    def testFixMapHeaderOrigin(self):
+        inFn = os.path.join(self.tmpDir, 'in.mrc')
+        fastFn = os.path.join(self.tmpDir, 'fast.mrc')
+        slowFn = os.path.join(self.tmpDir, 'slow.mrc')
+        writeMrc(inFn, (10, 12, 14), origin=(30., -10., 5.))
+        self.assertTrue(fixMapHeader(inFn, fastFn, (-4., -6., 8.), 2.))
+        Ccp4Header.fixFile(inFn, slowFn, (-4., -6., 8.), 2.,
+                           Ccp4Header.START)
+        headers = []
+        for fileName in (fastFn, slowFn):
+            with open(fileName, 'rb') as f:
+                header = f.read(1024)
+            # dimensions, start, grid, cell and origin
+            headers.append((struct.unpack_from('<10i', header),
+                            struct.unpack_from('<6f', header, 40),
+                            struct.unpack_from('<3f', header, 196)))
+        # the map is positioned by the start fields only in both paths
+        self.assertEqual(headers[0], headers[1])
+        self.assertEqual(headers[0][2], (0., 0., 0.))
+
+    def testNeedsConversion(self):
+        outFn = os.path.join(self.tmpDir, 'out.mrc')
+        for i, kwargs in enumerate([{'mode': 1}, {'mapAxes': (3, 2, 1)}]):
+            inFn = os.path.join(self.tmpDir, 'in%d.mrc' % i)
+            writeMrc(inFn, (8, 8, 8), **kwargs)
+            self.assertFalse(fixMapHeader(inFn, outFn, (0., 0., 0.), 1.))
+            self.assertFalse(os.path.exists(outFn))
+
+    def testCropMapToModel(self):
+        mapFn = os.path.join(self.tmpDir, 'map.mrc')
+        linkFn = os.path.join(self.tmpDir, 'link.mrc')
+        pdbFn = os.path.join(self.tmpDir, 'model.pdb')
+        writeMrc(mapFn, (50, 40, 30))
+        with open(mapFn, 'r+b') as f:  # 2 A/px and start (-5, 0, 0)
+            f.seek(16)
+            f.write(struct.pack('<3i', -5, 0, 0))
+            f.seek(40)
+            f.write(struct.pack('<3f', 100., 80., 60.))
+        os.link(mapFn, linkFn)
+        with open(pdbFn, 'w') as f:
+            f.write(PDB_ATOMS)
+
+        self.assertTrue(cropMapToModel(linkFn, pdbFn, 4.))
+        with open(linkFn, 'rb') as f:
+            words = struct.unpack_from(MRC_HEADER_FORMAT, f.read())
+        # atoms plus 4 A: x from 16 to 34 A (pixels 8 to 17), y from 26
+        # to 44 A and z from 36 to 54 A
+        self.assertEqual(words[0:3], (10, 10, 10))
+        self.assertEqual(words[4:7], (8, 13, 18))
+        # the unit cell is kept and the linked file is not modified
+        self.assertEqual(words[7:13], (50, 40, 30, 100., 80., 60.))
+        self.assertEqual(os.stat(mapFn).st_nlink, 1)
+        self.assertEqual(os.path.getsize(mapFn), 1024 + 50 * 40 * 30 * 4)
+
+    def testCropMapWithOrigin(self):
+        mapFn = os.path.join(self.tmpDir, 'map.mrc')
+        pdbFn = os.path.join(self.tmpDir, 'model.pdb')
+        # same position as with start (-5, 0, 0), given by ORIGIN
+        writeMrc(mapFn, (50, 40, 30), origin=(-10., 0., 0.))
+        with open(mapFn, 'r+b') as f:  # 2 A/px
+            f.seek(40)
+            f.write(struct.pack('<3f', 100., 80., 60.))
+        with open(pdbFn, 'w') as f:
+            f.write(PDB_ATOMS)
+
+        self.assertTrue(cropMapToModel(mapFn, pdbFn, 4.))
+        with open(mapFn, 'rb') as f:
+            header = f.read(1024)
+        words = struct.unpack_from(MRC_HEADER_FORMAT, header)
+        # the box starts at x = 13 * 2 - 10 = 16 A, as with the start
+        self.assertEqual(words[0:3], (10, 10, 10))
+        self.assertEqual(words[4:7], (13, 13, 18))
+        self.assertEqual(struct.unpack_from('<3f', header, 196),
+                         (-10., 0., 0.))
+
+    def testParseRSRefineLog(self):
+        logFn = os.path.join(self.tmpDir, 'rsr.log')
+        with open(logFn, 'w') as f:
+            f.write("start\n" + "x" * 20000 + "\n")
+            f.write(RSR_STATISTICS % {'bond': 0.1, 'cc': 0.5})
+            f.write(RSR_STATISTICS % {'bond': 0.004, 'cc': 0.7864})
+            f.write("*********************\n"
+                    "model-to-map fit, CC_mask: 0.7865\n")
+        # the last values are kept
+        self.assertEqual(parseRSRefineLog(logFn),
+                         {'cc_mask': 0.7865, 'cc_volume': 0.7776,
+                          'cc_peaks': 0.6892, 'bond_rmsd': 0.004,
+                          'angle_rmsd': 0.772, 'clashscore': 4.96,
+                          'rama_outliers': 0., 'rama_allowed': 3.57,
+                          'rama_favored': 96.43})
+        with open(logFn) as f:
+            lines = f.read().split('\n')
+        self.assertEqual(list(_readLinesBackwards(logFn, blockSize=7)),
+                         lines[::-1])
+
+    def testScoreWindows(self):
+        mapFn = os.path.join(self.tmpDir, 'map.mrc')
+        writeMrc(mapFn, (10, 10, 10), value=0.)
+        with open(mapFn, 'r+b') as f:  # 1 A/px, voxel (x=2, y=3, z=4) = 1
+            f.seek(1024 + (4 * 100 + 3 * 10 + 2) * 4)
+            f.write(struct.pack('<f', 1.))
+        windows = []
+        # the backbone is ignored, side chain atoms at (2, 3, 4), half
+        # way to it and out of the map
+        for i, sideChain in enumerate([(2., 3., 4.), (2.5, 3., 4.),
+                                       (20., 3., 4.)]):
+            windows.append(os.path.join(self.tmpDir, 'w%d.pdb' % i))
+            with open(windows[-1], 'w') as f:
+                f.write(pdbAtom(1, 'CA', 2., 3., 4.))
+                f.write(pdbAtom(2, 'CB', *sideChain))
+        windows.append(os.path.join(self.tmpDir, 'gly.pdb'))
+        with open(windows[-1], 'w') as f:
+            f.write(pdbAtom(1, 'CA', 2., 3., 4.))
+        scores = scoreWindows(mapFn, windows)
+        # densities in standard deviations of the map
+        std = (0.001 * 0.999) ** 0.5
+        self.assertAlmostEqual(scores[0], 0.999 / std, places=3)
+        self.assertAlmostEqual(scores[1], (0.5 - 0.001) / std, places=3)
+        self.assertAlmostEqual(scores[2], 0.)
+        self.assertTrue(scores[3] != scores[3])  # nan, no side chain
+
+        # the same map moved 2 A along x by START or by ORIGIN, and the
+        # side chain moved with it
+        with open(windows[0], 'w') as f:
+            f.write(pdbAtom(1, 'CA', 4., 3., 4.))
+            f.write(pdbAtom(2, 'CB', 4., 3., 4.))
+        for field, shift in ((16, struct.pack('<3i', 2, 0, 0)),
+                             (196, struct.pack('<3f', 2., 0., 0.))):
+            with open(mapFn, 'r+b') as f:
+                f.seek(16)
+                f.write(struct.pack('<3i', 0, 0, 0))
+                f.seek(196)
+                f.write(struct.pack('<3f', 0., 0., 0.))
+                f.seek(field)
+                f.write(shift)
+            self.assertAlmostEqual(scoreWindows(mapFn, windows[:1])[0],
+                                   0.999 / std, places=3)
+
+    def testFindCloseContacts(self):
+        coords = np.random.RandomState(0).uniform(-3., 3., (300, 3))
+        i, j, distances = findCloseContacts(coords, 0.5)
+        # same pairs as comparing every atom with every other one
+        matrix = np.sqrt(((coords[:, None] - coords[None]) ** 2).sum(axis=2))
+        expected = [(a, b) for a in range(300) for b in range(a + 1, 300)
+                    if matrix[a, b] < 0.5]
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(sorted(zip(i.tolist(), j.tolist())), expected)
+        self.assertTrue(np.allclose(distances, matrix[i, j]))
+        self.assertEqual(len(findCloseContacts(coords[:1], 0.5)[0]), 0)
@@ -0,0 +1,236 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# test the SQLite job queue used by search fit
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pyworkflow.tests import *
+from phenix.jobqueue import (FAILED, FINISHED, PENDING, RUNNING, JobQueue,
+                             JobWatchdog, findChildren)
+
+TABLE = 'jobs'
+
+
+class TestJobQueue(BaseTest):
+
+    def setUp(self):
+        self.dbFn = os.path.join(tempfile.mkdtemp(), 'db.sqlite3')
+        self.queue = JobQueue(self.dbFn, TABLE,
+                              extraColumns={'score': 'float DEFAULT -1'},
+                              indexes=['score'], leaseTime=30,
+                              checkInterval=0)
+        self.queue.create()
+
+    def _getStates(self):
+        conn = sqlite3.connect(self.dbFn)
+        rows = conn.execute("SELECT id, done, attempts FROM %s ORDER BY id"
+                            % TABLE).fetchall()
+        conn.close()
+        return rows
+
+    def testConcurrentClaims(self):
+        self.queue.add(['job%03d' % i for i in range(200)])
+        claimed = []
+        lock = threading.Lock()
+
+        def worker():
+            queue = JobQueue(self.dbFn, TABLE)
+            while True:
+                jobs = queue.claim(3)
+                if not jobs:
+                    break
+                for jobId, _ in jobs:
+                    queue.complete(jobId, score=float(jobId))
+                with lock:
+                    claimed.extend(jobs)
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # every job was done exactly once
+        self.assertEqual(sorted(claimed),
+                         [(i + 1, 'job%03d' % i) for i in range(200)])
+        self.assertEqual(set(r[1] for r in self._getStates()), {FINISHED})
+        self.assertEqual(self.queue.countPending(), 0)
+
+    def testExpiredLease(self):
+        self.queue.add(['a', 'b'])
+        self.queue.leaseTime = 0.2
+        (jobId, _), = self.queue.claim()
+        with self.queue.heartbeat([jobId]):
+            time.sleep(0.5)  # renewed, so nobody else can take it
+            self.assertEqual(self.queue.claim(2), [(2, 'b')])
+        time.sleep(0.3)  # not renewed any more: back in the queue
+        self.assertEqual(self.queue.claim(), [(1, 'a')])
+        self.assertTrue(self.queue.complete(1, score=0.5))
+        self.assertFalse(self.queue.complete(1, score=0.6))
+
+    def testOrphansAndFailures(self):
+        self.queue.add(['a'])
+        conn = sqlite3.connect(self.dbFn)
+        # claimed by a process that does not exist
+        conn.execute("UPDATE %s SET done=?, lease_owner=?, lease_expires=?"
+                     % TABLE, (RUNNING, '%s:999999999:1' % os.uname()[1],
+                               time.time() + 1000))
+        conn.commit()
+        conn.close()
+        for attempt in range(3):
+            (jobId, _), = self.queue.claim()
+            self.queue.release(jobId)
+        # too many attempts: failed, with the reason
+        self.assertEqual(self.queue.claim(), [])
+        self.assertEqual(self._getStates(), [(1, FAILED, 3)])
+        self.assertEqual(self.queue.countPending(), 0)
+        conn = sqlite3.connect(self.dbFn)
+        reason, = conn.execute("SELECT reason FROM %s" % TABLE).fetchone()
+        conn.close()
+        self.assertEqual(reason, 'not finished after 3 attempts')
+
+    def testExhaustedLease(self):
+        self.queue.add(['a', 'b'])
+        self.queue.leaseTime = 0.1
+        for attempt in range(3):
+            self.assertEqual(self.queue.claim(), [(1, 'a')])
+            time.sleep(0.2)  # the lease expires without completing
+        # the last attempt is still running while its lease is valid
+        self.queue.leaseTime = 30
+        self.assertEqual(self.queue.claim(), [(2, 'b')])
+        self.assertEqual(self.queue.countPending(), 1)
+        self.assertEqual(self._getStates(), [(1, FAILED, 3), (2, RUNNING, 1)])
+
+    def testIndexedChecks(self):
+        conn = sqlite3.connect(self.dbFn)
+        # the searches run by claim and countPending do not scan the table
+        for query, params in [
+                ("SELECT id, lease_owner FROM %s WHERE done=?", (1,)),
+                ("UPDATE %s SET done=3 WHERE attempts >= ? AND "
+                 "(done=? OR (done=? AND lease_expires < ?))", (3, 0, 1, 0)),
+                ("SELECT COUNT(*) FROM %s WHERE done IN (?, ?)", (0, 1))]:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + query % TABLE,
+                                params).fetchall()
+            self.assertFalse(any(row[-1].startswith('SCAN %s' % TABLE) and
+                                 'INDEX' not in row[-1] for row in plan),
+                             plan)
+        conn.close()
+
+    def testCheckInterval(self):
+        queue = JobQueue(self.dbFn, TABLE, checkInterval=1000)
+        queue.add(['a'])
+        (jobId, _), = queue.claim()
+        conn = sqlite3.connect(self.dbFn)
+        conn.execute("UPDATE %s SET lease_owner=?" % TABLE,
+                     ('%s:999999999:1' % os.uname()[1],))
+        conn.commit()
+        conn.close()
+        # orphans are only searched for every checkInterval seconds
+        self.assertEqual(queue.claim(), [])
+        queue.checkInterval = 0
+        queue._nextCheck = 0
+        self.assertEqual(queue.claim(), [(jobId, 'a')])
+
+    def testInterrupted(self):
+        self.queue.add(['a', 'b', 'c'])
+        (mine, _), = self.queue.claim()
+        conn = sqlite3.connect(self.dbFn)
+        # claimed before a reboot by a pid now used by a live process
+        conn.execute("UPDATE %s SET done=?, attempts=1, lease_owner=?, "
+                     "lease_expires=? WHERE id > ?" % TABLE,
+                     (RUNNING, '%s:%d:1' % (os.uname()[1], os.getppid()),
+                      time.time() + 1000, mine))
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.queue.claim(), [])
+        self.assertEqual(self.queue.requeueInterrupted(), 2)
+        self.assertEqual(self._getStates(), [(1, RUNNING, 1), (2, PENDING, 0),
+                                             (3, PENDING, 0)])
+
+    def testMigration(self):
+        dbFn = os.path.join(os.path.dirname(self.dbFn), 'old.sqlite3')
+        conn = sqlite3.connect(dbFn)
+        conn.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                     " filename TEXT, done int DEFAULT 0,"
+                     " score float DEFAULT -1)" % TABLE)
+        conn.executemany("INSERT INTO %s(filename, done, score) "
+                         "VALUES(?, ?, ?)" % TABLE,
+                         [('a', 1, 0.5), ('b', 1, -1), ('c', 0, -1)])
+        conn.commit()
+        conn.close()
+        queue = JobQueue(dbFn, TABLE, extraColumns={'score': 'float'})
+        queue.create(finishedCondition='score != -1')
+        self.assertEqual(queue.claim(5), [(2, 'b'), (3, 'c')])
+
+    def testRequeue(self):
+        self.queue.add(['a', 'b', 'c'])
+        for jobId, _ in self.queue.claim(3):
+            self.queue.complete(jobId, score=float(jobId),
+                                onComplete=lambda conn: conn.execute(
+                                    "UPDATE %s SET filename=filename||'!' "
+                                    "WHERE id=?" % TABLE, (jobId,)))
+        # promote the best job
+        self.assertEqual(self.queue.requeue("score > ?", (2.5,), score=-1.), 1)
+        self.assertEqual(self.queue.claim(3, columns=('score',)),
+                         [(3, 'c!', -1.)])
+
+    def testWatchdog(self):
+        self.queue.add(['a', 'b'])
+        (jobId, _), = self.queue.claim()
+        # a job that would run for a minute is killed after half a second
+        token = 'import time; time.sleep(60)  # job %d' % jobId
+        process = subprocess.Popen([sys.executable, '-c', token])
+        start = time.time()
+        with JobWatchdog(lambda: findChildren(token), maxTime=0.5,
+                         interval=0.1) as watchdog:
+            process.wait()
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(watchdog.reason.startswith('wall time'))
+        self.assertTrue(self.queue.fail(jobId, watchdog.reason))
+        # failed jobs are not claimed again nor counted as pending
+        self.assertEqual(self.queue.claim(2), [(2, 'b')])
+        self.assertEqual(self.queue.countPending(), 1)
+        self.assertEqual(self._getStates()[0], (jobId, FAILED, 1))
+        # but they can be queued again, e.g. with cheaper settings
+        self.assertEqual(self.queue.requeue("id=?", (jobId,), score=0.), 1)
+        self.assertEqual(self.queue.claim(), [(jobId, 'a')])
+
+    def testOrder(self):
+        queue = JobQueue(self.dbFn, TABLE,
+                         extraColumns={'score': 'float DEFAULT -1'},
+                         order='score DESC, id')
+        queue.add(['a', 'b', 'c'])
+        conn = sqlite3.connect(self.dbFn)
+        conn.execute("UPDATE %s SET score=-2 WHERE filename='a'" % TABLE)
+        conn.commit()
+        conn.close()
+        # a goes to the back of the queue
+        self.assertEqual(queue.claim(3), [(1, 'a'), (2, 'b'), (3, 'c')])
+        self.queue.release(2)
+        self.queue.release(1)
+        self.assertEqual(queue.claim(), [(2, 'b')])
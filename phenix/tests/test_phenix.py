@@ -22,6 +22,9 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # ***************************************************************************
 
+import os
+import stat
+import tempfile
 
 from pyworkflow.tests import *
 from phenix import Plugin
@@ -36,3 +39,29 @@ class TestVersion(BaseTest):
         else:
             print(("Your version is not " + PHENIXVERSION + " anymore"))
             print(("Your current version is " + version))
+
+    def testVersionIsCached(self):
+        Plugin.getPhenixVersion()
+        launches = Plugin.versionLaunches
+        for _ in range(100):
+            Plugin.getPhenixVersion()
+        # phenix.version is launched at most once per installation
+        self.assertEqual(Plugin.versionLaunches, launches)
+        self.assertLessEqual(launches, 1)
+
+    def _writeProgram(self, output):
+        fileName = os.path.join(tempfile.mkdtemp(), 'phenix.version')
+        with open(fileName, 'w') as f:
+            f.write("#!/bin/sh\necho '%s'\n" % output)
+        os.chmod(fileName, os.stat(fileName).st_mode | stat.S_IEXEC)
+        return fileName
+
+    def testParseVersion(self):
+        program = self._writeProgram("Release tag: 4487\nVersion: 1.20.1")
+        self.assertEqual(Plugin._runPhenixVersion(program), '1.20')
+        # no version in the output: nothing parsed, nothing cached
+        program = self._writeProgram("command not found")
+        self.assertEqual(Plugin._runPhenixVersion(program), '')
+        for version in ('', 'und ', None):
+            self.assertFalse(Plugin._isVersionValid(version))
+        self.assertTrue(Plugin._isVersionValid('1.19'))
@@ -0,0 +1,84 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# protocol to test the batch real_space_refine of a set of atomic structures
+import os
+
+from pwem.protocols.protocol_import import ProtImportSetOfAtomStructs
+from phenix.protocols.protocol_real_space_refine_batch import \
+    PhenixProtRunRSRefineBatch
+from pyworkflow.tests import *
+from phenix import Plugin, PHENIXVERSION
+from .test_protocol_real_space_refine import TestImportData
+
+
+class TestPhenixRSRefineBatch(TestImportData):
+    """ Refine the three refmac models of the tutorial against refmac3.mrc
+    """
+
+    def _importSetOfRefmacStructs(self):
+        args = {'inputPdbData': ProtImportSetOfAtomStructs.IMPORT_FROM_FILES,
+                'filesPath': os.path.dirname(self.dsModBuild.getFile(
+                    'PDBx_mmCIF/refmac3.pdb')),
+                'filesPattern': 'refmac?.pdb'
+                }
+        protImport = self.newProtocol(ProtImportSetOfAtomStructs, **args)
+        protImport.setObjLabel('import set of pdbs\n refmac1-3.pdb')
+        self.launchProtocol(protImport)
+        return protImport.outputAtomStructs
+
+    def testPhenixRSRefineBatch(self):
+        print("Run phenix real_space_refine on a set of three atomic "
+              "structures and one volume")
+        volume_refmac3 = self._importVolRefmac3()
+        structures = self._importSetOfRefmacStructs()
+        self.assertEqual(structures.getSize(), 3)
+
+        args = {'inputVolume': volume_refmac3,
+                'resolution': 3.5,
+                'inputStructures': structures,
+                'numberOfThreads': 4,
+                'occupancy': False,
+                'nqh_flips': False
+                }
+        if Plugin.getPhenixVersion() == PHENIXVERSION:
+            args['doSecondary'] = False
+        protBatch = self.newProtocol(PhenixProtRunRSRefineBatch, **args)
+        protBatch.setObjLabel('RSRefine batch\n refmac3.mrc and '
+                              'refmac1-3.pdb\n')
+        self.launchProtocol(protBatch)
+
+        # the map is converted once, a refined structure per input one
+        extraFiles = os.listdir(protBatch._getExtraPath())
+        self.assertEqual([fn for fn in extraFiles if fn.endswith('.mrc')],
+                         [protBatch.REALSPACEFILE])
+        output = protBatch.outputAtomStructs
+        self.assertEqual(output.getSize(), 3)
+        self.assertEqual(sorted(atomStruct.inputId.get()
+                                for atomStruct in output),
+                         sorted(atomStruct.getObjId()
+                                for atomStruct in structures))
+        for atomStruct in output:
+            self.assertTrue(os.path.exists(atomStruct.getFileName()))
+            self.assertTrue(atomStruct.clashscore.get() >= 0)
+            self.assertTrue(0 <= atomStruct.ramachandranFavored.get() <= 100)
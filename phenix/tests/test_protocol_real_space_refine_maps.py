@@ -0,0 +1,91 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+
+# protocol to test the refinement of one atomic structure against several maps
+import csv
+import os
+
+from pwem.protocols.protocol_import import ProtImportVolumes
+from phenix.protocols.protocol_real_space_refine_maps import \
+    PhenixProtRunRSRefineMaps
+from pyworkflow.tests import *
+from phenix import Plugin, PHENIXVERSION
+from .test_protocol_real_space_refine import TestImportData
+
+
+class TestPhenixRSRefineMaps(TestImportData):
+    """ Refine refmac3.pdb against the three refmac maps of the tutorial
+    """
+
+    def _importSetOfRefmacVolumes(self):
+        args = {'filesPath': os.path.dirname(self.dsModBuild.getFile(
+            'volumes/refmac3.mrc')),
+                'filesPattern': 'refmac?.mrc',
+                'samplingRate': 1.5,
+                'setOrigCoord': True,
+                'x': 37.5,
+                'y': 37.5,
+                'z': 37.5
+                }
+        protImportVol = self.newProtocol(ProtImportVolumes, **args)
+        protImportVol.setObjLabel('import volumes\n refmac1-3.mrc')
+        self.launchProtocol(protImportVol)
+        return protImportVol.outputVolumes
+
+    def testPhenixRSRefineMaps(self):
+        print("Run phenix real_space_refine of one atomic structure against "
+              "a set of three volumes")
+        volumes = self._importSetOfRefmacVolumes()
+        self.assertEqual(volumes.getSize(), 3)
+        structure_refmac3 = self._importStructRefmac3()
+
+        args = {'inputVolumes': volumes,
+                'resolution': 3.5,
+                'inputStructure': structure_refmac3,
+                'numberOfThreads': 4,
+                'occupancy': False,
+                'nqh_flips': False
+                }
+        if Plugin.getPhenixVersion() == PHENIXVERSION:
+            args['doSecondary'] = False
+        protMaps = self.newProtocol(PhenixProtRunRSRefineMaps, **args)
+        protMaps.setObjLabel('RSRefine maps\n refmac1-3.mrc and '
+                             'refmac3.pdb\n')
+        self.launchProtocol(protMaps)
+
+        # a refined model per map
+        output = protMaps.outputAtomStructs
+        self.assertEqual(output.getSize(), 3)
+        self.assertEqual(sorted(atomStruct.mapId.get()
+                                for atomStruct in output),
+                         sorted(vol.getObjId() for vol in volumes))
+        for atomStruct in output:
+            self.assertTrue(os.path.exists(atomStruct.getFileName()))
+            self.assertTrue(0 < atomStruct.ccMask.get() <= 1)
+        # and the comparison table, best fit first
+        with open(protMaps._getExtraPath('comparison.csv')) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 3)
+        ccs = [float(row['cc_mask']) for row in rows]
+        self.assertEqual(ccs, sorted(ccs, reverse=True))
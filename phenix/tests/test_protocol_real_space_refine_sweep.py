@@ -0,0 +1,135 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# protocol to test the sweep of real_space_refine settings
+import csv
+import json
+import os
+import shutil
+import tempfile
+
+from phenix.convert import parseRSRefineLog
+from phenix.protocols.protocol_real_space_refine_sweep import (
+    PhenixProtRunRSRefineSweep, getParetoFront, getParetoKeys,
+    getPointScores, getSettingsKey)
+from pyworkflow.object import Float
+from pyworkflow.tests import *
+from phenix import Plugin, PHENIXVERSION
+from .test_protocol_real_space_refine import TestImportData
+
+
+class TestParetoFront(BaseTest):
+
+    def testParetoFront(self):
+        # (CC_mask, MolProbity score): higher and lower are better
+        scores = [(0.80, 2.0), (0.70, 1.5), (0.75, 2.5), (0.80, 2.0),
+                  (0.60, 1.5), (0.85, 3.0)]
+        # 2 is worse than 0 in both, 4 than 1; equal points are kept
+        self.assertEqual(getParetoFront(scores), [0, 1, 3, 5])
+        self.assertEqual(getParetoFront([]), [])
+
+    def testUnscoredPoint(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        results = []
+        # the refinement of the last point stopped before the model vs
+        # data statistics
+        for i, log in enumerate(["CC_mask  : 0.8000\n",
+                                 "CC_mask  : 0.7000\n",
+                                 "Clashscore : 4.96\n"]):
+            logFn = os.path.join(tmpDir, 'point%d.log' % i)
+            with open(logFn, 'w') as f:
+                f.write(log)
+            ccMask, molprobityScore = getPointScores(
+                parseRSRefineLog(logFn), {'overallScore': Float(2.0 - i)})
+            results.append({'settings': {'point': i}, 'cc_mask': ccMask,
+                            'molprobity_score': molprobityScore})
+        self.assertEqual(results[2]['cc_mask'], None)
+        self.assertEqual(results[2]['molprobity_score'], 0.0)
+        # a missing MolProbity score also leaves a point unscored
+        self.assertEqual(getPointScores({'cc_mask': 0.9}, {}), (0.9, None))
+        # the unscored point is left out despite its best MolProbity score
+        self.assertEqual(getParetoKeys(results),
+                         set(getSettingsKey({'point': i}) for i in (0, 1)))
+
+    def testSettingsKey(self):
+        self.assertEqual(getSettingsKey({'a': 1, 'b': True}),
+                         getSettingsKey({'b': True, 'a': 1}))
+        self.assertNotEqual(getSettingsKey({'a': 1}),
+                            getSettingsKey({'a': 2}))
+
+
+class TestPhenixRSRefineSweep(TestImportData):
+    """ Sweep the settings of the refinement of refmac3.pdb against
+    refmac3.mrc and extend it with more macro cycles
+    """
+
+    def _runSweep(self, volume, structure, label, **kwargs):
+        args = {'inputVolume': volume,
+                'resolution': 3.5,
+                'inputStructure': structure,
+                'numberOfThreads': 3,
+                'occupancy': False,
+                'nqh_flips': False,
+                'sweepRunModes': 'localGridSearch'
+                }
+        if Plugin.getPhenixVersion() == PHENIXVERSION:
+            args['doSecondary'] = False
+        args.update(kwargs)
+        protSweep = self.newProtocol(PhenixProtRunRSRefineSweep, **args)
+        protSweep.setObjLabel(label)
+        self.launchProtocol(protSweep)
+        with open(protSweep._getExtraPath('sweep.csv')) as f:
+            return protSweep, list(csv.DictReader(f))
+
+    def testPhenixRSRefineSweep(self):
+        print("Run a sweep of phenix real_space_refine settings and extend it")
+        volume_refmac3 = self._importVolRefmac3()
+        structure_refmac3 = self._importStructRefmac3()
+
+        # local grid search on and off
+        protSweep, rows = self._runSweep(volume_refmac3, structure_refmac3,
+                                         'RSRefine sweep\n local grid search')
+        self.assertEqual(len(rows), 2)
+        front = [row for row in rows if row['pareto'] == '1']
+        self.assertTrue(1 <= len(front) <= 2)
+        self.assertEqual(protSweep.outputAtomStructs.getSize(), len(front))
+        for atomStruct in protSweep.outputAtomStructs:
+            self.assertTrue(os.path.exists(atomStruct.getFileName()))
+            self.assertTrue(0 < atomStruct.ccMask.get() <= 1)
+
+        # the points with 5 macro cycles are taken from the first sweep
+        protExtended, rows = self._runSweep(
+            volume_refmac3, structure_refmac3,
+            'RSRefine sweep\n extended with 10 macro cycles',
+            sweepMacroCycles='5 10', previousSweep=protSweep)
+        self.assertEqual(len(rows), 4)
+        for row in rows:
+            if row['macroCycles'] != '5':
+                continue
+            results = []
+            for prot in (protSweep, protExtended):
+                with open(prot._getExtraPath('point_%s' % row['key'],
+                                             'result.json')) as f:
+                    results.append(json.load(f))
+            self.assertEqual(results[0], results[1])
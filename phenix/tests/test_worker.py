@@ -0,0 +1,127 @@
+# ***************************************************************************
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+# test the phenix.python worker protocol using the scipion python
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import types
+
+from pyworkflow.tests import *
+from phenix.worker import (PhenixPythonWorker, PhenixScriptError,
+                           PhenixWorkerError, _moveOutputs)
+
+
+class TestPhenixWorker(BaseTest):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.worker = PhenixPythonWorker(sys.executable, idleTimeout=30)
+
+    def tearDown(self):
+        self.worker.close()
+
+    def testPing(self):
+        self.assertEqual(self.worker.call('ping'), 'pong')
+        pid = self.worker.getPid()
+        self.assertEqual(self.worker.call('ping'), 'pong')
+        # the same process answers every request
+        self.assertEqual(self.worker.getPid(), pid)
+
+    def testRunScript(self):
+        outFn = os.path.join(self.tmpDir, 'out.txt')
+        scriptFn = os.path.join(self.tmpDir, 'script.py')
+        with open(scriptFn, 'w') as f:
+            f.write("print('to stderr')\n"
+                    "with open('out.txt', 'w') as f:\n"
+                    "    f.write('done')\n")
+        self.worker.runScript(scriptFn, cwd=self.tmpDir)
+        with open(outFn) as f:
+            self.assertEqual(f.read(), 'done')
+
+        with open(scriptFn, 'w') as f:
+            f.write("raise ValueError('wrong')\n")
+        self.assertRaises(PhenixScriptError, self.worker.runScript, scriptFn)
+        # the worker survives errors in the scripts
+        self.assertEqual(self.worker.call('ping'), 'pong')
+
+    def testPickleAttributes(self):
+        data = types.SimpleNamespace(
+            model=types.SimpleNamespace(score=1.5, outliers=[1, 2]))
+        pklFn = os.path.join(self.tmpDir, 'data.pkl')
+        with open(pklFn, 'wb') as f:
+            pickle.dump(data, f)
+        values = self.worker.getPickleAttributes(
+            pklFn, [('score', 'model.score'), ('outliers', 'model.outliers')])
+        self.assertEqual(values, [('score', 1.5), ('outliers', [1, 2])])
+
+    def testOutputSerials(self):
+        stem = 'coot_000001_Imol_0000_version_0001_real_space_refined'
+        rounds = []
+        for searchRound in range(2):
+            # every round runs in an empty folder, so its outputs are _000
+            runDir = tempfile.mkdtemp(dir=self.tmpDir)
+            for ext in ('.cif', '.log'):
+                with open(os.path.join(runDir, stem + '_000' + ext),
+                          'w') as f:
+                    f.write('round %d' % searchRound)
+            rounds.append(_moveOutputs(runDir, self.tmpDir))
+        self.assertEqual(rounds, [[stem + '_000.cif', stem + '_000.log'],
+                                  [stem + '_001.cif', stem + '_001.log']])
+        # the outputs of the first round are kept
+        for searchRound, serial in enumerate(('_000', '_001')):
+            with open(os.path.join(self.tmpDir, stem + serial + '.cif')) as f:
+                self.assertEqual(f.read(), 'round %d' % searchRound)
+
+    def testRestart(self):
+        self.worker.call('ping')
+        self.worker.close()
+        self.assertFalse(self.worker.isAlive())
+        self.assertEqual(self.worker.call('ping'), 'pong')
+
+    def testMissingProgram(self):
+        worker = PhenixPythonWorker(os.path.join(self.tmpDir, 'phenix.python'))
+        self.assertRaises(PhenixWorkerError, worker.call, 'ping')
+
+    def testPython2Server(self):
+        # phenix.python is python 2 before PHENIX 1.19
+        python2 = shutil.which('python2.7') or shutil.which('python2')
+        if python2 is None:
+            self.skipTest("python 2 is not installed")
+        worker = PhenixPythonWorker(python2, idleTimeout=30)
+        try:
+            try:
+                worker.call('ping')
+            except PhenixWorkerError:
+                self.skipTest("python 2 cannot be launched")
+            scriptFn = os.path.join(self.tmpDir, 'script.py')
+            with open(scriptFn, 'w') as f:
+                f.write("with open('out.txt', 'w') as f:\n"
+                        "    f.write('done')\n")
+            worker.runScript(scriptFn, cwd=self.tmpDir)
+            with open(os.path.join(self.tmpDir, 'out.txt')) as f:
+                self.assertEqual(f.read(), 'done')
+        finally:
+            worker.close()
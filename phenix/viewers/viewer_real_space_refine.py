@@ -25,6 +25,12 @@
 # **************************************************************************
 
 from phenix.protocols.protocol_real_space_refine import PhenixProtRunRSRefine
+from phenix.protocols.protocol_real_space_refine_batch import \
+    PhenixProtRunRSRefineBatch
+from phenix.protocols.protocol_real_space_refine_maps import \
+    PhenixProtRunRSRefineMaps
+from phenix.protocols.protocol_real_space_refine_sweep import \
+    PhenixProtRunRSRefineSweep
 from .viewer_validation_cryoem import PhenixProtRunValidationCryoEMViewer
 
 class PhenixProtRunRSRefineViewer(PhenixProtRunValidationCryoEMViewer):
@@ -33,6 +39,14 @@ class PhenixProtRunRSRefineViewer(PhenixProtRunValidationCryoEMViewer):
     _label = 'Real Space Refine viewer'
     _targets = [PhenixProtRunRSRefine]
 
+    @classmethod
+    def can_handle_this_instance(cls, instance):
+        # the batch refinements have no single model to validate, their
+        # output set is shown by the generic viewers
+        return not isinstance(instance, (PhenixProtRunRSRefineBatch,
+                                         PhenixProtRunRSRefineMaps,
+                                         PhenixProtRunRSRefineSweep))
+
     def __init__(self,  **kwargs):
          PhenixProtRunValidationCryoEMViewer.__init__(self, **kwargs)
          REALSPACEFILE = self.protocol._getExtraPath(
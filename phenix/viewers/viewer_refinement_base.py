@@ -1512,8 +1512,8 @@ if data.model_stats.ligands is not None:
         with open(pythonFileName, "w") as f:
             f.write(command)
 
-        # execute file with phenix.python
-        Plugin.runPhenixProgram("", pythonFileName)
+        # execute file with the phenix.python worker
+        Plugin.runPhenixScript(pythonFileName)
 
         # read file in scipion python
         with open(ANALYSISTMPFILENAME, "r") as f:
@@ -27,6 +27,8 @@
 import math
 import os
 import sqlite3
+import tempfile
+from urllib.request import pathname2url
 
 import matplotlib.pyplot as plt
 from tkinter import messagebox
@@ -35,10 +37,14 @@ from pyworkflow.protocol.params import LabelParam, EnumParam, IntParam, FloatPar
 from pyworkflow.viewer import DESKTOP_TKINTER, WEB_DJANGO, ProtocolViewer
 from pwem.viewers import TableView, Chimera
 from pwem import Domain
-from phenix.protocols.protocol_search_fit import (DATAFILE,
-                                                  TABLE)
-from phenix import Plugin
-from phenix.constants import PHENIXVERSION19
+from phenix.cache import FileArchive
+from phenix.protocols.protocol_search_fit import (DATAFILE, DIRECTIONNAMES,
+                                                  FRAGMENTTABLE, TABLE,
+                                                  ROUNDTABLE, SUMMARYTABLE,
+                                                  TOPTABLE, TOPSIZE,
+                                                  WINDOWSARCHIVE)
+
+LIVE_PLOT_INTERVAL = 5  # seconds between updates of the live plot
 
 def errorWindow(tkParent, msg):
     try:
@@ -51,6 +57,55 @@ def errorWindow(tkParent, msg):
         print(("Error:", msg))
 
 
+def connectReadOnly(dbFileName):
+    """ Read only connection to the database of a (maybe running) search
+    fit: viewers never create, migrate or lock it for writing.
+    Raises sqlite3.OperationalError if it does not exist. """
+    return sqlite3.connect('file:%s?mode=ro'
+                           % pathname2url(os.path.abspath(dbFileName)),
+                           uri=True, timeout=60)
+
+
+class SearchFitMonitor(object):
+    """ Incremental reader of the results of a (maybe running) search
+    fit: each update only fetches the refinements finished since the
+    previous one. """
+    def __init__(self, dbFileName):
+        self.dbFileName = dbFileName
+        self.lastId = 0
+        self.scores = {}  # job id -> (search round, model_to_map_fit)
+
+    def update(self):
+        """ Read the new results, return how many there were. """
+        if not os.path.exists(self.dbFileName):
+            return 0
+        try:
+            conn = connectReadOnly(self.dbFileName)
+            try:
+                rows = conn.execute("""SELECT id, job_id, search_round,
+                                              model_to_map_fit
+                                       FROM %s
+                                       WHERE id > ?
+                                       ORDER BY id""" % ROUNDTABLE,
+                                    (self.lastId,)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.OperationalError:  # table not created yet
+            rows = []
+        for rowId, jobId, searchRound, modelToMapFit in rows:
+            # keep the result of the most expensive round
+            if self.scores.get(jobId, (-1, 0))[0] <= searchRound:
+                self.scores[jobId] = (searchRound, modelToMapFit)
+            self.lastId = rowId
+        return len(rows)
+
+    def getRanking(self, n):
+        """ Best n windows as (job id, search round, model_to_map_fit) """
+        ranking = sorted(self.scores.items(), key=lambda item: item[1],
+                         reverse=True)
+        return [(jobId, r, fit) for jobId, (r, fit) in ranking[:n]]
+
+
 class PhenixProtRuSearchFitViewer(ProtocolViewer):
     """ Viewer for Phenix program DEARCHFIT
     """
@@ -70,11 +125,19 @@ class PhenixProtRuSearchFitViewer(ProtocolViewer):
                            " plus 5 better atom struct candidates.")
         form.addParam("numAtomStruct", IntParam, label="Max. Number Atom Structs.",
                       default=1000,
-                      help="Number of atom structs to show ordered by model_to_map_fit\n")
+                      help="Number of atom structs to show ordered by model_to_map_fit\n"
+                           "(the summary plot shows at most %d)" % TOPSIZE)
         form.addParam("zone", FloatParam, label="Show Area around input atomic struct (A)",
                       default=3,
                       help="Limit the display to a zone around the input atomic structure.\n"
                            "Units = A.")
+        form.addParam('showLivePlot', LabelParam,
+                      label="Live plot",
+                      help="Plot of 'model_to_map_fit' values and ranking of "
+                           "the best windows, updated every %d seconds while "
+                           "the search is running. X axis as in the summary "
+                           "plot. Each window shows the value of the last "
+                           "round it reached." % LIVE_PLOT_INTERVAL)
         form.addParam('showPlot', LabelParam,
                       label="Summary Plot",
                       help="Plot showing 'model_to_map_fit' values. The X axis indicates \n"
@@ -85,7 +148,8 @@ class PhenixProtRuSearchFitViewer(ProtocolViewer):
     def _getVisualizeDict(self):
         return {
             'showMapModel': self._showMapModel,
-            'showPlot': self._showPlot
+            'showPlot': self._showPlot,
+            'showLivePlot': self._showLivePlot
         }
 
     def _showMapModel(self, e=None):
@@ -129,24 +193,8 @@ class PhenixProtRuSearchFitViewer(ProtocolViewer):
                 (counter -1, counter, self.zone.get()))
         f.write("cofr #%d\n" % counter)
         # open database and retrieve all files
-        conn = sqlite3.connect(os.path.abspath(self.protocol._getExtraPath(DATAFILE)))
-        c = conn.cursor()
-        sqlCommand = """SELECT filename, phenix_id
-                        FROM   %s
-                        WHERE model_to_map_fit != -1
-                        ORDER BY model_to_map_fit DESC
-                        LIMIT %d""" % (TABLE, self.numAtomStruct)
-        c.execute(sqlCommand)
-        rows = c.fetchall()
-
-        for row in rows:
-            if Plugin.getPhenixVersion() >= PHENIXVERSION19:
-                atomStructFn = row[0][:-4] + "_real_space_refined_000.cif"
-            else:
-                atomStructFn = row[0][:-4] + "_real_space_refined.cif"
+        for atomStructFn in self._getBestWindowFiles():
             f.write("open %s\n" % atomStructFn)
-        c.close()
-        conn.close()
         f.close()
         # run in the background
         chimeraPlugin = Domain.importFromPlugin('chimera', 'Plugin', doRaise=True)
@@ -154,6 +202,92 @@ class PhenixProtRuSearchFitViewer(ProtocolViewer):
                                         cwd=os.getcwd())
         return []
 
+    def _getBestWindowFiles(self):
+        """ Refined models of the best numAtomStruct windows, in the extra
+        folder of the protocol. Those that are only in the archive are
+        extracted to a temporary folder; the database and the archive of
+        the protocol are not modified. """
+        try:
+            conn = connectReadOnly(self.protocol._getExtraPath(DATAFILE))
+            try:
+                rows = conn.execute(
+                    """SELECT * FROM %s WHERE model_to_map_fit != -1
+                       ORDER BY search_round DESC, model_to_map_fit DESC
+                       LIMIT ?""" % TABLE,
+                    (self.numAtomStruct.get(),)).fetchall()
+                columns = [d[0] for d in conn.execute(
+                    "SELECT * FROM %s LIMIT 0" % TABLE).description]
+            finally:
+                conn.close()
+        except sqlite3.OperationalError:  # search not started yet
+            return []
+        archive = FileArchive(self.protocol._getExtraPath(WINDOWSARCHIVE))
+        tmpDir = None
+        fileNames = []
+        for row in rows:
+            row = dict(zip(columns, row))
+            # phenix_id is the serial number of the last run ('' before 1.19)
+            atomStructFn = row['filename'][:-4] + "_real_space_refined%s.cif" \
+                % row.get('phenix_id', '')
+            if not os.path.exists(atomStructFn) and row.get('archived'):
+                # refined models are kept on disk when the window is
+                # archived, but may have been archived by older versions
+                if tmpDir is None:
+                    tmpDir = tempfile.mkdtemp(prefix='search_fit_windows_')
+                extracted = os.path.join(tmpDir,
+                                         os.path.basename(atomStructFn))
+                if extracted in archive.extract(row['id'], tmpDir):
+                    atomStructFn = extracted
+            fileNames.append(atomStructFn)
+        return fileNames
+
+    def _getFragments(self, conn):
+        """ Fragments as in the protocol, read from conn """
+        try:
+            rows = conn.execute("""SELECT id, filename, chain, first_residue,
+                                          size, label
+                                   FROM %s""" % FRAGMENTTABLE).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        if not rows:  # run made before there were fragments
+            return dict(enumerate(self.protocol._readFragments()[:1]))
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def _readRound(self, c, searchRound, fragment, direction):
+        """ (count, sum, sum2) of the results of a round for a fragment
+        and direction, and its best (job id, model_to_map_fit). Read from
+        the running aggregates or, in runs made before they existed,
+        from the results of every round. """
+        try:
+            c.execute("""SELECT count, sum, sum2 FROM %s
+                         WHERE search_round=? AND fragment=? AND direction=?"""
+                      % SUMMARYTABLE, (searchRound, fragment, direction))
+            summary = c.fetchone()
+            c.execute("""SELECT job_id, model_to_map_fit FROM %s
+                         WHERE search_round=? AND fragment=? AND direction=?
+                         ORDER BY model_to_map_fit DESC
+                         LIMIT ?""" % TOPTABLE,
+                      (searchRound, fragment, direction,
+                       self.numAtomStruct.get()))
+            return summary, c.fetchall()
+        except sqlite3.OperationalError:
+            pass
+        results = """FROM %s r JOIN %s t ON t.id = r.job_id
+                     WHERE r.search_round=? AND t.fragment=?
+                     AND t.direction=?""" % (ROUNDTABLE, TABLE)
+        params = (searchRound, fragment, direction)
+        try:
+            c.execute("""SELECT COUNT(*), SUM(r.model_to_map_fit),
+                                SUM(r.model_to_map_fit * r.model_to_map_fit)
+                         """ + results, params)
+            summary = c.fetchone()
+            c.execute("SELECT r.job_id, r.model_to_map_fit " + results +
+                      " ORDER BY r.model_to_map_fit DESC LIMIT ?",
+                      params + (min(self.numAtomStruct.get(), TOPSIZE),))
+            return summary, c.fetchall()
+        except sqlite3.OperationalError:  # nothing refined yet
+            return None, []
+
     def _getInputVolume(self):
         if self.protocol.inputVolume.get() is None:
             fnVol = self.protocol.inputStructure.get().getVolume()
@@ -163,73 +297,93 @@ class PhenixProtRuSearchFitViewer(ProtocolViewer):
 
 
     def _showPlot(self, e=None):
-
-        xList = []
-        yList = []
-        conn = sqlite3.connect(os.path.abspath(self.protocol._getExtraPath(DATAFILE)))
+        # statistics of the first round, the only one with every window
+        searchRound = 0
+        try:
+            conn = connectReadOnly(self.protocol._getExtraPath(DATAFILE))
+        except sqlite3.OperationalError:  # search not started yet
+            errorWindow(self.getTkRoot(), "No data available")
+            return
+        fragments = self._getFragments(conn)
+        directions = self.protocol._getDirections()
+        # a series per chain and threading direction
+        groups = [(fragment, direction) for fragment in sorted(fragments)
+                  for direction in directions]
         c = conn.cursor()
-        sqlCommand = """
-                        SELECT id, model_to_map_fit
-                            FROM (
-                                  SELECT id, model_to_map_fit
-                                  FROM   %s
-                                  WHERE model_to_map_fit != -1
-                                  ORDER BY model_to_map_fit desc
-                                  LIMIT %d) AS a
-                           ORDER BY id
-                          """ % (TABLE, self.numAtomStruct)
-
-        c.execute(sqlCommand)
-        rows = c.fetchall()
+        titles = []
+        xMax, yMax = 0.0, 0.0
+        for fragment, direction in groups:
+            summary, rows = self._readRound(c, searchRound, fragment,
+                                            direction)
+            rows = sorted(rows)
+            if not summary or not summary[0] or not rows:
+                continue
 
-        for row in rows:
-            xList.append(float(row[0]) - 1.0)
-            yList.append(float(row[1]))
-        # compute avg
-        sqlCommand = """SELECT AVG(model_to_map_fit) 
-                        FROM (SELECT model_to_map_fit
-                             FROM %s
-                             WHERE model_to_map_fit != -1
-                             ORDER BY model_to_map_fit desc
-                             )""" % (TABLE)
-        c.execute(sqlCommand)
-        rows = c.fetchone(); avg = rows[0]
-        print("avg", avg)
-        fromRelation = """(SELECT model_to_map_fit
-                             FROM %s
-                             WHERE model_to_map_fit != -1
-                             ORDER BY model_to_map_fit desc
-                             ) AS mainTable""" % (TABLE)
-
-        sqlCommand = """SELECT AVG((mainTable.model_to_map_fit - sub.a) * (mainTable.model_to_map_fit - sub.a)) as var
-                        FROM %s,
-                        (SELECT AVG(model_to_map_fit) AS a
-                         FROM %s
-                         WHERE model_to_map_fit != -1
-                        ) AS sub
-                        WHERE model_to_map_fit != -1
-                        """ % (fromRelation, fromRelation)
-        c.execute(sqlCommand)
-        rows = c.fetchone(); std_2 = rows[0]
-        std = math.sqrt(std_2)
+            count, total, total2 = summary
+            avg = total / count
+            std = math.sqrt(max(total2 / count - avg * avg, 0.))
+            xList = [float(row[0]) - 1.0 for row in rows]
+            yList = [float(row[1]) for row in rows]
+            best = max(yList)
+            zBest = (best - avg) / std if std > 0 else 0.
+            label = []
+            if len(fragments) > 1:
+                label.append('chain %s' % fragments[fragment][4])
+            if len(directions) > 1:
+                label.append(DIRECTIONNAMES[direction])
+            label = ' '.join(label)
+            title = 'avg (all data) = %f, std (all data) = %f\n' \
+                    'best = %f (z-score %0.2f)' % (avg, std, best, zBest)
+            if label:
+                title = '%s: %s' % (label, title.replace('\n', ', '))
+            titles.append(title)
+            plt.plot(xList, yList, 'x', label=label)
+            xMax, yMax = max(xMax, max(xList)), max(yMax, best)
         c.close()
         conn.close()
 
-        if not (xList or yList):
+        if not titles:
             errorWindow(self.getTkRoot(), "No data available")
             return
 
-        title = 'avg (all data) = %f, std (all data) = %f'%(avg, std)
-        plt.plot(xList, yList, 'x')
-        plt.axis([-1.0, max(xList) + 1.0, 0.0, max(yList)+0.1])
-        plt.title(title)
+        plt.axis([-1.0, xMax + 1.0, 0.0, yMax + 0.1])
+        plt.title('\n'.join(titles))
+        if len(groups) > 1:
+            plt.legend()
         plt.xlabel('#Atom Structs')
         plt.ylabel('Map Model Fit Score')
         plt.show()
-        print(xList, yList)
 
-        # SELECT FLOOR(model_to_map_fit/5.00)*5 As Grade,
-        #        COUNT(*) AS [Grade Count]
-        # FROM TableName
-        # GROUP BY FLOOR(model_to_map_fit/5.00)*5
-        # ORDER BY 1
+    def _showLivePlot(self, e=None):
+        monitor = SearchFitMonitor(
+            os.path.abspath(self.protocol._getExtraPath(DATAFILE)))
+        fig, ax = plt.subplots()
+        ax.set_xlabel('#Atom Structs')
+        ax.set_ylabel('Map Model Fit Score')
+        points, = ax.plot([], [], 'x')
+        ranking = ax.text(0.01, 0.99, '', transform=ax.transAxes,
+                          verticalalignment='top', family='monospace')
+
+        def update():
+            if not monitor.update() and monitor.lastId:
+                return
+            jobIds = sorted(monitor.scores)
+            xList = [jobId - 1 for jobId in jobIds]
+            yList = [monitor.scores[jobId][1] for jobId in jobIds]
+            points.set_data(xList, yList)
+            if xList:
+                ax.axis([-1.0, max(xList) + 1.0, 0.0, max(yList) + 0.1])
+            lines = ['%4s %5s %6s' % ('#', 'round', 'fit')]
+            lines += ['%4d %5d %6.3f' % (jobId - 1, r, fit)
+                      for jobId, r, fit in monitor.getRanking(5)]
+            ranking.set_text('\n'.join(lines))
+            ax.set_title('%d refined windows' % len(jobIds))
+            fig.canvas.draw_idle()
+
+        update()
+        # keep a reference to the timer, otherwise it is garbage collected
+        self._liveTimer = fig.canvas.new_timer(
+            interval=LIVE_PLOT_INTERVAL * 1000)
+        self._liveTimer.add_callback(update)
+        self._liveTimer.start()
+        plt.show()
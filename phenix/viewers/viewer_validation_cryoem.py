@@ -648,8 +648,8 @@ data.model.geometry.clash.clashes.save_table_data("{dirName}/clashes.txt")
                    dirName=dirName)
             with open(CLASHESFILENAME, "w") as f:
                 f.write(command)
-            # execute file with phenix.python
-            Plugin.runPhenixProgram("", CLASHESFILENAME)
+            # execute file with the phenix.python worker
+            Plugin.runPhenixScript(CLASHESFILENAME)
 
         self._openBrowser(onSelect)
 
@@ -1705,8 +1705,8 @@ if data.model.geometry.rama_z is not None:
         with open(pythonFileName, "w") as f:
             f.write(command)
 
-        # execute file with phenix.python
-        Plugin.runPhenixProgram("", pythonFileName)
+        # execute file with the phenix.python worker
+        Plugin.runPhenixScript(pythonFileName)
 
         # read file in scipion python
         with open(VALIDATIONTMPFILENAME, "r") as f:
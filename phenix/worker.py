@@ -0,0 +1,366 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Long-lived phenix.python worker.
+
+Starting phenix.python and importing cctbx costs several seconds, so instead
+of writing a script and launching a new interpreter for every pickle we
+need to read, a single phenix.python process is kept alive and receives
+JSON-RPC requests (one JSON document per line) through its stdin. Answers
+are written to a private copy of the original stdout; anything printed by
+the executed code goes to stderr.
+
+This file is used on both sides: imported by Scipion (python 3) it provides
+the client (PhenixPythonWorker), executed by phenix.python it runs the
+server. phenix.python is python 2 before PHENIX 1.19, so the file must
+remain valid python 2 code and the server functions must only use what
+python 2.7 provides (e.g. os.rename, not os.replace).
+"""
+
+import json
+import os
+import re
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+# seconds without requests before the worker exits
+WORKER_IDLE_TIMEOUT = 600
+
+# JSON-RPC error codes
+ERROR_SCRIPT = -32000  # the executed code raised an exception
+ERROR_METHOD = -32601  # unknown method
+
+
+class PhenixWorkerError(Exception):
+    """ The worker could not be started or stopped answering. """
+    pass
+
+
+class PhenixScriptError(Exception):
+    """ The code run by the worker raised an exception. """
+    pass
+
+
+# --------------------------- client ------------------------------------------
+
+class PhenixPythonWorker(object):
+    """ Client of a phenix.python process running this file.
+    The process is started on the first request, restarted if it died
+    (e.g. because it was idle for more than idleTimeout seconds) and
+    stopped with close().
+    """
+    def __init__(self, program, environ=None, idleTimeout=WORKER_IDLE_TIMEOUT):
+        self.program = program
+        self.environ = environ
+        self.idleTimeout = idleTimeout
+        self._process = None
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def isAlive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def getPid(self):
+        return self._process.pid if self.isAlive() else None
+
+    def _start(self):
+        serverFile = os.path.abspath(__file__)
+        if serverFile.endswith('.pyc'):
+            serverFile = serverFile[:-1]
+        try:
+            self._process = subprocess.Popen(
+                [self.program, serverFile, str(self.idleTimeout)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                env=self.environ, universal_newlines=True)
+        except OSError as e:
+            self._process = None
+            raise PhenixWorkerError("Cannot start %s: %s" % (self.program, e))
+
+    def call(self, method, **params):
+        """ Send a request and wait for its answer. """
+        with self._lock:
+            if not self.isAlive():
+                self._start()
+            self._counter += 1
+            request = {'jsonrpc': '2.0', 'id': self._counter,
+                       'method': method, 'params': params}
+            try:
+                self._process.stdin.write(json.dumps(request) + '\n')
+                self._process.stdin.flush()
+                line = self._process.stdout.readline()
+            except (OSError, IOError) as e:
+                self._kill()
+                raise PhenixWorkerError("Worker communication failed: %s" % e)
+            if not line:
+                self._kill()
+                raise PhenixWorkerError("Worker exited while running '%s'"
+                                        % method)
+        response = json.loads(line)
+        if 'error' in response:
+            error = response['error']
+            if error['code'] == ERROR_SCRIPT:
+                raise PhenixScriptError("%s\n%s" % (error['message'],
+                                                    error.get('data', '')))
+            raise PhenixWorkerError(error['message'])
+        return response['result']
+
+    def runScript(self, fileName, cwd=None):
+        """ Execute a python script inside the worker. """
+        return self.call('run_script', file=os.path.abspath(fileName),
+                         cwd=os.path.abspath(cwd or os.getcwd()))
+
+    def getPickleAttributes(self, fileName, attributes):
+        """ Load a pickle file and return the requested attributes.
+        attributes: list of (key, 'dotted.attribute.path') pairs.
+        Returns a list of (key, value) pairs in the same order.
+        """
+        return [tuple(item) for item in
+                self.call('pickle_attrs', file=os.path.abspath(fileName),
+                          attrs=list(attributes))]
+
+    def runProgram(self, program, args, cwd, logFileName):
+        """ Run a PHENIX program (e.g. 'phenix.programs.real_space_refine')
+        inside the worker, with the arguments of its command line.
+        Its output is written to logFileName. Returns the names of the
+        files it created, which are moved to cwd when it finishes. """
+        return self.call('run_program', program=program, args=list(args),
+                         cwd=os.path.abspath(cwd),
+                         log=os.path.abspath(logFileName))
+
+    def close(self):
+        """ Ask the worker to exit and wait for it. """
+        with self._lock:
+            if not self.isAlive():
+                return
+            try:
+                self._process.stdin.write(json.dumps(
+                    {'jsonrpc': '2.0', 'id': 0, 'method': 'shutdown',
+                     'params': {}}) + '\n')
+                self._process.stdin.flush()
+                self._process.wait(timeout=10)
+            except Exception:
+                self._kill()
+            self._process = None
+
+    def _kill(self):
+        if self.isAlive():
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+
+# --------------------------- server ------------------------------------------
+
+def _getAttribute(obj, path):
+    for name in path.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _toJson(value):
+    """ Convert cctbx objects (e.g. flex arrays) to something json can
+    serialize. """
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        pass
+    try:
+        return [_toJson(v) for v in value]
+    except TypeError:
+        return str(value)
+
+
+def _loadPickle(fileName):
+    try:
+        from libtbx import easy_pickle
+        return easy_pickle.load(fileName)
+    except ImportError:
+        import pickle
+        with open(fileName, 'rb') as f:
+            return pickle.load(f)
+
+
+def _runScript(params):
+    fileName = params['file']
+    os.chdir(params.get('cwd') or os.path.dirname(fileName))
+    with open(fileName) as f:
+        code = compile(f.read(), fileName, 'exec')
+    namespace = {'__name__': '__main__', '__file__': fileName}
+    exec(code, namespace)
+    return None
+
+
+def _pickleAttributes(params):
+    data = _loadPickle(params['file'])
+    return [(key, _toJson(_getAttribute(data, path)))
+            for key, path in params['attrs']]
+
+
+# maps already read by this worker: (path, mtime) -> map manager
+_maps = {}
+
+
+def _cacheMaps():
+    """ Make the data managers of this process read every map file once:
+    following requests on the same file get a copy of the map already
+    in memory. """
+    try:
+        from iotbx.data_manager.real_map import RealMapDataManager
+    except ImportError:
+        return
+    if getattr(RealMapDataManager, '_scipionMapCache', False):
+        return
+    processFile = RealMapDataManager.process_real_map_file
+
+    def process_real_map_file(self, filename):
+        key = (os.path.abspath(filename), os.path.getmtime(filename))
+        if key in _maps:
+            self.add_real_map(filename, _maps[key].deep_copy())
+        else:
+            processFile(self, filename)
+            _maps[key] = self.get_real_map(filename).deep_copy()
+        return filename
+
+    RealMapDataManager.process_real_map_file = process_real_map_file
+    RealMapDataManager._scipionMapCache = True
+
+
+def _runProgram(params):
+    """ Run the program in a private folder inside cwd, so that only its
+    own outputs are returned even if other programs are writing in cwd
+    at the same time, and then move them to cwd. """
+    import importlib
+    from iotbx.cli_parser import run_program
+    from libtbx.utils import multi_out
+    cwd = params['cwd']
+    _cacheMaps()
+    program = importlib.import_module(params['program']).Program
+    # input paths relative to cwd, for the private folder
+    args = []
+    for arg in params['args']:
+        name, sep, value = arg.rpartition('=')
+        path = os.path.join(cwd, value)
+        if value and not os.path.isabs(value) and os.path.exists(path):
+            arg = name + sep + os.path.abspath(path)
+        args.append(arg)
+    runDir = tempfile.mkdtemp(prefix='.phenix_run_', dir=cwd)
+    try:
+        os.chdir(runDir)
+        logFile = open(params['log'], 'w')
+        try:
+            logger = multi_out()
+            logger.register('stdout', sys.stdout)
+            logger.register('log', logFile)
+            run_program(program_class=program, args=args, logger=logger)
+        finally:
+            logFile.close()
+        os.chdir(cwd)
+        newFiles = _moveOutputs(runDir, cwd)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(runDir, ignore_errors=True)
+    return newFiles
+
+
+# output names with a serial number, e.g. model_real_space_refined_000.cif
+SERIAL = re.compile(r'^(.+)_(\d{3})([._].*)?$')
+
+
+def _moveOutputs(runDir, cwd):
+    """ Move the files of runDir to cwd and return their new names.
+    The program ran in an empty folder, so it numbered its outputs from
+    the first serial: they are renumbered after the outputs that earlier
+    runs (e.g. previous rounds of a window) left in cwd. """
+    taken = {}  # stem -> serials already in cwd
+    for name in os.listdir(cwd):
+        match = SERIAL.match(name)
+        if match:
+            taken.setdefault(match.group(1), set()).add(int(match.group(2)))
+    newFiles = []
+    for name in sorted(os.listdir(runDir)):
+        newName = name
+        match = SERIAL.match(name)
+        if match and match.group(1) in taken:
+            serials = taken[match.group(1)]
+            newName = '%s_%03d%s' % (match.group(1),
+                                     max(serials) + 1 + int(match.group(2)),
+                                     match.group(3) or '')
+        dst = os.path.join(cwd, newName)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        # replaces dst on POSIX, unlike os.replace also in python 2
+        os.rename(os.path.join(runDir, name), dst)
+        newFiles.append(newName)
+    return sorted(newFiles)
+
+
+METHODS = {
+    'ping': lambda params: 'pong',
+    'run_script': _runScript,
+    'pickle_attrs': _pickleAttributes,
+    'run_program': _runProgram,
+}
+
+
+def serve(idleTimeout):
+    # keep the real stdout for the answers and send everything
+    # else (prints from the executed scripts) to stderr
+    out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    while True:
+        ready, _, _ = select.select([sys.stdin], [], [], idleTimeout)
+        if not ready:
+            break  # idle for too long
+        line = sys.stdin.readline()
+        if not line:
+            break  # client is gone
+        request = json.loads(line)
+        method = request.get('method')
+        if method == 'shutdown':
+            break
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        if method not in METHODS:
+            response['error'] = {'code': ERROR_METHOD,
+                                 'message': 'Unknown method %s' % method}
+        else:
+            try:
+                response['result'] = METHODS[method](request.get('params', {}))
+            except BaseException as e:
+                response['error'] = {'code': ERROR_SCRIPT,
+                                     'message': '%s: %s'
+                                                % (type(e).__name__, e),
+                                     'data': traceback.format_exc()}
+        out.write(json.dumps(response) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    serve(float(sys.argv[1]) if len(sys.argv) > 1 else WORKER_IDLE_TIMEOUT)